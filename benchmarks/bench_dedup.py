@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the removal of repeated urls over the all_units dict.
+
+It compares dedup_units (single pass, one shared set of seen urls, counts
+as a by-product) against the previous implementation, which called
+utils.remove_duplicates (copying the whole set of seen urls on every call)
+and then walked both dicts again with num_urls_in_units_dict. The previous
+implementation is quadratic, so it is only run up to --max-old urls.
+
+Usage:
+
+    python benchmarks/bench_dedup.py [--max-old NUM_URLS]
+"""
+
+from __future__ import print_function
+
+import argparse
+import sys
+import time
+
+sys.path.insert(0, '.')
+
+from edx_dl.common import Unit, Video  # noqa: E402
+from edx_dl.edx_dl import dedup_units, num_urls_in_units_dict  # noqa: E402
+from edx_dl.utils import remove_duplicates  # noqa: E402
+
+SIZES = [10000, 100000, 1000000]
+
+
+def old_remove_repeated_urls(all_units):
+    existing_urls = set()
+    filtered_units = {}
+    for url, units in all_units.items():
+        reduced_units = []
+        for unit in units:
+            videos = []
+            for video in unit.videos:
+                video_youtube_url = None
+                if video.video_youtube_url not in existing_urls:
+                    video_youtube_url = video.video_youtube_url
+                    existing_urls.add(video_youtube_url)
+
+                mp4_urls, existing_urls = remove_duplicates(video.mp4_urls,
+                                                            existing_urls)
+
+                if video_youtube_url is not None or len(mp4_urls) > 0:
+                    videos.append(Video(video_youtube_url=video_youtube_url,
+                                        available_subs_url=video.available_subs_url,
+                                        sub_template_url=video.sub_template_url,
+                                        mp4_urls=mp4_urls))
+
+            resources_urls, existing_urls = remove_duplicates(unit.resources_urls,
+                                                              existing_urls)
+
+            if len(videos) > 0 or len(resources_urls) > 0:
+                reduced_units.append(Unit(videos=videos,
+                                          resources_urls=resources_urls))
+
+        filtered_units[url] = reduced_units
+    return filtered_units
+
+
+def old_dedup(all_units):
+    filtered_units = old_remove_repeated_urls(all_units)
+    return (filtered_units, num_urls_in_units_dict(all_units),
+            num_urls_in_units_dict(filtered_units))
+
+
+def build_units(num_urls, units_per_page=10):
+    """
+    Build an all_units dict with about num_urls urls (5 per unit), a fifth
+    of them repeated across pages.
+    """
+    all_units = {}
+    num_units = num_urls // 5
+    for page in range(num_units // units_per_page):
+        units = []
+        for i in range(units_per_page):
+            n = page * units_per_page + i
+            video = Video(video_youtube_url='https://youtube.com/watch?v=%d' % n,
+                          available_subs_url='subs/%d' % n,
+                          sub_template_url='template/%d/%%s' % n,
+                          mp4_urls=['https://cdn/%d.mp4' % n])
+            units.append(Unit(videos=[video],
+                              resources_urls=['https://res/%d.pdf' % (n // 2)]))
+        all_units['https://page/%d' % page] = units
+    return all_units
+
+
+def timed(func, all_units):
+    start = time.time()
+    result = func(all_units)
+    return time.time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--max-old', type=int, default=100000,
+                        help='largest size run with the old implementation')
+    args = parser.parse_args()
+
+    print('%10s %12s %12s' % ('urls', 'old (s)', 'new (s)'))
+    for size in SIZES:
+        all_units = build_units(size)
+        new_time, new_result = timed(dedup_units, all_units)
+        old_time = '-'
+        if size <= args.max_old:
+            elapsed, old_result = timed(old_dedup, all_units)
+            assert old_result[1:] == new_result[1:]
+            old_time = '%.2f' % elapsed
+        print('%10d %12s %12.2f' % (size, old_time, new_time))
+
+
+if __name__ == '__main__':
+    main()
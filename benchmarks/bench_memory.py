@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Memory benchmark of the course data model.
+
+It builds the same all_units dict ({SubSection.url: [Unit]}) with the
+current __slots__ based classes and with equivalent plain classes (the model
+used before, with a per-instance __dict__, lists and non shared URL strings)
+and reports the memory used by each one.
+
+Usage:
+
+    python benchmarks/bench_memory.py [NUM_UNITS]
+"""
+
+from __future__ import print_function
+
+import gc
+import sys
+import tracemalloc
+
+sys.path.insert(0, '.')
+
+from edx_dl.common import Unit, Video  # noqa: E402
+
+
+class PlainUnit(object):
+    def __init__(self, videos, resources_urls):
+        self.videos = videos
+        self.resources_urls = resources_urls
+
+
+class PlainVideo(object):
+    def __init__(self, video_youtube_url, available_subs_url,
+                 sub_template_url, mp4_urls):
+        self.video_youtube_url = video_youtube_url
+        self.available_subs_url = available_subs_url
+        self.sub_template_url = sub_template_url
+        self.mp4_urls = mp4_urls
+
+
+def _url(*parts):
+    # built at runtime, like the strings coming from the parsed pages, so
+    # equal URLs are different objects unless they are interned
+    return ''.join(str(part) for part in parts)
+
+
+def build_units(num_units, unit_class, video_class, units_per_page=10):
+    """
+    Build an all_units dict with num_units units. Every page repeats the
+    course resources (a syllabus and the slides of the week), as it happens
+    in real courses.
+    """
+    base = 'https://courses.edx.org/courses/course-v1:Org+C101+2017/'
+    all_units = {}
+    for page in range(num_units // units_per_page):
+        page_url = _url(base, 'courseware/week', page // 20, '/seq', page)
+        units = []
+        for i in range(units_per_page):
+            n = page * units_per_page + i
+            mp4 = _url('https://d2f1egay8yehza.cloudfront.net/org-c101/V', n,
+                       '_100.mp4')
+            video = video_class(
+                video_youtube_url=_url('https://youtube.com/watch?v=',
+                                       '%011d' % n),
+                available_subs_url=_url(base, 'xblock/video', n,
+                                        '/handler/transcript/available'),
+                sub_template_url=_url(base, 'xblock/video', n,
+                                      '/handler/transcript/translation/%s'),
+                mp4_urls=[mp4, _url(mp4)])
+            resources = [_url(base, 'asset/syllabus.pdf'),
+                         _url(base, 'asset/week', page // 20, '-slides.pdf')]
+            units.append(unit_class(videos=[video], resources_urls=resources))
+        all_units[page_url] = units
+    return all_units
+
+
+def measure(num_units, unit_class, video_class):
+    """
+    Return the number of bytes allocated to build the units dict.
+    """
+    gc.collect()
+    tracemalloc.start()
+    all_units = build_units(num_units, unit_class, video_class)
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del all_units
+    return current
+
+
+def main():
+    num_units = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    plain = measure(num_units, PlainUnit, PlainVideo)
+    compact = measure(num_units, Unit, Video)
+
+    print('units:   %d' % num_units)
+    print('plain:   %8.1f MiB' % (plain / 2.0 ** 20))
+    print('compact: %8.1f MiB' % (compact / 2.0 ** 20))
+    print('saved:   %8.1f%%' % (100.0 * (plain - compact) / plain))
+
+
+if __name__ == '__main__':
+    main()
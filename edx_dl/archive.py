@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+"""
+Archive of the fetched pages, used to record a run and replay it offline.
+
+The pages are stored compressed (gzip) and content-addressed by the SHA-1
+of their text, so a page fetched several times (or identical pages under
+different URLs) is stored once. An append-only index maps each URL to the
+hash of its last recorded contents:
+
+    DIR/index.jsonl         {"url": ..., "sha1": ...} per line
+    DIR/objects/ab/abcd...  gzip compressed utf-8 text of a page
+
+Replaying reads the objects through memory maps and decompresses them while
+they are consumed, so re-running the extraction of thousands of pages needs
+no network at all.
+"""
+
+import codecs
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import threading
+import zlib
+
+from .utils import mkdir_p
+
+
+INDEX_FILENAME = 'index.jsonl'
+OBJECTS_DIRNAME = 'objects'
+
+
+class PageNotArchivedError(LookupError):
+    """
+    Raised when replaying a page that was not recorded.
+    """
+    pass
+
+
+class _ArchiveWriter(object):
+    """
+    Writes one page into the archive while it is being fetched.
+    """
+    def __init__(self, archive, url):
+        self.archive = archive
+        self.url = url
+        self._sha1 = hashlib.sha1()
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                            16 + zlib.MAX_WBITS)
+        fd, self._tmp_filename = tempfile.mkstemp(dir=archive.objects_dir,
+                                                  prefix='tmp-')
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self._sha1.update(data)
+        self._file.write(self._compressor.compress(data))
+
+    def close(self):
+        """
+        Store the page in its final place and add it to the index.
+        """
+        self._file.write(self._compressor.flush())
+        self._file.close()
+        sha1 = self._sha1.hexdigest()
+        filename = self.archive.object_filename(sha1)
+        mkdir_p(os.path.dirname(filename))
+        if os.path.exists(filename):
+            os.remove(self._tmp_filename)
+        else:
+            os.rename(self._tmp_filename, filename)
+        self.archive.add_to_index(self.url, sha1)
+
+    def abort(self):
+        """
+        Discard the page, e.g. because the fetch failed.
+        """
+        self._file.close()
+        os.remove(self._tmp_filename)
+
+
+class PageArchive(object):
+    """
+    Content-addressed archive of pages, see the module documentation.
+    """
+    def __init__(self, directory):
+        """
+        @param directory: Directory of the archive, created if needed.
+        @type directory: str
+        """
+        self.directory = directory
+        self.objects_dir = os.path.join(directory, OBJECTS_DIRNAME)
+        self.index_filename = os.path.join(directory, INDEX_FILENAME)
+        self._index = {}
+        self._lock = threading.Lock()
+
+        mkdir_p(self.objects_dir)
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename) as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._index[entry['url']] = entry['sha1']
+
+    def __contains__(self, url):
+        return url in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def object_filename(self, sha1):
+        return os.path.join(self.objects_dir, sha1[:2], sha1)
+
+    def add_to_index(self, url, sha1):
+        with self._lock:
+            self._index[url] = sha1
+            with open(self.index_filename, 'a') as f:
+                f.write(json.dumps({'url': url, 'sha1': sha1}) + '\n')
+
+    def writer(self, url):
+        """
+        Return a writer to record the page of url chunk by chunk. The page
+        is only added to the archive when the writer is closed.
+        """
+        return _ArchiveWriter(self, url)
+
+    def put(self, url, text):
+        """
+        Record the whole text of the page of url.
+        """
+        writer = self.writer(url)
+        writer.write(text)
+        writer.close()
+
+    def iter_text(self, url, chunk_size=64 * 1024):
+        """
+        Generator of the text of the recorded page of url, in chunks.
+        """
+        try:
+            sha1 = self._index[url]
+        except KeyError:
+            raise PageNotArchivedError('Page not in the archive: %s' % url)
+
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        with open(self.object_filename(sha1), 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for pos in range(0, len(data), chunk_size):
+                    text = decoder.decode(
+                        decompressor.decompress(data[pos:pos + chunk_size]))
+                    if text:
+                        yield text
+            finally:
+                data.close()
+        text = decoder.decode(decompressor.flush(), final=True)
+        if text:
+            yield text
+
+    def get(self, url):
+        """
+        Return the text of the recorded page of url.
+        """
+        return ''.join(self.iter_text(url))
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""
+Checksums of the downloaded files, used to audit a mirror for corruption.
+
+The SHA-256 of every file is computed while it is downloaded (so it costs no
+second read) and appended, with the size and modification time of the file,
+to a sidecar manifest in the directory of the file:
+
+    DIR/.edx-dl-checksums   {"filename": ..., "size": ..., "mtime": ...,
+                             "sha256": ...} per line, the last entry of a
+                             filename wins
+
+A quick verification only compares sizes and modification times and rehashes
+the files whose size matches but whose modification time changed. A full
+verification rehashes every file, in parallel processes.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+
+MANIFEST_FILENAME = '.edx-dl-checksums'
+
+# modification times are compared with this tolerance (in seconds) since
+# some filesystems don't keep them with full precision
+MTIME_TOLERANCE = 0.01
+
+OK = 'ok'
+MISSING = 'missing'
+WRONG_SIZE = 'wrong size'
+WRONG_CHECKSUM = 'wrong checksum'
+
+_lock = threading.Lock()
+
+
+def new_hash():
+    """
+    Return a new hash object of the algorithm used in the manifests.
+    """
+    return hashlib.sha256()
+
+
+def hash_file(filename, chunk_size=1024 * 1024):
+    """
+    Return the hex digest of the contents of filename.
+    """
+    hash_ = new_hash()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hash_.update(chunk)
+    return hash_.hexdigest()
+
+
+def record_checksum(filename, sha256):
+    """
+    Append the checksum, size and modification time of the (just
+    downloaded) filename to the manifest of its directory.
+    """
+    stat = os.stat(filename)
+    directory, basename = os.path.split(filename)
+    entry = {'filename': basename, 'size': stat.st_size,
+             'mtime': stat.st_mtime, 'sha256': sha256}
+    with _lock:
+        with open(os.path.join(directory, MANIFEST_FILENAME), 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+
+def read_manifest(directory):
+    """
+    Return the entries of the manifest of directory as a dict
+    {filename: entry}.
+    """
+    entries = {}
+    with open(os.path.join(directory, MANIFEST_FILENAME)) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                entries[entry['filename']] = entry
+    return entries
+
+
+def _iter_entries(root):
+    """
+    Generator of (path, entry) for every file recorded in the manifests
+    below root.
+    """
+    for directory, _, filenames in os.walk(root):
+        if MANIFEST_FILENAME in filenames:
+            for basename, entry in sorted(read_manifest(directory).items()):
+                yield os.path.join(directory, basename), entry
+
+
+def _check_stat(path, entry):
+    """
+    Return the problem found comparing the file with its entry without
+    reading it, or None if it must be rehashed to know, or OK.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return MISSING
+    if stat.st_size != entry['size']:
+        return WRONG_SIZE
+    if abs(stat.st_mtime - entry['mtime']) > MTIME_TOLERANCE:
+        return None
+    return OK
+
+
+def _check_hash(path_and_entry):
+    path, entry = path_and_entry
+    try:
+        sha256 = hash_file(path)
+    except (IOError, OSError):
+        return path, MISSING
+    return path, OK if sha256 == entry['sha256'] else WRONG_CHECKSUM
+
+
+def verify(root, full=False, processes=None):
+    """
+    Verify the files recorded in the manifests below root and return the
+    list of (path, status) of every file, status being one of OK, MISSING,
+    WRONG_SIZE or WRONG_CHECKSUM.
+
+    @param full: Rehash every file (in a pool of processes) instead of only
+        the ones whose modification time changed.
+    @type full: bool
+
+    @param processes: Size of the pool of processes, default the number of
+        CPUs.
+    @type processes: int
+    """
+    results = []
+    to_hash = []
+    for path, entry in _iter_entries(root):
+        status = _check_stat(path, entry)
+        if status is None or (full and status == OK):
+            to_hash.append((path, entry))
+        else:
+            results.append((path, status))
+
+    if full and to_hash:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+        try:
+            results.extend(pool.imap_unordered(_check_hash, to_hash,
+                                               chunksize=4))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        if to_hash:
+            logging.info('Rehashing %d modified files', len(to_hash))
+        results.extend(_check_hash(item) for item in to_hash)
+
+    return sorted(results)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-process API of edx-dl, for programs that serve many requests with one
+authenticated session instead of running edx-dl once per course:
+
+    client = EdxClient('user@example.com', 'password')
+    courses = client.list_courses()
+    sections = client.outline(courses[0])
+    for planned in client.plan_downloads({courses[0]: sections}):
+        print(planned.url, planned.path)
+
+No method exits the program: the errors are raised as EdxDlError, whose
+exit_code is the one the command line tool would have exited with.
+
+Every client has its own session (cookies) with its site, so clients of
+different sites can be used at the same time from different threads. The
+other network settings (retries, timeouts) are shared by the whole process.
+"""
+
+import argparse
+
+from . import edx_dl
+from .common import EdxDlError, ExitCode
+
+
+class EdxClient(object):
+    """
+    Client of an Open edX site holding one authenticated session.
+    """
+    def __init__(self, username, password, platform='edx',
+                 file_formats=None, overwrite_file_formats=False,
+                 limiter=None):
+        """
+        @param platform: Key of the site in OPENEDX_SITES.
+        @type platform: str
+
+        @param file_formats: Formats of the resources to download besides
+            the default ones (see DEFAULT_FILE_FORMATS).
+        @type file_formats: [str]
+
+        @param overwrite_file_formats: Download only file_formats.
+        @type overwrite_file_formats: bool
+
+        @param limiter: Limiter of the concurrent requests to the site, by
+            default the one shared by all the sites.
+        @type limiter: AdaptiveLimiter
+        """
+        self.site = edx_dl.OpenEdxSite(platform, limiter)
+        self.file_formats = edx_dl.get_file_formats(file_formats or [],
+                                                    overwrite_file_formats)
+        with edx_dl.use_site(self.site):
+            self.headers = edx_dl.login(username, password)
+
+    def list_courses(self, started_only=True):
+        """
+        Returns the [Course] the user is enrolled in, only the started ones
+        unless started_only is False.
+        """
+        with edx_dl.use_site(self.site):
+            courses = edx_dl.get_courses_info(self.site.dashboard,
+                                              self.headers)
+        if started_only:
+            courses = [course for course in courses
+                       if course.state == 'Started']
+        return courses
+
+    def select_courses(self, course_urls):
+        """
+        Returns the started courses whose url is in course_urls, raising
+        EdxDlError if there is none.
+        """
+        return edx_dl.filter_courses(self.list_courses(), course_urls)
+
+    def outline(self, course):
+        """
+        Returns the [Section] of course.
+        """
+        with edx_dl.use_site(self.site):
+            return edx_dl.get_course_sections(course, self.headers)
+
+    def iter_units(self, urls):
+        """
+        Generator of (url, [Unit]) for the urls of subsections, extracted
+        in parallel and yielded as soon as each one is extracted.
+        """
+        with edx_dl.use_site(self.site):
+            return edx_dl.iter_all_units(urls, self.headers,
+                                         self.file_formats)
+
+    def plan_downloads(self, selections, output_dir='Downloaded',
+                       subtitles=False, prefer_cdn_videos=False,
+                       cdn_quality='best', all_units=None):
+        """
+        Returns the [PlannedDownload] of the resources of the selected
+        sections, without downloading anything. The repeated urls are only
+        planned once.
+
+        @param selections: Selected sections as {Course: [Section]}.
+        @type selections: dict
+
+        @param all_units: Units of the subsections as {url: [Unit]}, they
+            are extracted if not given.
+        @type all_units: dict
+
+        The other parameters are the ones of the command line options with
+        the same name, cdn_quality being 'best', 'smallest', 'all' or a
+        height (int).
+        """
+        if all_units is None:
+            urls = [subsection.url
+                    for sections in selections.values()
+                    for section in sections
+                    for subsection in section.subsections]
+            all_units = dict(self.iter_units(urls))
+        if not any(all_units.values()):
+            raise EdxDlError('No downloadable video found.',
+                             ExitCode.NO_DOWNLOADABLE_VIDEO)
+
+        filtered_units = edx_dl.dedup_units(all_units)[0]
+        args = argparse.Namespace(output_dir=output_dir,
+                                  subtitles=subtitles,
+                                  prefer_cdn_videos=prefer_cdn_videos,
+                                  cdn_quality=cdn_quality,
+                                  shard=None)
+        with edx_dl.use_site(self.site):
+            return list(edx_dl.iter_planned_downloads(args, selections,
+                                                      filtered_units,
+                                                      self.headers))
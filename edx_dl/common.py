@@ -30,13 +30,63 @@ In the script the data structures used are:
 
 4. The units can contain multiple videos:
    Unit -> [Video]
+
+Since a cache can hold hundreds of thousands of these objects, they use
+__slots__ instead of a per-instance __dict__, URLs are interned (so the same
+URL repeated across videos, units and dict keys is stored only once) and the
+fields that never change after extraction are tuples instead of lists.
 """
 
+import os
+
+from six.moves import intern
+
+
+def intern_url(url):
+    """
+    Return the canonical (interned) copy of the url string, so that repeated
+    URLs share the same object in memory.
+    """
+    if url is None:
+        return None
+    try:
+        return intern(url)
+    except TypeError:  # python2 can't intern unicode strings
+        return url
+
+
+def _intern_urls(urls):
+    """
+    Return a tuple with the interned copy of the given urls.
+    """
+    return tuple(intern_url(url) for url in urls)
+
 
-class Course(object):
+class _Compact(object):
+    """
+    Base class of the __slots__ based model classes.
+
+    It supports pickling with any protocol and reading caches written before
+    the classes had __slots__ (whose state is a __dict__).
+    """
+    __slots__ = ()
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):  # (dict_state, slots_state)
+            state = dict(state[0] or {}, **(state[1] or {}))
+        # going through __init__ interns the urls read from the cache
+        self.__init__(**state)
+
+
+class Course(_Compact):
     """
     Course class represents course information.
     """
+    __slots__ = ('id', 'name', 'url', 'state')
+
     def __init__(self, id, name, url, state):
         """
         @param id: The id of a course in edX is composed by the path
@@ -57,7 +107,7 @@ class Course(object):
         """
         self.id = id
         self.name = name
-        self.url = url
+        self.url = intern_url(url)
         self.state = state
 
     def __repr__(self):
@@ -65,10 +115,12 @@ class Course(object):
         return self.name + ": " + url
 
 
-class Section(object):
+class Section(_Compact):
     """
     Representation of a section of the course.
     """
+    __slots__ = ('position', 'name', 'url', 'subsections')
+
     def __init__(self, position, name, url, subsections):
         """
         @param position: Integer position of the section in the list of
@@ -87,14 +139,16 @@ class Section(object):
         """
         self.position = position
         self.name = name
-        self.url = url
-        self.subsections = subsections
+        self.url = intern_url(url)
+        self.subsections = tuple(subsections)
 
 
-class SubSection(object):
+class SubSection(_Compact):
     """
     Representation of a subsection in a section.
     """
+    __slots__ = ('position', 'name', 'url')
+
     def __init__(self, position, name, url):
         """
         @param position: Integer position of the subsection in the subsection
@@ -109,15 +163,17 @@ class SubSection(object):
         """
         self.position = position
         self.name = name
-        self.url = url
+        self.url = intern_url(url)
 
     def __repr__(self):
         return self.name + ": " + self.url
 
-class Unit(object):
+class Unit(_Compact):
     """
     Representation of a single unit of the course.
     """
+    __slots__ = ('videos', 'resources_urls')
+
     def __init__(self, videos, resources_urls):
         """
         @param videos: List of videos present in the unit.
@@ -128,14 +184,17 @@ class Unit(object):
             and youtube links.
         @type resources_urls: [str]
         """
-        self.videos = videos
-        self.resources_urls = resources_urls
+        self.videos = tuple(videos)
+        self.resources_urls = _intern_urls(resources_urls)
 
 
-class Video(object):
+class Video(_Compact):
     """
     Representation of a single video.
     """
+    __slots__ = ('video_youtube_url', 'available_subs_url', 'sub_template_url',
+                 'mp4_urls')
+
     def __init__(self, video_youtube_url, available_subs_url,
                  sub_template_url, mp4_urls):
         """
@@ -151,10 +210,53 @@ class Video(object):
         @param mp4_urls: List of URLs to mp4 video files.
         @type mp4_urls: [str]
         """
-        self.video_youtube_url = video_youtube_url
-        self.available_subs_url = available_subs_url
-        self.sub_template_url = sub_template_url
-        self.mp4_urls = mp4_urls
+        self.video_youtube_url = intern_url(video_youtube_url)
+        self.available_subs_url = intern_url(available_subs_url)
+        self.sub_template_url = intern_url(sub_template_url)
+        self.mp4_urls = _intern_urls(mp4_urls)
+
+
+class PlannedDownload(_Compact):
+    """
+    Representation of a download planned for the selected sections.
+    """
+    __slots__ = ('url', 'target_dir', 'filename', 'kind', 'key')
+
+    VIDEO = 'video'
+    SUBTITLE = 'subtitle'
+    RESOURCE = 'resource'
+
+    def __init__(self, url, target_dir, filename, kind, key=None):
+        """
+        @param url: URL to download.
+        @type url: str
+
+        @param target_dir: Directory where the file is stored.
+        @type target_dir: str
+
+        @param filename: Name of the file inside target_dir. For youtube
+            videos it is a youtube-dl output template.
+        @type filename: str
+
+        @param kind: One of PlannedDownload.VIDEO, SUBTITLE or RESOURCE.
+        @type kind: str
+
+        @param key: Key used to assign the download to a shard, the
+            downloads of a video and its subtitles share it. Default: url.
+        @type key: str
+        """
+        self.url = intern_url(url)
+        self.target_dir = target_dir
+        self.filename = filename
+        self.kind = kind
+        self.key = intern_url(key or url)
+
+    @property
+    def path(self):
+        return os.path.join(self.target_dir, self.filename)
+
+    def __repr__(self):
+        return self.url + " => " + self.path
 
 
 class ExitCode(object):
@@ -168,10 +270,29 @@ class ExitCode(object):
     INVALID_COURSE_URL = 4
     UNKNOWN_PLATFORM = 5
     NO_DOWNLOADABLE_VIDEO = 6
+    NOT_ENOUGH_SPACE = 7
+    VERIFICATION_FAILED = 8
+
+
+class EdxDlError(Exception):
+    """
+    Raised when a request can't be fulfilled (wrong credentials, unknown
+    course...), exit_code being the ExitCode of the command line tool for it.
+    """
+    def __init__(self, message, exit_code):
+        super(EdxDlError, self).__init__(message)
+        self.exit_code = exit_code
 
 
 YOUTUBE_DL_CMD = ['youtube-dl', '--ignore-config']
 DEFAULT_CACHE_FILENAME = 'edx-dl.cache'
+DEFAULT_FAILURES_FILENAME = 'edx-dl.failures'
+DEFAULT_OUTLINE_FILENAME = 'edx-dl.outline'
+SHARD_MANIFEST_FILENAME = 'edx-dl.shard-%d-of-%d.jsonl'
+# Values of --export-format that write a manifest of the planned downloads
+# instead of formatting each url
+EXPORT_MANIFEST_FORMATS = ['aria2c', 'jsonl']
+DOWNLOAD_ORDERS = ['outline', 'smallest', 'largest']
 DEFAULT_FILE_FORMATS = ['e?ps', 'pdf', 'txt', 'doc', 'xls', 'ppt',
                         'docx', 'xlsx', 'pptx', 'odt', 'ods', 'odp', 'odg',
                         'zip', 'rar', 'gz', 'mp3', 'R', 'Rmd', 'ipynb', 'py']
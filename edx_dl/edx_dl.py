@@ -11,49 +11,91 @@ import getpass
 import json
 import logging
 import os
-import pickle
+import random
 import re
+import socket
+import subprocess
 import sys
+import time
+import zlib
 
 from functools import partial
-from multiprocessing.dummy import Pool as ThreadPool
 
-from six.moves.http_cookiejar import CookieJar
-from six.moves.urllib.error import HTTPError, URLError
+from six.moves.urllib.error import HTTPError
 from six.moves.urllib.parse import urlencode
-from six.moves.urllib.request import (
-    urlopen,
-    build_opener,
-    install_opener,
-    HTTPCookieProcessor,
-    Request,
-    urlretrieve,
-)
 
 from ._version import __version__
 
+
 from .common import (
     YOUTUBE_DL_CMD,
     DEFAULT_CACHE_FILENAME,
+    DEFAULT_FAILURES_FILENAME,
+    DEFAULT_OUTLINE_FILENAME,
+    SHARD_MANIFEST_FILENAME,
+    Section,
+    SubSection,
     Unit,
     Video,
     ExitCode,
+    EdxDlError,
     DEFAULT_FILE_FORMATS,
+    DOWNLOAD_ORDERS,
+    EXPORT_MANIFEST_FORMATS,
+    intern_url,
+    PlannedDownload,
 )
 from .parsing import (
     edx_json2srt,
     get_page_extractor,
+    BlocksApiExtractor,
     is_youtube_url,
+    rendition_height,
 )
 from .utils import (
+    AdaptiveLimiter,
+    BandwidthLimiter,
+    ConditionalCache,
     clean_filename,
     directory_name,
+    download_file,
     execute_command,
+    get_bandwidth_limiter,
+    get_content_length,
+    get_directory_cache,
     get_filename_from_prefix,
+    get_free_space,
+    get_throughput_tracker,
+    get_timeouts,
     get_page_contents,
     get_page_contents_as_json,
+    get_retry_policy,
+    get_session,
+    iter_page_contents,
     mkdir_p,
-    remove_duplicates,
+    open_url,
+    parse_rate,
+    parse_rate_schedule,
+    probe_throughput,
+    RETRYABLE_EXCEPTIONS,
+    RetryPolicy,
+    Session,
+    set_archive,
+    set_bandwidth_limiter,
+    set_conditional_cache,
+    set_default_session,
+    set_limiter,
+    set_retry_policy,
+    set_timeouts,
+    set_watchdog,
+    thread_pool,
+    transfer_stats,
+    url_host,
+    use_session,
+    DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_READ_TIMEOUT,
+    DEFAULT_STALL_TIMEOUT,
+    Watchdog,
 )
 
 
@@ -95,33 +137,68 @@ OPENEDX_SITES = {
         'courseware-selector': ('nav', {'aria-label': 'Course Navigation'}),
     }
 }
-BASE_URL = OPENEDX_SITES['edx']['url']
-EDX_HOMEPAGE = BASE_URL + '/login_ajax'
-LOGIN_API = BASE_URL + '/login_ajax'
-DASHBOARD = BASE_URL + '/dashboard'
-COURSEWARE_SEL = OPENEDX_SITES['edx']['courseware-selector']
+USER_API = '/api/user/v1/me'
+
+
+class OpenEdxSite(Session):
+    """
+    An Open edX site of OPENEDX_SITES and the session (cookies, limiter) of
+    the requests to it.
+
+    The fetches, extractions and downloads of a thread go to its current
+    site (see use_site), and the pools of threads they start inherit it, so
+    several sites can be downloaded at the same time from different
+    threads of one process.
+    """
+    def __init__(self, name, limiter=None):
+        """
+        @param name: Key of the site in OPENEDX_SITES.
+        @type name: str
+
+        @param limiter: Limiter of the concurrent requests to the site, by
+            default the one shared by all the sites.
+        @type limiter: AdaptiveLimiter
+        """
+        sites = sorted(OPENEDX_SITES.keys())
+        if name not in sites:
+            raise EdxDlError("OpenEdX platform should be one of: %s" %
+                             ', '.join(sites), ExitCode.UNKNOWN_PLATFORM)
+        super(OpenEdxSite, self).__init__(limiter)
+        self.name = name
+        self.base_url = OPENEDX_SITES[name]['url']
+        self.homepage = self.base_url + '/login_ajax'
+        self.login_api = self.base_url + '/login_ajax'
+        self.dashboard = self.base_url + '/dashboard'
+        self.courseware_selector = OPENEDX_SITES[name]['courseware-selector']
+
+    def __repr__(self):
+        return 'OpenEdxSite(%r)' % self.name
+
+
+def get_site():
+    """
+    Returns the OpenEdxSite of the current thread.
+    """
+    return get_session()
+
+
+def use_site(site):
+    """
+    Context manager making site the OpenEdxSite of the current thread while
+    the block runs.
+    """
+    return use_session(site)
 
 
 def change_openedx_site(site_name):
     """
-    Changes the openedx website for the given one via the key
+    Changes the openedx website of the threads without a site of their own
+    for the given one via the key
     """
-    global BASE_URL
-    global EDX_HOMEPAGE
-    global LOGIN_API
-    global DASHBOARD
-    global COURSEWARE_SEL
+    set_default_session(OpenEdxSite(site_name))
 
-    sites = sorted(OPENEDX_SITES.keys())
-    if site_name not in sites:
-        logging.error("OpenEdX platform should be one of: %s", ', '.join(sites))
-        sys.exit(ExitCode.UNKNOWN_PLATFORM)
 
-    BASE_URL = OPENEDX_SITES[site_name]['url']
-    EDX_HOMEPAGE = BASE_URL + '/login_ajax'
-    LOGIN_API = BASE_URL + '/login_ajax'
-    DASHBOARD = BASE_URL + '/dashboard'
-    COURSEWARE_SEL = OPENEDX_SITES[site_name]['courseware-selector']
+change_openedx_site('edx')
 
 
 def _display_courses(courses):
@@ -141,9 +218,10 @@ def get_courses_info(url, headers):
     """
     logging.info('Extracting course information from dashboard.')
 
-    page = get_page_contents(url, headers)
+    page = get_page_contents(url, headers, conditional=True)
     page_extractor = get_page_extractor(url)
-    courses = page_extractor.extract_courses_from_html(page, BASE_URL)
+    courses = page_extractor.extract_courses_from_html(page,
+                                                       get_site().base_url)
 
     logging.debug('Data extracted: %s', courses)
 
@@ -161,12 +239,10 @@ def _get_initial_token(url):
     """
     logging.info('Getting initial CSRF token.')
 
-    cookiejar = CookieJar()
-    opener = build_opener(HTTPCookieProcessor(cookiejar))
-    install_opener(opener)
-    opener.open(url)
+    site = get_site()
+    site.open(url, timeout=get_timeouts()[0]).close()
 
-    for cookie in cookiejar:
+    for cookie in site.cookiejar:
         if cookie.name == 'csrftoken':
             logging.info('Found CSRF token.')
             return cookie.value
@@ -181,9 +257,10 @@ def get_available_sections(url, headers):
     """
     logging.debug("Extracting sections for :" + url)
 
-    page = get_page_contents(url, headers)
+    page = get_page_contents(url, headers, conditional=True)
     page_extractor = get_page_extractor(url)
-    sections = page_extractor.extract_sections_from_html(page, BASE_URL)
+    sections = page_extractor.extract_sections_from_html(page,
+                                                         get_site().base_url)
 
     logging.debug("Extracted sections: " + str(sections))
     return sections
@@ -197,19 +274,30 @@ def edx_get_subtitle(url, headers,
     subtitles are available.
     """
     try:
-        if ';' in url:  # non-JSON format (e.g. Stanford)
-            return get_page_contents(url, headers)
-        else:
-            json_object = get_page_contents_as_json(url, headers)
-            return edx_json2srt(json_object)
-    except URLError as exception:
+        return _fetch_subtitle(url, headers, get_page_contents,
+                               get_page_contents_as_json)
+    except RETRYABLE_EXCEPTIONS as exception:
         logging.warn('edX subtitles (error: %s)', exception)
         return None
     except ValueError as exception:
-        logging.warn('edX subtitles (error: %s)', exception.message)
+        logging.warn('edX subtitles (error: %s)', exception)
         return None
 
 
+def _fetch_subtitle(url, headers,
+                    get_page_contents=get_page_contents,
+                    get_page_contents_as_json=get_page_contents_as_json):
+    """
+    Return a string with the subtitles content from the url, raising the
+    errors found while fetching it.
+    """
+    if ';' in url:  # non-JSON format (e.g. Stanford)
+        return get_page_contents(url, headers)
+    else:
+        json_object = get_page_contents_as_json(url, headers)
+        return edx_json2srt(json_object)
+
+
 def edx_login(url, headers, username, password):
     """
     Log in user into the openedx website.
@@ -220,13 +308,29 @@ def edx_login(url, headers, username, password):
                            'password': password,
                            'remember': False}).encode('utf-8')
 
+    from six.moves.urllib.request import Request
     request = Request(url, post_data, headers)
-    response = urlopen(request)
-    resp = json.loads(response.read().decode('utf-8'))
+    response = open_url(request)
+    try:
+        resp = json.loads(response.read().decode('utf-8'))
+    finally:
+        response.close()
 
     return resp
 
 
+def parse_cdn_quality(value):
+    """
+    Parses the value of --cdn-quality: best, smallest, all or a height.
+    """
+    if value in ('best', 'smallest', 'all'):
+        return value
+    try:
+        return int(value.rstrip('p'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid quality: %s' % value)
+
+
 def parse_args():
     """
     Parse the arguments/options passed to the program on the command line.
@@ -322,6 +426,23 @@ def parse_args():
                         default=False,
                         help='prefer CDN video downloads over youtube (BETA)')
 
+    parser.add_argument('--auto-video-source',
+                        dest='auto_video_source',
+                        action='store_true',
+                        default=False,
+                        help='download each video from the fastest of its '
+                        'sources (youtube and the CDN hosts) measured during '
+                        'the run, trying the next one on errors')
+
+    parser.add_argument('--cdn-quality',
+                        dest='cdn_quality',
+                        type=parse_cdn_quality,
+                        default='best',
+                        help='CDN video rendition to download when there '
+                        'are several: best, smallest, the highest one not '
+                        'taller than the given height (e.g. 720), or all. '
+                        'Default: best')
+
     parser.add_argument('--export-filename',
                         dest='export_filename',
                         default=None,
@@ -335,7 +456,10 @@ def parse_args():
                         default='%(url)s',
                         help='export format string. Old-style python formatting '
                         'is used. Available variables: %%(url)s. Default: '
-                        '"%%(url)s"')
+                        '"%%(url)s". Use "aria2c" (aria2c input file) or '
+                        '"jsonl" (JSON Lines) to export every planned '
+                        'download with its target directory, filename and '
+                        'kind instead')
 
     parser.add_argument('--list-file-formats',
                         dest='list_file_formats',
@@ -363,6 +487,105 @@ def parse_args():
                         default=False,
                         help='create and use a cache of extracted resources')
 
+    parser.add_argument('--sync',
+                        dest='sync',
+                        action='store_true',
+                        default=False,
+                        help='only extract and download the subsections that '
+                        'are new or changed since the last run with --sync '
+                        '(uses the cache of extracted resources for the rest '
+                        'of their sections)')
+
+    parser.add_argument('--outline-file',
+                        dest='outline_file',
+                        default=DEFAULT_OUTLINE_FILENAME,
+                        help='file where --sync keeps the outline of the '
+                        'courses. Default: "%s"' % DEFAULT_OUTLINE_FILENAME)
+
+    parser.add_argument('--watch',
+                        dest='watch',
+                        type=float,
+                        metavar='INTERVAL',
+                        default=None,
+                        help='keep running, checking the courses for new '
+                        'content about every INTERVAL seconds and '
+                        'downloading it (implies --sync)')
+
+    parser.add_argument('--shard',
+                        dest='shard',
+                        type=parse_shard,
+                        metavar='K/N',
+                        default=None,
+                        help='only download the K-th of N parts of the '
+                        'videos and resources (split by a stable hash of '
+                        'their url, so N machines can share a run), writing '
+                        'the manifest of the part in the output directory')
+
+    parser.add_argument('--merge-shards',
+                        dest='merge_shards',
+                        nargs='+',
+                        metavar='MANIFEST',
+                        default=None,
+                        help='check that the manifests written with --shard '
+                        'cover the whole run with nothing missing or '
+                        'repeated, write them merged to --export-filename '
+                        '(default: standard output) and exit')
+
+    parser.add_argument('--plan-queue',
+                        dest='plan_queue',
+                        metavar='QUEUE',
+                        default=None,
+                        help='add the planned downloads to the QUEUE file '
+                        'shared with --work-queue processes instead of '
+                        'downloading them')
+
+    parser.add_argument('--work-queue',
+                        dest='work_queue',
+                        metavar='QUEUE',
+                        default=None,
+                        help='download the items of the QUEUE file written by '
+                        '--plan-queue until none is left, together with any '
+                        'number of other worker processes')
+
+    parser.add_argument('--lease-timeout',
+                        dest='lease_timeout',
+                        type=float,
+                        default=600,
+                        help='seconds after which the download of a worker '
+                        'that stopped answering is given to another worker. '
+                        'Default: 600')
+
+    parser.add_argument('--blocks-api',
+                        dest='blocks_api',
+                        action='store_true',
+                        default=False,
+                        help='get the outline and the videos of the courses '
+                        'from the Open edX Course Blocks API instead of '
+                        'scraping every subsection page, using the pages '
+                        'where the API is not available (BETA)')
+
+    parser.add_argument('--profile',
+                        dest='profile',
+                        metavar='FILE',
+                        default=None,
+                        help='profile the run, including its threads, and '
+                        'save the profile in FILE in pstats format (read '
+                        'it with python -m pstats FILE). The pages are '
+                        'parsed in threads unless --parse-processes is '
+                        'given')
+
+    parser.add_argument('--trace-malloc',
+                        dest='trace_malloc',
+                        metavar='N',
+                        type=int,
+                        nargs='?',
+                        const=10,
+                        default=None,
+                        help='trace the memory allocations and report the '
+                        'N (default 10) lines allocating the most after '
+                        'each phase of the run (outline, extraction, dedup '
+                        'and download)')
+
     parser.add_argument('--dry-run',
                         dest='dry_run',
                         action='store_true',
@@ -375,6 +598,135 @@ def parse_args():
                         default=False,
                         help='extracts the resources from the pages sequentially')
 
+    parser.add_argument('--max-concurrency',
+                        dest='max_concurrency',
+                        type=int,
+                        default=16,
+                        help='maximum number of simultaneous requests; the '
+                        'actual number adapts to the server responses, '
+                        'backing off when it answers 429/5xx. Default: 16')
+
+    parser.add_argument('--retries',
+                        dest='retries',
+                        type=int,
+                        default=3,
+                        help='number of times a request is retried on '
+                        'transient errors, with exponential backoff. '
+                        'Default: 3')
+
+    parser.add_argument('--connect-timeout',
+                        dest='connect_timeout',
+                        type=float,
+                        default=DEFAULT_CONNECT_TIMEOUT,
+                        help='seconds to wait for a connection to be '
+                        'established. Default: %d' % DEFAULT_CONNECT_TIMEOUT)
+
+    parser.add_argument('--read-timeout',
+                        dest='read_timeout',
+                        type=float,
+                        default=DEFAULT_READ_TIMEOUT,
+                        help='seconds to wait for each read of a response. '
+                        'Default: %d' % DEFAULT_READ_TIMEOUT)
+
+    parser.add_argument('--stall-timeout',
+                        dest='stall_timeout',
+                        type=float,
+                        default=DEFAULT_STALL_TIMEOUT,
+                        help='cancel (and retry) transfers that received no '
+                        'data for this number of seconds, 0 disables it. '
+                        'Default: %d' % DEFAULT_STALL_TIMEOUT)
+
+    parser.add_argument('--failures-file',
+                        dest='failures_file',
+                        action='store',
+                        default=DEFAULT_FAILURES_FILENAME,
+                        help='file where the downloads that still failed '
+                        'after the final retry pass are written. '
+                        'Default: "%s"' % DEFAULT_FAILURES_FILENAME)
+
+    parser.add_argument('--retry-failures',
+                        dest='retry_failures',
+                        action='store',
+                        default=None,
+                        help='only download the items listed in the given '
+                        'failures file (written by a previous run)')
+
+    archive_group = parser.add_mutually_exclusive_group()
+    archive_group.add_argument('--record',
+                               dest='record',
+                               action='store',
+                               default=None,
+                               metavar='DIR',
+                               help='store every fetched page (compressed) '
+                               'in the archive directory DIR')
+
+    archive_group.add_argument('--replay',
+                               dest='replay',
+                               action='store',
+                               default=None,
+                               metavar='DIR',
+                               help='serve the pages from the archive '
+                               'directory DIR written with --record, '
+                               'without logging in nor fetching them. Use '
+                               'it with --dry-run or --export-filename to '
+                               're-run the extraction offline')
+
+    parser.add_argument('--parse-processes',
+                        dest='parse_processes',
+                        type=int,
+                        default=None,
+                        help='number of processes parsing the pages fetched '
+                        'in parallel, 0 parses them in the fetching threads. '
+                        'Default: the number of CPUs')
+
+    parser.add_argument('--limit-rate',
+                        dest='limit_rate',
+                        type=parse_rate,
+                        default=None,
+                        help='maximum bandwidth (bytes per second, with an '
+                        'optional K, M or G suffix) shared by all the '
+                        'transfers, also passed to youtube-dl. '
+                        'Default: no limit')
+
+    parser.add_argument('--limit-rate-schedule',
+                        dest='limit_rate_schedule',
+                        type=parse_rate_schedule,
+                        default=[],
+                        help='comma separated HH:MM-HH:MM=RATE windows of '
+                        'the day using a different rate than --limit-rate, '
+                        '0 meaning no limit (e.g. "22:00-06:00=0" for full '
+                        'speed at night)')
+
+    parser.add_argument('--prefetch-sizes',
+                        dest='prefetch_sizes',
+                        action='store_true',
+                        default=False,
+                        help='ask the size of every CDN video and resource '
+                        'before downloading, report the total per section '
+                        'and stop if there is not enough free space in the '
+                        'output directory')
+
+    parser.add_argument('--download-order',
+                        dest='download_order',
+                        choices=DOWNLOAD_ORDERS,
+                        default='outline',
+                        help='order of the downloads: as in the course '
+                        'outline, or the CDN videos and resources by size '
+                        '(smallest or largest first, implies '
+                        '--prefetch-sizes). Default: outline')
+
+    parser.add_argument('--verify',
+                        dest='verify',
+                        nargs='?',
+                        const='quick',
+                        choices=['quick', 'full'],
+                        default=None,
+                        help='verify the files downloaded in the output '
+                        'directory against their recorded checksums and '
+                        'exit: "quick" (the default) only rehashes the files '
+                        'whose modification time changed, "full" rehashes '
+                        'all of them in parallel processes')
+
     parser.add_argument('--quiet',
                         dest='quiet',
                         action='store_true',
@@ -420,9 +772,9 @@ def edx_get_headers():
         'User-Agent': 'edX-downloader/0.01',
         'Accept': 'application/json, text/javascript, */*; q=0.01',
         'Content-Type': 'application/x-www-form-urlencoded;charset=utf-8',
-        'Referer': EDX_HOMEPAGE,
+        'Referer': get_site().homepage,
         'X-Requested-With': 'XMLHttpRequest',
-        'X-CSRFToken': _get_initial_token(EDX_HOMEPAGE),
+        'X-CSRFToken': _get_initial_token(get_site().homepage),
     }
 
     logging.debug('Headers built: %s', headers)
@@ -435,9 +787,13 @@ def extract_units(url, headers, file_formats):
     """
     logging.info("Processing '%s'", url)
 
-    page = get_page_contents(url, headers)
+    # the page is streamed, so if the connection fails in the middle of it
+    # the whole page is processed again
     page_extractor = get_page_extractor(url)
-    units = page_extractor.extract_units_from_html(page, BASE_URL, file_formats)
+    base_url = get_site().base_url
+    units = get_retry_policy().call(
+        lambda: page_extractor.extract_units_from_stream(
+            iter_page_contents(url, headers), base_url, file_formats))
 
     return units
 
@@ -465,7 +821,9 @@ def extract_all_units_in_parallel(urls, headers, file_formats):
     logging.debug('urls: ' + str(urls))
 
     mapfunc = partial(extract_units, file_formats=file_formats, headers=headers)
-    pool = ThreadPool(16)
+    # the pool may have more threads than requests allowed at a given time,
+    # the limiter of the site is what really bounds the concurrency
+    pool = thread_pool()
     units = pool.map(mapfunc, urls)
     pool.close()
     pool.join()
@@ -474,6 +832,87 @@ def extract_all_units_in_parallel(urls, headers, file_formats):
     return all_units
 
 
+def _fetch_page(url, headers):
+    """
+    Returns the (url, page) tuple of the given url.
+    """
+    logging.info("Processing '%s'", url)
+    return url, get_page_contents(url, headers)
+
+
+def _parse_units(url, page, base_url, file_formats):
+    """
+    Extracts the units of the page of the given url. It runs in the worker
+    processes of extract_all_units_with_processes.
+    """
+    page_extractor = get_page_extractor(url)
+    return page_extractor.extract_units_from_html(page, base_url,
+                                                  file_formats)
+
+
+def iter_all_units(urls, headers, file_formats):
+    """
+    Returns a generator of (url, units) for the urls, extracted in parallel
+    in the site of the caller and yielded as soon as each one is extracted
+    (not in the order of urls).
+    """
+    mapfunc = partial(_extract_units_of_url, file_formats=file_formats,
+                      headers=headers)
+    # the pool is started here, in the site of the caller, not when the
+    # generator is first consumed
+    pool = thread_pool()
+    return _iter_pool_results(pool, pool.imap_unordered(mapfunc, urls))
+
+
+def _iter_pool_results(pool, results):
+    try:
+        for result in results:
+            yield result
+    finally:
+        # the consumer may stop early, don't extract the rest
+        pool.terminate()
+        pool.join()
+
+
+def _extract_units_of_url(url, headers, file_formats):
+    return url, extract_units(url, headers, file_formats)
+
+
+def extract_all_units_with_processes(urls, headers, file_formats,
+                                     processes=None):
+    """
+    Returns a dict of all the units in the selected_sections: {url, units}
+    in parallel, fetching the pages in a pool of threads and parsing them in
+    a pool of processes (one per CPU by default), so that the parsing is not
+    serialized by the GIL.
+    """
+    logging.info('Extracting all units information in parallel '
+                 '(parsing with processes).')
+    logging.debug('urls: ' + str(urls))
+
+    import multiprocessing
+
+    parse_pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+    fetch_pool = thread_pool()
+    try:
+        # each page is handed to the parsing processes as soon as it is
+        # fetched, so fetching and parsing overlap
+        base_url = get_site().base_url
+        results = [(url, parse_pool.apply_async(_parse_units,
+                                                (url, page, base_url,
+                                                 file_formats)))
+                   for url, page in fetch_pool.imap_unordered(
+                       partial(_fetch_page, headers=headers), urls)]
+        all_units = dict((url, result.get()) for url, result in results)
+    finally:
+        fetch_pool.close()
+        parse_pool.close()
+        fetch_pool.join()
+        parse_pool.join()
+
+    return all_units
+
+
 def _display_sections_menu(course, sections):
     """
     List the weeks for the given course.
@@ -533,17 +972,25 @@ def parse_courses(args, available_courses):
         _display_courses(available_courses)
         exit(ExitCode.OK)
 
-    if len(args.course_urls) == 0:
-        logging.error('You must pass the URL of at least one course, check the correct url with --list-courses')
-        exit(ExitCode.MISSING_COURSE_URL)
+    return filter_courses(available_courses, args.course_urls)
+
+
+def filter_courses(available_courses, course_urls):
+    """
+    Returns the courses of available_courses whose url is in course_urls,
+    raising EdxDlError if there is none.
+    """
+    if len(course_urls) == 0:
+        raise EdxDlError('You must pass the URL of at least one course, check the correct url with --list-courses',
+                         ExitCode.MISSING_COURSE_URL)
 
     selected_courses = [available_course
                         for available_course in available_courses
-                        for url in args.course_urls
+                        for url in course_urls
                         if available_course.url == url]
     if len(selected_courses) == 0:
-        logging.error('You have not passed a valid course url, check the correct url with --list-courses')
-        exit(ExitCode.INVALID_COURSE_URL)
+        raise EdxDlError('You have not passed a valid course url, check the correct url with --list-courses',
+                         ExitCode.INVALID_COURSE_URL)
     return selected_courses
 
 
@@ -570,23 +1017,30 @@ def parse_file_formats(args):
     """
     parse options for file formats and builds the array to be used
     """
-    file_formats = DEFAULT_FILE_FORMATS
-
     if args.list_file_formats:
-        logging.info(file_formats)
+        logging.info(DEFAULT_FILE_FORMATS)
         exit(ExitCode.OK)
 
-    if args.overwrite_file_formats:
-        file_formats = []
-
+    new_file_formats = []
     if args.file_formats:
         new_file_formats = args.file_formats.split(",")
-        file_formats.extend(new_file_formats)
 
+    file_formats = get_file_formats(new_file_formats,
+                                    args.overwrite_file_formats)
     logging.debug("file_formats: %s", file_formats)
     return file_formats
 
 
+def get_file_formats(new_file_formats=(), overwrite=False):
+    """
+    Returns the file formats of the resources to download: the default ones
+    (unless overwrite) and new_file_formats.
+    """
+    file_formats = [] if overwrite else list(DEFAULT_FILE_FORMATS)
+    file_formats.extend(new_file_formats)
+    return file_formats
+
+
 def _display_selections(selections):
     """
     Displays the course, sections and subsections to be downloaded
@@ -603,8 +1057,8 @@ def parse_units(all_units):
     """
     flat_units = [unit for units in all_units.values() for unit in units]
     if len(flat_units) < 1:
-        logging.warn('No downloadable video found.')
-        exit(ExitCode.NO_DOWNLOADABLE_VIDEO)
+        raise EdxDlError('No downloadable video found.',
+                         ExitCode.NO_DOWNLOADABLE_VIDEO)
 
 
 def get_subtitles_urls(available_subs_url, sub_template_url, headers):
@@ -666,6 +1120,189 @@ def _build_subtitles_downloads(video, target_dir, filename_prefix, headers):
     return downloads
 
 
+def select_rendition(urls, quality):
+    """
+    Returns a list with the url of the CDN video rendition matching quality
+    (see parse_cdn_quality), or all the urls if quality is 'all'.
+
+    The same file on several hosts counts as a single rendition (the first
+    host wins). The renditions are ranked by the height found in their urls
+    or, when it can't be found in all of them, by their size.
+    """
+    if quality == 'all' or len(urls) <= 1:
+        return list(urls)
+
+    renditions = []
+    names = set()
+    for url in urls:
+        name = _url_basename(url)
+        if name not in names:
+            names.add(name)
+            renditions.append(url)
+    if len(renditions) == 1:
+        return renditions
+
+    heights = [rendition_height(url) for url in renditions]
+    if None not in heights:
+        keys = heights
+    else:
+        keys = [_head_size(url) for url in renditions]
+        if None in keys:
+            logging.warn('Could not rank the renditions of %s, downloading '
+                         'the first one', renditions[0])
+            return renditions[:1]
+    ranked = sorted(zip(keys, renditions), key=lambda pair: pair[0])
+
+    if quality == 'smallest':
+        return [ranked[0][1]]
+    if quality == 'best' or None in heights:
+        if quality != 'best':
+            logging.warn('The heights of the renditions of %s are unknown, '
+                         'downloading the biggest one', renditions[0])
+        return [ranked[-1][1]]
+    fitting = [url for height, url in ranked if height <= quality]
+    return [fitting[-1] if fitting else ranked[0][1]]
+
+
+def _url_basename(url):
+    return url.split('?', 1)[0].rsplit('/', 1)[-1]
+
+
+# host of the throughput estimate of youtube-dl downloads
+YOUTUBE_HOST = 'youtube'
+
+
+def _source_host(url):
+    return YOUTUBE_HOST if is_youtube_url(url) else url_host(url)
+
+
+def _youtube_id(url):
+    """
+    Returns the id of the video of a youtube url, or None.
+    """
+    match = re.search(r'(?:[?&]v=|youtu\.?be/|/embed/)([\w-]+)', url)
+    return match.group(1) if match else None
+
+
+def video_sources(video, quality):
+    """
+    Returns the urls a video can be downloaded from: the CDN hosts of the
+    rendition matching quality and then youtube.
+    """
+    sources = []
+    if video.mp4_urls:
+        name = _url_basename(select_rendition(video.mp4_urls, quality)[0])
+        sources = [url for url in video.mp4_urls if _url_basename(url) == name]
+    if video.video_youtube_url is not None:
+        sources.append(video.video_youtube_url)
+    return sources
+
+
+def rank_sources(urls):
+    """
+    Returns the urls sorted by the throughput estimate of their host,
+    fastest first. CDN hosts never measured are probed with a short ranged
+    read; youtube can't be probed, so it keeps its place among the hosts
+    without estimate until a download measures it.
+    """
+    tracker = get_throughput_tracker()
+    for url in urls:
+        host = _source_host(url)
+        if host != YOUTUBE_HOST and tracker.estimate(host) is None:
+            try:
+                probe_throughput(url)
+            except Exception as e:
+                logging.debug('Could not probe %s: %s', url, e)
+                tracker.penalize(host)
+    return sorted(urls,
+                  key=lambda url: -(tracker.estimate(_source_host(url)) or 0))
+
+
+def _youtube_files(target_dir, filename_prefix, url):
+    """
+    Returns the names of the files written by youtube-dl for url, see the
+    template in _build_filename_from_url.
+    """
+    video_id = _youtube_id(url)
+    if video_id is None:
+        return []
+    return [name for name in get_directory_cache().listing(target_dir)
+            if name.startswith(filename_prefix + '-') and
+            ('-%s.' % video_id) in name]
+
+
+def _is_source_downloaded(url, target_dir, filename_prefix):
+    if is_youtube_url(url):
+        return bool(_youtube_files(target_dir, filename_prefix, url))
+    filename = _build_filename_from_url(url, target_dir, filename_prefix)
+    return get_directory_cache().exists(filename)
+
+
+def _download_source(url, target_dir, filename_prefix, args):
+    """
+    Downloads the video from url (youtube or CDN), recording the
+    throughput of its host. Raises the errors found.
+    """
+    filename = _build_filename_from_url(url, target_dir, filename_prefix)
+    logging.info('[download] %s => %s', url, filename)
+    directory_cache = get_directory_cache()
+    if not is_youtube_url(url):
+        from .checksums import new_hash, record_checksum
+        sha256 = download_file(url, filename, new_hash=new_hash)
+        record_checksum(filename, sha256)
+        directory_cache.add(filename)
+        return
+
+    tracker = get_throughput_tracker()
+    start = time.time()
+    try:
+        subprocess.check_call(_youtube_dl_command(url, filename, args))
+    except Exception:
+        tracker.penalize(YOUTUBE_HOST)
+        raise
+    finally:
+        directory_cache.forget(target_dir)
+    nbytes = sum(directory_cache.size(os.path.join(target_dir, name))
+                 for name in _youtube_files(target_dir, filename_prefix, url))
+    tracker.record(YOUTUBE_HOST, nbytes, time.time() - start)
+
+
+def download_fastest_source(video, args, target_dir, filename_prefix,
+                            headers):
+    """
+    Downloads the video from the fastest of its sources, failing over to
+    the next one on errors.
+    """
+    sources = video_sources(video, args.cdn_quality)
+    for url in sources:
+        if _is_source_downloaded(url, target_dir, filename_prefix):
+            logging.info('[skipping] %s => %s', url, target_dir)
+            return
+    if not sources:
+        return
+    if args.dry_run:
+        logging.info('[download] %s => %s', sources[0], target_dir)
+        return
+
+    error = None
+    ranked = rank_sources(sources)
+    for url in ranked:
+        try:
+            _download_source(url, target_dir, filename_prefix, args)
+            return
+        except Exception as e:
+            logging.warn('Download from %s failed (%s)', url, e)
+            error = e
+
+    if not args.ignore_errors:
+        raise error
+    logging.warn('Error ignored, no source of the video worked: %s', error)
+    if isinstance(error, subprocess.CalledProcessError) or \
+            get_retry_policy().is_retryable(error):
+        _defer_download(ranked[0], _build_filename_from_url(
+            ranked[0], target_dir, filename_prefix), 'url')
+
+
 def _build_url_downloads(urls, target_dir, filename_prefix):
     """
     Builds a dict {url: filename} for the given urls
@@ -714,8 +1351,10 @@ def download_url(url, filename, headers, args):
         # Note: The mess with various exceptions being caught (and their
         # order) is due to different behaviors in different Python versions
         # (e.g., 2.7 vs. 3.4).
+        from .checksums import new_hash, record_checksum
         try:
-            urlretrieve(url, filename)
+            sha256 = download_file(url, filename, new_hash=new_hash)
+            record_checksum(filename, sha256)
         except Exception as e:
             logging.warn('Got SSL/Connection error: %s', e)
             if not args.ignore_errors:
@@ -724,6 +1363,8 @@ def download_url(url, filename, headers, args):
                 raise e
             else:
                 logging.warn('SSL/Connection error ignored: %s', e)
+                if get_retry_policy().is_retryable(e):
+                    _defer_download(url, filename, 'url')
 
 
 def download_youtube_url(url, filename, headers, args):
@@ -731,26 +1372,208 @@ def download_youtube_url(url, filename, headers, args):
     Downloads a youtube URL and applies the filters from args
     """
     logging.info('Downloading video with URL %s from YouTube.', url)
+    cmd = _youtube_dl_command(url, filename, args)
+
+    if not execute_command(cmd, args):
+        _defer_download(url, filename, 'url')
+
+
+def _youtube_dl_command(url, filename, args):
+    """
+    Returns the youtube-dl command line downloading url into filename.
+    """
     video_format_option = args.format + '/mp4' if args.format else 'mp4'
     cmd = YOUTUBE_DL_CMD + ['-o', filename, '-f', video_format_option]
 
     if args.subtitles:
         cmd.append('--all-subs')
+    cmd.extend(['--socket-timeout', '%g' % get_timeouts()[1]])
+    # youtube-dl runs while no other transfer is going on, so it gets the
+    # whole budget in force when it starts
+    rate = get_bandwidth_limiter().current_rate()
+    if rate is not None:
+        cmd.extend(['--limit-rate', '%d' % rate])
     cmd.extend(args.youtube_dl_options.split())
     cmd.append(url)
-
-    execute_command(cmd, args)
+    return cmd
 
 
 def download_subtitle(url, filename, headers, args):
     """
     Downloads the subtitle from the url and transforms it to the srt format
     """
-    subs_string = edx_get_subtitle(url, headers)
+    try:
+        subs_string = _fetch_subtitle(url, headers)
+    except RETRYABLE_EXCEPTIONS as exception:
+        logging.warn('edX subtitles (error: %s)', exception)
+        # permanent errors (e.g. no transcript for a language) are not
+        # worth retrying
+        if get_retry_policy().is_retryable(exception):
+            _defer_download(url, filename, 'subtitle')
+        return
+    except ValueError as exception:
+        logging.warn('edX subtitles (error: %s)', exception)
+        return
+
     if subs_string:
+        from .checksums import new_hash, record_checksum
         full_filename = os.path.join(os.getcwd(), filename)
+        data = subs_string.encode('utf-8')
         with open(full_filename, 'wb+') as f:
-            f.write(subs_string.encode('utf-8'))
+            f.write(data)
+        hash_ = new_hash()
+        hash_.update(data)
+        record_checksum(full_filename, hash_.hexdigest())
+
+
+# Downloads that failed during the run, as (url, filename, kind) tuples, they
+# are retried once more at the end of the run.
+_deferred_downloads = []
+
+
+def _defer_download(url, filename, kind):
+    """
+    Queue a failed download to be retried at the end of the run.
+    """
+    logging.info('[deferred] %s => %s', url, filename)
+    _deferred_downloads.append((url, filename, kind))
+
+
+def _download_function(kind):
+    """
+    Return the download function for the given kind of download.
+    """
+    return download_subtitle if kind == 'subtitle' else download_url
+
+
+def _queue_download(planned):
+    """
+    Returns the (url, filename, kind) download of a PlannedDownload, as
+    done by download_url and download_subtitle.
+    """
+    if planned.kind == PlannedDownload.SUBTITLE:
+        # the subtitles are converted to srt while downloading them
+        filename = os.path.splitext(planned.path)[0] + '.srt'
+        return planned.url, filename, 'subtitle'
+    return planned.url, planned.path, 'url'
+
+
+def plan_queue(planned_downloads, filename):
+    """
+    Adds the planned downloads to the work queue in filename.
+    """
+    from .workqueue import WorkQueue
+    queue = WorkQueue(filename)
+    try:
+        added = queue.add(_queue_download(planned)
+                          for planned in planned_downloads)
+        logging.info('Added %d downloads to the queue [%s]: %s', added,
+                     filename, queue.counts())
+    finally:
+        queue.close()
+
+
+def work_queue(filename, headers, args):
+    """
+    Downloads the items leased from the work queue in filename until there
+    is nothing left to lease. Failed downloads are given back to the queue
+    to be retried by any worker, and written to the failures file once
+    they ran out of attempts.
+    """
+    from .workqueue import WorkQueue
+    queue = WorkQueue(filename, lease_timeout=args.lease_timeout)
+    worker = '%s:%d' % (socket.gethostname(), os.getpid())
+    if args.dry_run:
+        logging.info('Downloads in the queue [%s]: %s', filename,
+                     queue.counts())
+        queue.close()
+        return
+    try:
+        while True:
+            job = queue.lease(worker)
+            if job is None:
+                break
+            target_dir = os.path.dirname(job.filename)
+            if target_dir:
+                _ensure_dir(target_dir)
+            error = None
+            with queue.keep_leased(job, worker):
+                try:
+                    skip_or_download({job.url: job.filename}, headers, args,
+                                     _download_function(job.kind))
+                except Exception as e:
+                    logging.error('Download of %s failed: %s', job.url, e)
+                    error = e
+            # the queue retries the downloads, not this worker
+            failed = error is not None or bool(_deferred_downloads)
+            del _deferred_downloads[:]
+            if failed:
+                queue.fail(job, worker, retry=error is None or
+                           get_retry_policy().is_retryable(error))
+            else:
+                queue.complete(job, worker)
+        logging.info('Nothing left to download in [%s]: %s', filename,
+                     queue.counts())
+        failures = queue.failures()
+    finally:
+        queue.close()
+    if failures and not args.dry_run:
+        write_failures_file(failures, args.failures_file)
+
+
+def retry_deferred_downloads(headers, args):
+    """
+    Retry the downloads that failed during the run and return the ones that
+    failed again as a list of (url, filename, kind) tuples.
+    """
+    deferred = _deferred_downloads[:]
+    del _deferred_downloads[:]
+    if deferred:
+        logging.info('Retrying %d failed downloads', len(deferred))
+
+    for url, filename, kind in deferred:
+        if os.path.exists(filename):
+            continue
+        logging.info('[retry] %s => %s', url, filename)
+        _download_function(kind)(url, filename, headers, args)
+
+    failures = _deferred_downloads[:]
+    del _deferred_downloads[:]
+    return failures
+
+
+def write_failures_file(failures, filename=DEFAULT_FAILURES_FILENAME):
+    """
+    Writes the failed downloads to filename, one JSON object per line, so
+    that they can be downloaded again with --retry-failures.
+    """
+    logging.warn('%d downloads failed, writing them to [%s]', len(failures),
+                 filename)
+    with open(filename, 'w') as f:
+        for url, target, kind in failures:
+            f.write(json.dumps({'url': url, 'filename': target,
+                                'kind': kind}) + '\n')
+
+
+def read_failures_file(filename):
+    """
+    Reads the failed downloads written by write_failures_file.
+    """
+    with open(filename) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return [(r['url'], r['filename'], r['kind']) for r in records]
+
+
+def download_failures(failures, headers, args):
+    """
+    Downloads only the given (url, filename, kind) failures.
+    """
+    for url, filename, kind in failures:
+        target_dir = os.path.dirname(filename)
+        if target_dir:
+            mkdir_p(target_dir)
+        skip_or_download({url: filename}, headers, args,
+                         _download_function(kind))
 
 
 def skip_or_download(downloads, headers, args, f=download_url):
@@ -758,8 +1581,9 @@ def skip_or_download(downloads, headers, args, f=download_url):
     downloads url into filename using download function f,
     if filename exists it skips
     """
+    directory_cache = get_directory_cache()
     for url, filename in downloads.items():
-        if os.path.exists(filename):
+        if directory_cache.exists(filename):
             logging.info('[skipping] %s => %s', url, filename)
             continue
         else:
@@ -767,11 +1591,32 @@ def skip_or_download(downloads, headers, args, f=download_url):
         if args.dry_run:
             continue
         f(url, filename, headers, args)
+        if is_youtube_url(url):
+            # youtube-dl chooses the final name of the files it writes
+            directory_cache.forget(os.path.dirname(filename))
+        else:
+            directory_cache.add(filename)
+
+
+def _ensure_dir(directory):
+    """
+    Creates directory if it isn't in the listing of its parent.
+    """
+    directory_cache = get_directory_cache()
+    if not directory_cache.is_dir(directory):
+        mkdir_p(directory)
+        directory_cache.add(directory)
 
 
 def download_video(video, args, target_dir, filename_prefix, headers):
-    if args.prefer_cdn_videos or video.video_youtube_url is None:
-        mp4_downloads = _build_url_downloads(video.mp4_urls, target_dir,
+    if not in_shard(video_shard_key(video), args.shard):
+        return
+    if args.auto_video_source:
+        download_fastest_source(video, args, target_dir, filename_prefix,
+                                headers)
+    elif args.prefer_cdn_videos or video.video_youtube_url is None:
+        mp4_urls = select_rendition(video.mp4_urls, args.cdn_quality)
+        mp4_downloads = _build_url_downloads(mp4_urls, target_dir,
                                              filename_prefix)
         skip_or_download(mp4_downloads, headers, args)
     else:
@@ -805,7 +1650,9 @@ def download_unit(unit, args, target_dir, filename_prefix, headers):
             new_prefix = filename_prefix + ('-%02d' % i)
             download_video(video, args, target_dir, new_prefix, headers)
 
-    res_downloads = _build_url_downloads(unit.resources_urls, target_dir,
+    resources_urls = [url for url in unit.resources_urls
+                      if in_shard(url, args.shard)]
+    res_downloads = _build_url_downloads(resources_urls, target_dir,
                                          filename_prefix)
     skip_or_download(res_downloads, headers, args)
 
@@ -820,6 +1667,122 @@ def download(args, selections, all_units, headers):
     # notice that we could iterate over all_units, but we prefer to do it over
     # sections/subsections to add correct prefixes and show nicer information.
 
+    for target_dir, prefixed_units in _iter_sections(args, selections,
+                                                     all_units):
+        _ensure_dir(target_dir)
+        for filename_prefix, unit in prefixed_units:
+            download_unit(unit, args, target_dir, filename_prefix, headers)
+
+
+def _is_sizable(planned):
+    """
+    Whether the size of a planned download can be asked to its server,
+    youtube videos and edX subtitles don't announce it.
+    """
+    return (planned.kind != PlannedDownload.SUBTITLE and
+            not is_youtube_url(planned.url))
+
+
+def prefetch_sizes(planned_downloads):
+    """
+    Returns a dict {url: size} of the CDN videos and resources among the
+    planned downloads, asking them concurrently with HEAD requests. The
+    size is None when the server doesn't announce it or the request fails.
+    """
+    urls = list(set(planned.url for planned in planned_downloads
+                    if _is_sizable(planned)))
+
+    pool = thread_pool()
+    try:
+        sizes = pool.map(_head_size, urls)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(urls, sizes))
+
+
+def _head_size(url):
+    """
+    Returns the size announced for url, or None if it is unknown.
+    """
+    try:
+        return get_content_length(url)
+    except Exception as e:
+        logging.debug('Could not get the size of %s: %s', url, e)
+        return None
+
+
+def report_sizes(planned_downloads, sizes):
+    """
+    Logs the size of the pending downloads per section directory and
+    returns the total number of bytes still to download.
+    """
+    section_sizes = {}
+    unknown = 0
+    for planned in planned_downloads:
+        size = sizes.get(planned.url)
+        if size is None:
+            unknown += _is_sizable(planned)
+            continue
+        if get_directory_cache().exists(planned.path):
+            size = 0
+        section_sizes[planned.target_dir] = (
+            section_sizes.get(planned.target_dir, 0) + size)
+
+    for target_dir, size in sorted(section_sizes.items()):
+        logging.info('%s: %.1f MiB to download', target_dir,
+                     size / 1024.0 / 1024.0)
+    total = sum(section_sizes.values())
+    logging.info('Total: %.1f MiB to download', total / 1024.0 / 1024.0)
+    if unknown:
+        logging.warn('The size of %d downloads is unknown', unknown)
+    return total
+
+
+def has_free_space(output_dir, needed):
+    """
+    Checks that the filesystem of output_dir has at least needed bytes free.
+    """
+    free = get_free_space(output_dir)
+    if free is None or free >= needed:
+        return True
+    logging.error('Not enough free space in [%s]: %.1f MiB needed, '
+                  '%.1f MiB available', output_dir, needed / 1024.0 / 1024.0,
+                  free / 1024.0 / 1024.0)
+    return False
+
+
+def sort_by_size(planned_downloads, sizes, order):
+    """
+    Returns the CDN videos and resources of planned_downloads sorted by
+    their size, smallest or largest first, the ones of unknown size last.
+    """
+    sizable = [planned for planned in planned_downloads
+               if _is_sizable(planned) and planned.url in sizes]
+    known = [planned for planned in sizable
+             if sizes[planned.url] is not None]
+    unknown = [planned for planned in sizable if sizes[planned.url] is None]
+    known.sort(key=lambda planned: sizes[planned.url],
+               reverse=(order == 'largest'))
+    return known + unknown
+
+
+def download_in_order(planned_downloads, headers, args):
+    """
+    Downloads the given CDN videos and resources in the given order. The
+    rest (youtube videos and subtitles) is left to download(), which skips
+    the files downloaded here.
+    """
+    for planned in planned_downloads:
+        _ensure_dir(planned.target_dir)
+        skip_or_download({planned.url: planned.path}, headers, args)
+
+
+def _iter_sections(args, selections, all_units):
+    """
+    Generator of (target_dir, [(filename_prefix, unit)]) for every selected
+    section, the units are numbered by their position in the section.
+    """
     for selected_course, selected_sections in selections.items():
         coursename = directory_name(selected_course.name)
         for selected_section in selected_sections:
@@ -827,15 +1790,258 @@ def download(args, selections, all_units, headers):
                                            selected_section.name)
             target_dir = os.path.join(args.output_dir, coursename,
                                       clean_filename(section_dirname))
-            mkdir_p(target_dir)
-            counter = 0
-            for subsection in selected_section.subsections:
-                units = all_units.get(subsection.url, [])
-                for unit in units:
-                    counter += 1
-                    filename_prefix = "%02d" % counter
-                    download_unit(unit, args, target_dir, filename_prefix,
-                                  headers)
+            units = [unit
+                     for subsection in selected_section.subsections
+                     for unit in all_units.get(subsection.url, [])]
+            yield target_dir, [("%02d" % counter, unit)
+                               for counter, unit in enumerate(units, 1)]
+
+
+def iter_planned_downloads(args, selections, all_units, headers):
+    """
+    Generator of the PlannedDownload that download() would perform (it
+    does not check which files already exist).
+
+    The filenames of the subtitles are based on the video filename for
+    CDN videos and on the filename prefix for youtube videos (whose title
+    is only known by youtube-dl). Transcripts other than the Stanford ones
+    are served as edX JSON, so they keep the .json extension.
+    """
+    for target_dir, prefixed_units in _iter_sections(args, selections,
+                                                     all_units):
+        for filename_prefix, unit in prefixed_units:
+            for planned in _iter_unit_downloads(unit, args, target_dir,
+                                                filename_prefix, headers):
+                yield planned
+
+
+def _iter_unit_downloads(unit, args, target_dir, filename_prefix, headers):
+    """
+    Generator of the PlannedDownload of a unit, see download_unit.
+    """
+    for i, video in enumerate(unit.videos, 1):
+        prefix = filename_prefix
+        if len(unit.videos) > 1:
+            prefix = filename_prefix + ('-%02d' % i)
+        key = video_shard_key(video)
+        if not in_shard(key, args.shard):
+            continue
+
+        if args.prefer_cdn_videos or video.video_youtube_url is None:
+            video_urls = select_rendition(video.mp4_urls, args.cdn_quality)
+        else:
+            video_urls = [video.video_youtube_url]
+        basename = prefix
+        for url in video_urls:
+            filename = _build_filename_from_url(url, '', prefix)
+            if not is_youtube_url(url):
+                basename = os.path.splitext(filename)[0]
+            yield PlannedDownload(url, target_dir, filename,
+                                  PlannedDownload.VIDEO, key)
+
+        if args.subtitles:
+            subtitles_urls = get_subtitles_urls(video.available_subs_url,
+                                                video.sub_template_url,
+                                                headers)
+            for sub_lang, sub_url in sorted(subtitles_urls.items()):
+                extension = '.srt' if ';' in sub_url else '.json'
+                yield PlannedDownload(sub_url, target_dir,
+                                      basename + '.' + sub_lang + extension,
+                                      PlannedDownload.SUBTITLE, key)
+
+    for url in unit.resources_urls:
+        if not in_shard(url, args.shard):
+            continue
+        yield PlannedDownload(url, target_dir,
+                              _build_filename_from_url(url, '',
+                                                       filename_prefix),
+                              PlannedDownload.RESOURCE)
+
+
+def parse_shard(value):
+    """
+    Parses the value of --shard, K/N with 1 <= K <= N, into (K, N).
+    """
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid shard: %s' % value)
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError('invalid shard: %s' % value)
+    return index, count
+
+
+def video_shard_key(video):
+    """
+    Returns the key assigning a video (and its subtitles) to a shard, it
+    doesn't depend on the options choosing its source.
+    """
+    if video.mp4_urls:
+        return video.mp4_urls[0]
+    return video.video_youtube_url
+
+
+def in_shard(key, shard):
+    """
+    Whether the download with the given key belongs to shard, a (K, N)
+    tuple or None for all the downloads. The assignment is a stable hash,
+    so every node computes the same partition.
+    """
+    if shard is None:
+        return True
+    index, count = shard
+    return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % count == index - 1
+
+
+def _iter_shard_keys(args, selections, all_units):
+    """
+    Generator of the keys of all the videos and resources that have
+    something to download, whatever their shard.
+    """
+    for _, prefixed_units in _iter_sections(args, selections, all_units):
+        for _, unit in prefixed_units:
+            for video in unit.videos:
+                if video.video_youtube_url is not None or video.mp4_urls:
+                    if args.prefer_cdn_videos and not video.mp4_urls:
+                        continue
+                    yield video_shard_key(video)
+            for url in unit.resources_urls:
+                yield url
+
+
+def plan_fingerprint(keys):
+    """
+    Returns (number of keys, checksum of the keys) of a run, the shards of
+    the same run must agree on it.
+    """
+    keys = sorted(set(keys))
+    return len(keys), zlib.crc32('\n'.join(keys).encode('utf-8')) & 0xffffffff
+
+
+def write_shard_manifest(planned_downloads, shard, fingerprint, filename):
+    """
+    Writes the manifest of the downloads of a shard: a JSON header with the
+    shard and the fingerprint of the whole run, then a JSON record per
+    download.
+    """
+    index, count = shard
+    num_keys, checksum = fingerprint
+    logging.info('writing the manifest of shard %d/%d to [%s]', index, count,
+                 filename)
+    with open(filename, 'w') as f:
+        f.write(json.dumps({'shard': index, 'shards': count,
+                            'keys': num_keys, 'checksum': checksum}) + '\n')
+        for planned in planned_downloads:
+            f.write(json.dumps({'url': planned.url,
+                                'dir': planned.target_dir,
+                                'filename': planned.filename,
+                                'kind': planned.kind,
+                                'key': planned.key}) + '\n')
+
+
+def merge_shard_manifests(filenames, output_filename):
+    """
+    Checks that the manifests cover every shard of the same run, with no
+    download missing or repeated, and writes their records to
+    output_filename (dash "-" for stdout) as JSON Lines. Returns True if
+    the check passed.
+    """
+    headers = []
+    records = []
+    for filename in filenames:
+        with open(filename) as f:
+            lines = [json.loads(line) for line in f if line.strip()]
+        if not lines or 'shard' not in lines[0]:
+            logging.error('[%s] is not a shard manifest', filename)
+            return False
+        headers.append(lines[0])
+        records.extend(lines[1:])
+
+    problems = []
+    runs = set((h['shards'], h['keys'], h['checksum']) for h in headers)
+    if len(runs) > 1:
+        problems.append('the manifests come from different runs')
+    count = headers[0]['shards']
+    shards = sorted(h['shard'] for h in headers)
+    if shards != list(range(1, count + 1)):
+        problems.append('expected shards 1..%d, got %s' % (count, shards))
+    paths = [os.path.join(r['dir'], r['filename']) for r in records]
+    repeated = len(paths) - len(set(paths))
+    if repeated:
+        problems.append('%d downloads are repeated' % repeated)
+    keys = set(r['key'] for r in records)
+    if len(keys) != headers[0]['keys']:
+        problems.append('%d of %d videos and resources are missing' %
+                        (headers[0]['keys'] - len(keys), headers[0]['keys']))
+    for problem in problems:
+        logging.error('Merging the shards: %s', problem)
+    if problems:
+        return False
+
+    file_ = sys.stdout if output_filename == '-' else open(output_filename,
+                                                           'w')
+    try:
+        for record in records:
+            del record['key']
+            file_.write(json.dumps(record) + '\n')
+    finally:
+        if file_ is not sys.stdout:
+            file_.close()
+    logging.info('Merged %d shards with %d downloads', count, len(records))
+    return True
+
+
+def format_aria2c(planned):
+    """
+    Formats a PlannedDownload as an entry of an aria2c input file, or
+    returns None for youtube videos, which aria2c can't download.
+    """
+    if is_youtube_url(planned.url):
+        return None
+    return '%s\n  dir=%s\n  out=%s\n' % (planned.url, planned.target_dir,
+                                         planned.filename)
+
+
+def format_jsonl(planned):
+    """
+    Formats a PlannedDownload as a JSON Lines record.
+    """
+    return json.dumps({'url': planned.url,
+                       'dir': planned.target_dir,
+                       'filename': planned.filename,
+                       'kind': planned.kind}) + '\n'
+
+
+MANIFEST_FORMATTERS = {
+    'aria2c': format_aria2c,
+    'jsonl': format_jsonl,
+}
+
+
+def save_manifest(planned_downloads, format_, filename):
+    """
+    Writes the planned downloads to filename (dash "-" for stdout) in the
+    given manifest format, one record at a time as they are planned.
+    Returns the number of records written.
+    """
+    formatter = MANIFEST_FORMATTERS[format_]
+    file_ = sys.stdout if filename == '-' else open(filename, 'w')
+    written = skipped = 0
+    try:
+        for planned in planned_downloads:
+            record = formatter(planned)
+            if record is None:
+                skipped += 1
+                continue
+            file_.write(record)
+            written += 1
+    finally:
+        if file_ is not sys.stdout:
+            file_.close()
+    if skipped:
+        logging.warn('%d youtube videos are not supported by the %s format '
+                     'and were not exported', skipped, format_)
+    return written
 
 
 def remove_repeated_urls(all_units):
@@ -843,36 +2049,93 @@ def remove_repeated_urls(all_units):
     Removes repeated urls from the units, it does not consider subtitles.
     This is done to avoid repeated downloads.
     """
-    existing_urls = set()
+    filtered_units, _, _ = dedup_units(all_units)
+    return filtered_units
+
+
+def _num_urls_in_video(video):
+    """
+    Counts the number of urls of a video (including the subtitles ones).
+    """
+    return (int(video.video_youtube_url is not None) +
+            int(video.available_subs_url is not None) +
+            int(video.sub_template_url is not None) +
+            len(video.mp4_urls))
+
+
+def dedup_units(all_units):
+    """
+    Removes repeated urls from the units (see remove_repeated_urls) and
+    counts the urls before and after the removal in the same pass.
+
+    All the units share a single set of seen urls, so the whole process is
+    linear in the number of urls. Videos and units without repeated urls are
+    reused instead of rebuilt.
+
+    Returns a tuple (filtered_units, num_all_urls, num_filtered_urls), the
+    counts are the same given by num_urls_in_units_dict.
+    """
+    seen = set()
+    num_all_urls = 0
+    num_filtered_urls = 0
     filtered_units = {}
+
+    def _new_urls(urls):
+        new_urls = []
+        for url in urls:
+            if url not in seen:
+                seen.add(url)
+                new_urls.append(url)
+        return new_urls
+
     for url, units in all_units.items():
         reduced_units = []
         for unit in units:
             videos = []
+            changed = False
             for video in unit.videos:
+                num_video_urls = _num_urls_in_video(video)
+                num_all_urls += num_video_urls
+
                 # we don't analyze the subtitles for repetition since
                 # their size is negligible for the goal of this function
-                video_youtube_url = None
-                if video.video_youtube_url not in existing_urls:
-                    video_youtube_url = video.video_youtube_url
-                    existing_urls.add(video_youtube_url)
-
-                mp4_urls, existing_urls = remove_duplicates(video.mp4_urls, existing_urls)
-
-                if video_youtube_url is not None or len(mp4_urls) > 0:
-                    videos.append(Video(video_youtube_url=video_youtube_url,
-                                        available_subs_url=video.available_subs_url,
-                                        sub_template_url=video.sub_template_url,
-                                        mp4_urls=mp4_urls))
-
-            resources_urls, existing_urls = remove_duplicates(unit.resources_urls, existing_urls)
-
-            if len(videos) > 0 or len(resources_urls) > 0:
+                video_youtube_url = video.video_youtube_url
+                if video_youtube_url is not None:
+                    if video_youtube_url in seen:
+                        video_youtube_url = None
+                    else:
+                        seen.add(video_youtube_url)
+                mp4_urls = _new_urls(video.mp4_urls)
+
+                if video_youtube_url is None and len(mp4_urls) == 0:
+                    changed = True
+                    continue
+
+                if (video_youtube_url != video.video_youtube_url or
+                        len(mp4_urls) != len(video.mp4_urls)):
+                    changed = True
+                    video = Video(video_youtube_url=video_youtube_url,
+                                  available_subs_url=video.available_subs_url,
+                                  sub_template_url=video.sub_template_url,
+                                  mp4_urls=mp4_urls)
+                    num_video_urls = _num_urls_in_video(video)
+                videos.append(video)
+                num_filtered_urls += num_video_urls
+
+            num_all_urls += len(unit.resources_urls)
+            resources_urls = _new_urls(unit.resources_urls)
+            num_filtered_urls += len(resources_urls)
+            changed = changed or len(resources_urls) != len(unit.resources_urls)
+
+            if not changed:
+                if len(videos) > 0 or len(resources_urls) > 0:
+                    reduced_units.append(unit)
+            elif len(videos) > 0 or len(resources_urls) > 0:
                 reduced_units.append(Unit(videos=videos,
                                           resources_urls=resources_urls))
 
         filtered_units[url] = reduced_units
-    return filtered_units
+    return filtered_units, num_all_urls, num_filtered_urls
 
 
 def num_urls_in_units_dict(units_dict):
@@ -885,10 +2148,7 @@ def num_urls_in_units_dict(units_dict):
     for units in units_dict.values():
         for unit in units:
             for video in unit.videos:
-                num_urls += int(video.video_youtube_url is not None)
-                num_urls += int(video.available_subs_url is not None)
-                num_urls += int(video.sub_template_url is not None)
-                num_urls += len(video.mp4_urls)
+                num_urls += _num_urls_in_video(video)
             num_urls += len(unit.resources_urls)
 
     return num_urls
@@ -896,24 +2156,31 @@ def num_urls_in_units_dict(units_dict):
 
 def extract_all_units_with_cache(all_urls, headers, file_formats,
                                  filename=DEFAULT_CACHE_FILENAME,
-                                 extractor=extract_all_units_in_parallel):
+                                 extractor=extract_all_units_in_parallel,
+                                 refresh_urls=()):
     """
-    Extracts the units which are not in the cache and extract their resources
-    returns the full list of units (cached+new)
+    Extracts the units which are not in the cache (or are in refresh_urls)
+    and extract their resources returns the full list of units (cached+new)
 
     The cache is used to improve speed because it avoids requesting already
     known (and extracted) objects from URLs. This is useful to follow courses
     week by week since we won't parse the already known subsections/units,
     additionally it speeds development of code unrelated to extraction.
     """
+    import pickle
+
     cached_units = {}
 
     if os.path.exists(filename):
         with open(filename, 'rb') as f:
             cached_units = pickle.load(f)
+        cached_units = dict((intern_url(url), units)
+                            for url, units in cached_units.items())
 
     # we filter the cached urls
-    new_urls = [url for url in all_urls if url not in cached_units]
+    refresh_urls = set(refresh_urls)
+    new_urls = [url for url in all_urls
+                if url not in cached_units or url in refresh_urls]
     logging.info('loading %d urls from cache [%s]', len(cached_units.keys()),
                  filename)
     new_units = extractor(new_urls, headers, file_formats)
@@ -923,14 +2190,121 @@ def extract_all_units_with_cache(all_urls, headers, file_formats,
     return all_units
 
 
+def outline_to_json(sections):
+    """
+    Returns the sections (and their subsections) as JSON serializable data.
+    """
+    return [{'position': section.position, 'name': section.name,
+             'url': section.url,
+             'subsections': [{'position': subsection.position,
+                              'name': subsection.name,
+                              'url': subsection.url}
+                             for subsection in section.subsections]}
+            for section in sections]
+
+
+def outline_from_json(data):
+    """
+    Returns the sections serialized by outline_to_json.
+    """
+    return [Section(position=section['position'], name=section['name'],
+                    url=section['url'],
+                    subsections=[SubSection(**subsection)
+                                 for subsection in section['subsections']])
+            for section in data]
+
+
+def read_outline_file(filename=DEFAULT_OUTLINE_FILENAME):
+    """
+    Reads the outlines written by write_outline_file as a dict
+    {course_id: [Section]}, empty if there is no file yet.
+    """
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        data = json.load(f)
+    return dict((course_id, outline_from_json(sections))
+                for course_id, sections in data.items())
+
+
+def write_outline_file(outlines, filename=DEFAULT_OUTLINE_FILENAME):
+    """
+    Writes the outlines given as a dict {course_id: [Section]}.
+    """
+    logging.info('writing the outline of %d courses to [%s]', len(outlines),
+                 filename)
+    data = dict((course_id, outline_to_json(sections))
+                for course_id, sections in outlines.items())
+    with open(filename, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+
+
+def diff_outline(old_sections, new_sections):
+    """
+    Compares two outlines of a course and returns the (new, changed,
+    removed) lists of subsections, a subsection being identified by its
+    url and changed when it was renamed or moved.
+    """
+    def placed_subsections(sections):
+        return dict((subsection.url,
+                     (section.position, section.name, subsection))
+                    for section in sections
+                    for subsection in section.subsections)
+
+    old = placed_subsections(old_sections or [])
+    new = placed_subsections(new_sections)
+    added, changed = [], []
+    for url, (position, name, subsection) in new.items():
+        if url not in old:
+            added.append(subsection)
+            continue
+        old_position, old_name, old_subsection = old[url]
+        if (position, name, subsection.position, subsection.name) != \
+                (old_position, old_name, old_subsection.position,
+                 old_subsection.name):
+            changed.append(subsection)
+    removed = [subsection for url, (_, _, subsection) in old.items()
+               if url not in new]
+    return added, changed, removed
+
+
+def sync_selections(selections, all_selections, outlines):
+    """
+    Returns the selections restricted to the sections with new or changed
+    subsections since the given outlines, and the set of urls of those
+    subsections. The whole section is kept since the filenames of its units
+    are numbered across its subsections.
+    """
+    changed_urls = set()
+    for course, sections in all_selections.items():
+        added, changed, removed = diff_outline(outlines.get(course.id),
+                                               sections)
+        logging.info('%s: %d new, %d changed and %d removed subsections',
+                     course.name, len(added), len(changed), len(removed))
+        for subsection in removed:
+            logging.info('[removed] %s', subsection)
+        changed_urls.update(subsection.url for subsection in added + changed)
+
+    synced = {}
+    for course, sections in selections.items():
+        changed_sections = [section for section in sections
+                            if any(subsection.url in changed_urls
+                                   for subsection in section.subsections)]
+        if changed_sections:
+            synced[course] = changed_sections
+    return synced, changed_urls
+
+
 def write_units_to_cache(units, filename=DEFAULT_CACHE_FILENAME):
     """
     writes units to cache
     """
+    import pickle
+
     logging.info('writing %d urls to cache [%s]', len(units.keys()),
                  filename)
     with open(filename, 'wb') as f:
-        pickle.dump(units, f)
+        pickle.dump(units, f, pickle.HIGHEST_PROTOCOL)
 
 
 def extract_urls_from_units(all_units, format_):
@@ -979,43 +2353,210 @@ def main():
     logging.info('edx_dl version %s', __version__)
     file_formats = parse_file_formats(args)
 
+    global _memory_tracer
+    profiler = None
+    if args.profile is not None or args.trace_malloc is not None:
+        from .profiling import MemoryTracer, RunProfiler
+    if args.profile is not None:
+        if args.parse_processes is None:
+            # parse in the profiled threads, not in unprofiled processes
+            args.parse_processes = 0
+        profiler = RunProfiler()
+        profiler.start()
+    if args.trace_malloc is not None:
+        _memory_tracer = MemoryTracer(args.trace_malloc)
+        _memory_tracer.start()
+
+    try:
+        _run(args, file_formats)
+    except EdxDlError as e:
+        logging.error(e)
+        exit(e.exit_code)
+    finally:
+        if profiler is not None:
+            profiler.stop(args.profile)
+        if _memory_tracer is not None:
+            _memory_tracer.stop()
+            _memory_tracer = None
+
+
+def _run(args, file_formats):
+    """
+    Runs edx-dl with the parsed args.
+    """
+    if args.verify:
+        if not verify_downloads(args.output_dir, args.verify == 'full'):
+            exit(ExitCode.VERIFICATION_FAILED)
+        return
+
+    if args.merge_shards:
+        if not merge_shard_manifests(args.merge_shards,
+                                     args.export_filename or '-'):
+            exit(ExitCode.VERIFICATION_FAILED)
+        return
+
     change_openedx_site(args.platform)
+    set_limiter(AdaptiveLimiter(maximum=max(1, args.max_concurrency)))
+    set_retry_policy(RetryPolicy(max_attempts=max(0, args.retries) + 1))
+    set_timeouts(args.connect_timeout, args.read_timeout)
+    set_watchdog(Watchdog(args.stall_timeout))
+    set_bandwidth_limiter(BandwidthLimiter(args.limit_rate,
+                                           args.limit_rate_schedule))
+
+    if args.replay or args.record:
+        from .archive import PageArchive
+
+    if args.replay:
+        archive = PageArchive(args.replay)
+        logging.info('Replaying %d pages from [%s]', len(archive), args.replay)
+        set_archive(archive, replay=True)
+        headers = {}
+    else:
+        if args.record:
+            logging.info('Recording the fetched pages in [%s]', args.record)
+            set_archive(PageArchive(args.record))
+        headers = _login(args)
 
-    # Query password, if not alredy passed by command line.
-    if not args.password:
-        args.password = getpass.getpass(stream=sys.stderr)
+    if args.retry_failures is not None:
+        download_failures(read_failures_file(args.retry_failures),
+                          headers, args)
+        _finish_downloads(headers, args)
+        return
 
-    if not args.username or not args.password:
-        logging.error("You must supply username and password to log-in")
-        exit(ExitCode.MISSING_CREDENTIALS)
+    if args.work_queue is not None:
+        work_queue(args.work_queue, headers, args)
+        return
 
-    # Prepare Headers
-    headers = edx_get_headers()
+    if args.watch:
+        watch(args, headers, file_formats)
+        return
 
-    # Login
-    resp = edx_login(LOGIN_API, headers, args.username, args.password)
-    if not resp.get('success', False):
-        logging.error(resp.get('value', "Wrong Email or Password."))
-        exit(ExitCode.WRONG_EMAIL_OR_PASSWORD)
+    selected_courses = select_courses(args, headers)
+    api_blocks = {}
+    all_selections = get_all_selections(args, selected_courses, headers,
+                                        api_blocks)
+    process_selections(args, headers, file_formats, all_selections,
+                       api_blocks)
 
-    # Parse and select the available courses
-    courses = get_courses_info(DASHBOARD, headers)
+    _display_transfer_stats()
+
+
+def select_courses(args, headers):
+    """
+    Returns the started courses of the dashboard selected in args.
+    """
+    courses = get_courses_info(get_site().dashboard, headers)
     available_courses = [course for course in courses if course.state == 'Started']
-    selected_courses = parse_courses(args, available_courses)
+    return parse_courses(args, available_courses)
+
+
+def get_all_selections(args, selected_courses, headers, api_blocks=None):
+    """
+    Returns a dict {course: [Section]} with the outline of the courses.
+
+    With --blocks-api the outlines are taken from the Course Blocks API
+    (falling back to the course pages where it is not available) and the
+    blocks of every subsection are stored in the api_blocks dict for
+    extract_all_units_with_api.
+    """
+    if args.blocks_api and api_blocks is not None:
+        return dict((course, get_sections_from_api(course, headers,
+                                                   api_blocks))
+                    for course in selected_courses)
+    all_selections = {selected_course:
+                      get_course_sections(selected_course, headers)
+                      for selected_course in selected_courses}
+    return all_selections
 
-    # Parse the sections and build the selections dict filtered by sections
-    if args.platform == 'edx':
-        all_selections = {selected_course:
-                          get_available_sections(selected_course.url.replace('info', 'course'), 
-                                                 headers)
-                          for selected_course in selected_courses}
-    else:
-        all_selections = {selected_course:
-                          get_available_sections(selected_course.url.replace('info', 'courseware'), 
-                                                 headers)
-                          for selected_course in selected_courses}
 
+def get_course_sections(course, headers):
+    """
+    Returns the [Section] of the outline of course.
+    """
+    page = 'course' if get_site().name == 'edx' else 'courseware'
+    return get_available_sections(course.url.replace('info', page), headers)
+
+
+def get_sections_from_api(course, headers, api_blocks):
+    """
+    Returns the sections of course given by the Course Blocks API, storing
+    its blocks in api_blocks as {subsection_url: (extractor, blocks,
+    block_id)}. Falls back to the course page if the API fails.
+    """
+    base_url = get_site().base_url
+    extractor = BlocksApiExtractor(base_url, course.id)
+    try:
+        username = get_page_contents_as_json(base_url + USER_API,
+                                             headers)['username']
+        url = extractor.blocks_url(username)
+        blocks = {}
+        root = None
+        while url:
+            page_blocks, page_root, url = extractor.parse_blocks_page(
+                get_page_contents_as_json(url, headers))
+            blocks.update(page_blocks)
+            root = root or page_root
+        if root is None:
+            raise ValueError('no course block')
+        sections = extractor.extract_sections(blocks, root)
+    except (HTTPError, ValueError, KeyError) as e:
+        logging.warn('Course Blocks API not available for %s (%s), using '
+                     'the course pages', course.name, e)
+        return get_course_sections(course, headers)
+
+    block_ids = dict((block.get('lms_web_url'), block_id)
+                     for block_id, block in blocks.items()
+                     if block.get('type') == 'sequential')
+    for section in sections:
+        for subsection in section.subsections:
+            api_blocks[subsection.url] = (extractor, blocks,
+                                          block_ids[subsection.url])
+    return sections
+
+
+def extract_all_units_with_api(urls, headers, file_formats, api_blocks,
+                               extractor=extract_all_units_in_parallel):
+    """
+    Returns a dict {url: [Unit]} of the subsections in urls, built from the
+    blocks of the Course Blocks API in api_blocks. The subsections missing
+    from api_blocks or whose resources the API doesn't give are extracted
+    from their pages with extractor.
+    """
+    all_units = {}
+    page_urls = []
+    for url in urls:
+        units = None
+        if url in api_blocks:
+            api_extractor, blocks, block_id = api_blocks[url]
+            units = api_extractor.extract_units(blocks, block_id,
+                                                file_formats)
+        if units is None:
+            page_urls.append(url)
+        else:
+            all_units[url] = units
+    if page_urls:
+        logging.info('Extracting %d subsections from their pages',
+                     len(page_urls))
+        all_units.update(extractor(page_urls, headers, file_formats))
+    return all_units
+
+
+def process_selections(args, headers, file_formats, all_selections,
+                       api_blocks=None):
+    """
+    Selects the sections of all_selections given in args, extracts their
+    units and downloads (or exports) their resources.
+    """
+    _memory_snapshot('outline')
     selections = parse_sections(args, all_selections)
+    changed_urls = ()
+    if args.sync:
+        outlines = read_outline_file(args.outline_file)
+        selections, changed_urls = sync_selections(selections,
+                                                   all_selections, outlines)
+        if not selections:
+            logging.info('Nothing new since the last run')
+            return
     _display_selections(selections)
 
     # Extract the unit information (downloadable resources)
@@ -1026,39 +2567,230 @@ def main():
                 for selected_section in selected_sections
                 for subsection in selected_section.subsections]
 
-    extractor = extract_all_units_in_parallel
+    extractor = partial(extract_all_units_with_processes,
+                        processes=args.parse_processes)
     if args.sequential:
         extractor = extract_all_units_in_sequence
+    elif args.parse_processes == 0:
+        extractor = extract_all_units_in_parallel
+    if api_blocks:
+        extractor = partial(extract_all_units_with_api,
+                            api_blocks=api_blocks, extractor=extractor)
 
-    if args.cache:
+    if args.cache or args.sync:
         all_units = extract_all_units_with_cache(all_urls, headers,
                                                  file_formats,
-                                                 extractor=extractor)
+                                                 extractor=extractor,
+                                                 refresh_urls=changed_urls)
     else:
         all_units = extractor(all_urls, headers, file_formats)
 
     parse_units(selections)
 
-    if args.cache:
+    if args.cache or args.sync:
         write_units_to_cache(all_units)
+    _memory_snapshot('extraction')
 
     # This removes all repeated important urls
     # FIXME: This is not the best way to do it but it is the simplest, a
     # better approach will be to create symbolic or hard links for the repeated
     # units to avoid losing information
-    filtered_units = remove_repeated_urls(all_units)
-    num_all_urls = num_urls_in_units_dict(all_units)
-    num_filtered_urls = num_urls_in_units_dict(filtered_units)
+    filtered_units, num_all_urls, num_filtered_urls = dedup_units(all_units)
     logging.warn('Removed %d duplicated urls from %d in total',
                  (num_all_urls - num_filtered_urls), num_all_urls)
+    _memory_snapshot('dedup')
 
     # finally we download or export all the resources
     if args.export_filename is not None:
         logging.info('exporting urls to file %s', args.export_filename)
-        urls = extract_urls_from_units(filtered_units, args.export_format)
-        save_urls_to_file(urls, args.export_filename)
+        if args.export_format in EXPORT_MANIFEST_FORMATS:
+            planned_downloads = iter_planned_downloads(args, selections,
+                                                       filtered_units, headers)
+            save_manifest(planned_downloads, args.export_format,
+                          args.export_filename)
+        else:
+            urls = extract_urls_from_units(filtered_units, args.export_format)
+            save_urls_to_file(urls, args.export_filename)
     else:
+        if args.prefetch_sizes or args.download_order != 'outline':
+            planned_downloads = list(iter_planned_downloads(
+                args, selections, filtered_units, headers))
+            sizes = prefetch_sizes(planned_downloads)
+            needed = report_sizes(planned_downloads, sizes)
+            if not args.dry_run and not has_free_space(args.output_dir,
+                                                       needed):
+                exit(ExitCode.NOT_ENOUGH_SPACE)
+            if args.download_order != 'outline' and not args.dry_run:
+                download_in_order(sort_by_size(planned_downloads, sizes,
+                                               args.download_order),
+                                  headers, args)
+        if args.plan_queue is not None:
+            plan_queue(iter_planned_downloads(args, selections,
+                                              filtered_units, headers),
+                       args.plan_queue)
+            return
+        if args.shard is not None:
+            _ensure_dir(args.output_dir)
+            write_shard_manifest(
+                iter_planned_downloads(args, selections, filtered_units,
+                                       headers),
+                args.shard,
+                plan_fingerprint(_iter_shard_keys(args, selections,
+                                                  filtered_units)),
+                os.path.join(args.output_dir,
+                             SHARD_MANIFEST_FILENAME % args.shard))
         download(args, selections, filtered_units, headers)
+        _finish_downloads(headers, args)
+    _memory_snapshot('download')
+
+    if args.sync and not args.dry_run:
+        outlines.update((course.id, sections)
+                        for course, sections in all_selections.items())
+        write_outline_file(outlines, args.outline_file)
+
+
+# MemoryTracer of --trace-malloc
+_memory_tracer = None
+
+
+def _memory_snapshot(phase):
+    """
+    Reports the memory allocated until the end of phase with --trace-malloc.
+    """
+    if _memory_tracer is not None:
+        _memory_tracer.snapshot(phase)
+
+
+WATCH_JITTER = 0.2
+
+
+def _jittered(interval):
+    """
+    Returns interval randomly stretched or shrunk by up to WATCH_JITTER, so
+    that the polls of many courses spread out over time.
+    """
+    return interval * random.uniform(1 - WATCH_JITTER, 1 + WATCH_JITTER)
+
+
+def watch(args, headers, file_formats):
+    """
+    Polls the dashboard and the outline of every selected course about
+    every args.watch seconds, downloading what is new in each course (see
+    --sync), until interrupted.
+
+    The session is kept (and renewed if the site rejects it) and the pages
+    are fetched with conditional requests, so polling unchanged pages only
+    costs a 304 response. Each course is polled on its own jittered
+    schedule to spread the load.
+    """
+    set_conditional_cache(ConditionalCache())
+    args.sync = True
+    next_dashboard = 0
+    courses = []
+    due = {}
+    while True:
+        now = time.time()
+        try:
+            if now >= next_dashboard:
+                courses = select_courses(args, headers)
+                for course in courses:
+                    due.setdefault(course.id, now)
+                next_dashboard = now + _jittered(args.watch)
+            for course in courses:
+                if due[course.id] <= now:
+                    api_blocks = {}
+                    all_selections = get_all_selections(args, [course],
+                                                        headers, api_blocks)
+                    process_selections(args, headers, file_formats,
+                                       all_selections, api_blocks)
+                    due[course.id] = time.time() + _jittered(args.watch)
+        except RETRYABLE_EXCEPTIONS as e:
+            if isinstance(e, HTTPError) and e.code in (401, 403):
+                logging.warn('Session rejected (%s), logging in again', e)
+                headers = _login(args)
+                continue
+            logging.error('Polling failed (%s), trying again later', e)
+            time.sleep(_jittered(args.watch))
+            continue
+
+        next_poll = min([due[course.id] for course in courses] +
+                        [next_dashboard])
+        time.sleep(max(0, next_poll - time.time()))
+
+
+def verify_downloads(output_dir, full=False):
+    """
+    Verifies the downloaded files against the checksums recorded while
+    downloading them, returns True if all of them are fine.
+    """
+    from .checksums import verify, OK
+    logging.info('Verifying the files in [%s]', output_dir)
+    results = verify(output_dir, full)
+    problems = [(path, status) for path, status in results if status != OK]
+    for path, status in problems:
+        logging.error('[%s] %s', status, path)
+    logging.info('%d files verified, %d with problems', len(results),
+                 len(problems))
+    return not problems
+
+
+def _display_transfer_stats():
+    """
+    Displays the bytes of the pages received and the savings of their
+    compression.
+    """
+    logging.info('Pages: %d bytes received, %d bytes decompressed '
+                 '(%.1f%% saved by compression)',
+                 transfer_stats.wire_bytes, transfer_stats.decoded_bytes,
+                 100 * transfer_stats.saved_ratio())
+
+
+def _login(args):
+    """
+    Logs into the Open edX site and returns the headers for future
+    requests.
+    """
+    # Query password, if not alredy passed by command line.
+    if not args.password:
+        args.password = getpass.getpass(stream=sys.stderr)
+
+    return login(args.username, args.password)
+
+
+def login(username, password):
+    """
+    Logs into the current Open edX site and returns the headers for future
+    requests, raising EdxDlError if the credentials are wrong.
+    """
+    if not username or not password:
+        raise EdxDlError("You must supply username and password to log-in",
+                         ExitCode.MISSING_CREDENTIALS)
+
+    # Prepare Headers
+    headers = edx_get_headers()
+
+    # Login
+    resp = edx_login(get_site().login_api, headers, username, password)
+    if not resp.get('success', False):
+        raise EdxDlError(resp.get('value', "Wrong Email or Password."),
+                         ExitCode.WRONG_EMAIL_OR_PASSWORD)
+
+    return headers
+
+
+def _finish_downloads(headers, args):
+    """
+    Retries the deferred downloads and records the ones that still fail.
+    """
+    if args.dry_run:
+        return
+    failures = retry_deferred_downloads(headers, args)
+    if failures:
+        write_failures_file(failures, args.failures_file)
+    elif os.path.exists(args.failures_file):
+        # don't let a later --retry-failures download items that succeeded
+        logging.info('No failed downloads, removing [%s]', args.failures_file)
+        os.remove(args.failures_file)
 
 
 if __name__ == '__main__':
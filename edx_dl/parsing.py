@@ -9,13 +9,78 @@ import json
 from datetime import timedelta, datetime
 
 from six.moves import html_parser
-from bs4 import BeautifulSoup as BeautifulSoup_
+from six.moves.urllib.parse import urlencode
 
 from .common import Course, Section, SubSection, Unit, Video
 
 
-# Force use of bs4 with html5lib
-BeautifulSoup = lambda page: BeautifulSoup_(page, 'html5lib')
+def BeautifulSoup(page):
+    """
+    Parse the page forcing the use of bs4 with html5lib. They are imported
+    here since they are slow to import and many runs don't need them.
+    """
+    from bs4 import BeautifulSoup as BeautifulSoup_
+    return BeautifulSoup_(page, 'html5lib')
+
+# in this module we avoid using beautifulsoup for the units for performance
+# reasons, parsing html with regular expressions is really nasty, don't do
+# this if you don't need to !
+RE_UNITS = re.compile(r'(<div?[^>]id="seq_contents_\d+".*?>.*?<\/div>)',
+                      re.DOTALL)
+# Pieces of RE_UNITS used to scan a page incrementally: the beginning of a
+# unit block, its whole opening tag and an opening tag cut by the end of the
+# text received so far
+RE_UNIT_START = re.compile(r'<div?[^>]id="seq_contents_')
+RE_UNIT_OPEN = re.compile(r'<div?[^>]id="seq_contents_\d+".*?>', re.DOTALL)
+RE_UNIT_OPEN_PARTIAL = re.compile(r'<div?[^>]id="seq_contents_(?:\d*|\d+"[^>]*)\Z')
+UNIT_START_LENGTH = len('<div id="seq_contents_')
+UNIT_END = '</div>'
+
+
+def iter_unit_blocks(chunks):
+    """
+    Generator of the unit blocks (the seq_contents_N <div>s matched by
+    RE_UNITS) of a page given as an iterable of text chunks.
+
+    Blocks are emitted as soon as they are complete and the text before
+    them is dropped, so the memory used is bounded by the largest unit
+    instead of the whole page. The blocks are the same that
+    RE_UNITS.findall gives for the whole page.
+
+    Each chunk is only scanned once: the end of the pending unit is searched
+    in the new text (plus a small overlap) instead of matching RE_UNITS
+    against the whole pending text again.
+    """
+    buf = ''
+    open_end = None  # end of the opening tag of the unit at buf[0], if any
+    scan = 0  # position of buf where the search is resumed
+    for chunk in chunks:
+        buf += chunk
+        while True:
+            if open_end is None:
+                start = RE_UNIT_START.search(buf, scan)
+                if start is None:
+                    # the beginning of a unit may be split between chunks
+                    keep = max(scan, len(buf) - UNIT_START_LENGTH + 1)
+                    buf, scan = buf[keep:], 0
+                    break
+                buf = buf[start.start():]
+                opening = RE_UNIT_OPEN.match(buf)
+                if opening is None:
+                    if RE_UNIT_OPEN_PARTIAL.match(buf):
+                        scan = 0  # wait for the rest of the opening tag
+                        break
+                    scan = 1  # not a unit, look for the next one
+                    continue
+                open_end = scan = opening.end()
+
+            end = buf.find(UNIT_END, scan)
+            if end == -1:
+                scan = max(open_end, len(buf) - len(UNIT_END) + 1)
+                break
+            end += len(UNIT_END)
+            yield buf[:end]
+            buf, open_end, scan = buf[end:], None, 0
 
 
 def edx_json2srt(o):
@@ -66,6 +131,15 @@ class PageExtractor(object):
         """
         raise NotImplementedError("Subclasses should implement this")
 
+    def extract_units_from_stream(self, chunks, BASE_URL, file_formats):
+        """
+        Method to extract the resources (units) from a page given as an
+        iterable of text chunks. By default the whole page is gathered
+        first, subclasses can process it incrementally.
+        """
+        return self.extract_units_from_html(''.join(chunks), BASE_URL,
+                                            file_formats)
+
     def extract_sections_from_html(self, page, BASE_URL):
         """
         Method to extract the sections (and subsections) from an html page
@@ -86,14 +160,17 @@ class ClassicEdXPageExtractor(PageExtractor):
         Extract Units from the html of a subsection webpage as a list of
         resources
         """
-        # in this function we avoid using beautifulsoup for performance reasons
-        # parsing html with regular expressions is really nasty, don't do this if
-        # you don't need to !
-        re_units = re.compile('(<div?[^>]id="seq_contents_\d+".*?>.*?<\/div>)',
-                              re.DOTALL)
+        return self.extract_units_from_stream([page], BASE_URL, file_formats)
+
+    def extract_units_from_stream(self, chunks, BASE_URL, file_formats):
+        """
+        Extract Units from the html of a subsection webpage, given as an
+        iterable of text chunks, as a list of resources. Each unit is
+        processed as soon as its block is complete.
+        """
         units = []
 
-        for unit_html in re_units.findall(page):
+        for unit_html in iter_unit_blocks(chunks):
             unit = self.extract_unit(unit_html, BASE_URL, file_formats)
             if len(unit.videos) > 0 or len(unit.resources_urls) > 0:
                 units.append(unit)
@@ -408,6 +485,165 @@ class NewEdXPageExtractor(CurrentEdXPageExtractor):
         return sections
 
 
+class BlocksApiExtractor(object):
+    """
+    Extractor of the sections and units of a course from the JSON of the
+    Open edX Course Blocks API (/api/courses/v1/blocks/), which describes
+    the whole course in a few requests instead of a page per subsection.
+
+    The resources are found in the html of the html components, which the
+    platform only gives when it enables their student_view_data; the units
+    of subsections with html components without it must be extracted from
+    their pages instead.
+    """
+    # the encodings of the videos, best first
+    VIDEO_ENCODINGS = ('desktop_mp4', 'fallback', 'mobile_high',
+                       'mobile_low')
+
+    def __init__(self, BASE_URL, course_id):
+        self.BASE_URL = BASE_URL
+        self.course_id = course_id
+
+    def blocks_url(self, username):
+        """
+        URL of the first page of the blocks of the course.
+        """
+        query = urlencode([('course_id', self.course_id),
+                           ('username', username),
+                           ('depth', 'all'),
+                           ('requested_fields', 'children,display_name,'
+                            'type,lms_web_url,student_view_data'),
+                           ('student_view_data', 'video,html'),
+                           ('return_type', 'dict')])
+        return self.BASE_URL + '/api/courses/v1/blocks/?' + query
+
+    @staticmethod
+    def parse_blocks_page(data):
+        """
+        Returns (blocks, root, next_url) from a page of the API, root and
+        next_url being None if the page doesn't give them. Both the dict
+        and the paginated list formats are supported.
+        """
+        if 'results' in data:
+            results = data['results']
+            if isinstance(results, dict):  # paginated dict format
+                blocks, root = results.get('blocks', {}), results.get('root')
+            else:
+                blocks = dict((block['id'], block) for block in results)
+                root = None
+            next_url = data.get('next') or data.get('pagination',
+                                                    {}).get('next')
+        else:
+            blocks, root, next_url = data['blocks'], data.get('root'), None
+        if root is None:
+            roots = [block_id for block_id, block in blocks.items()
+                     if block.get('type') == 'course']
+            root = roots[0] if roots else None
+        return blocks, root, next_url
+
+    @staticmethod
+    def _children(blocks, block_id, type_=None):
+        children = [blocks[child]
+                    for child in blocks[block_id].get('children', [])
+                    if child in blocks]
+        if type_ is not None:
+            children = [child for child in children
+                        if child.get('type') == type_]
+        return children
+
+    def extract_sections(self, blocks, root):
+        """
+        Returns the [Section] of the chapters of the course, the url of the
+        subsections being their lms_web_url.
+        """
+        sections = []
+        chapters = self._children(blocks, root, 'chapter')
+        for position, chapter in enumerate(chapters, 1):
+            subsections = [SubSection(position=i,
+                                      name=sequential.get('display_name'),
+                                      url=sequential['lms_web_url'])
+                           for i, sequential in enumerate(
+                               self._children(blocks, chapter['id'],
+                                              'sequential'), 1)]
+            url = subsections[0].url if subsections else None
+            sections.append(Section(position=position,
+                                    name=chapter.get('display_name'),
+                                    url=url, subsections=subsections))
+        return sections
+
+    def extract_units(self, blocks, sequential_id, file_formats):
+        """
+        Returns the [Unit] of the verticals of the sequential, or None if
+        they must be extracted from its page (see the class docstring).
+        """
+        units = []
+        for vertical in self._children(blocks, sequential_id, 'vertical'):
+            videos, resources_urls = [], []
+            pending = [vertical]
+            while pending:
+                block = pending.pop(0)
+                type_ = block.get('type')
+                if type_ == 'video':
+                    videos.append(self.extract_video(block))
+                elif type_ == 'html':
+                    data = block.get('student_view_data') or {}
+                    if not data.get('enabled', 'html' in data):
+                        return None
+                    resources_urls.extend(self.extract_resources_urls(
+                        data.get('html', ''), file_formats))
+                pending.extend(self._children(blocks, block['id']))
+            if videos or resources_urls:
+                units.append(Unit(videos=videos,
+                                  resources_urls=resources_urls))
+        return units
+
+    def extract_video(self, block):
+        """
+        Returns the Video of a video block.
+        """
+        data = block.get('student_view_data') or {}
+        encoded_videos = data.get('encoded_videos') or {}
+        youtube = encoded_videos.get('youtube') or {}
+        mp4_urls = []
+        for encoding in self.VIDEO_ENCODINGS:
+            url = (encoded_videos.get(encoding) or {}).get('url')
+            if url and url.split('?')[0].endswith('.mp4') and \
+                    url not in mp4_urls:
+                mp4_urls.append(url)
+
+        available_subs_url = sub_template_url = None
+        if data.get('transcripts'):
+            handler_url = '%s/courses/%s/xblock/%s/handler/transcript/' % (
+                self.BASE_URL, self.course_id, block['id'])
+            available_subs_url = handler_url + 'available_translations'
+            sub_template_url = handler_url + 'translation/%s'
+
+        return Video(video_youtube_url=youtube.get('url') or None,
+                     available_subs_url=available_subs_url,
+                     sub_template_url=sub_template_url,
+                     mp4_urls=mp4_urls)
+
+    def extract_resources_urls(self, html, file_formats):
+        """
+        Returns the urls of the links of html to files of the given formats
+        or to youtube videos.
+        """
+        formats = '|'.join(file_formats)
+        re_links = re.compile(r'<a\s[^>]*?href=["\']([^"\']*)["\']')
+        re_resource = re.compile(r'.*\.(?:' + formats + ')$')
+        resources_urls = []
+        for url in re_links.findall(html):
+            if is_youtube_url(url):
+                resources_urls.append(url)
+            elif re_resource.match(url):
+                if url.startswith('//'):
+                    url = 'https:' + url
+                elif not url.startswith('http'):
+                    url = self.BASE_URL + url
+                resources_urls.append(url)
+        return resources_urls
+
+
 def get_page_extractor(url):
     """
     factory method for page extractors
@@ -427,3 +663,20 @@ def get_page_extractor(url):
 def is_youtube_url(url):
     re_youtube_url = re.compile(r'(https?\:\/\/(?:www\.)?(?:youtube\.com|youtu\.?be)\/.*?)')
     return re_youtube_url.match(url)
+
+
+# heights of the video in CDN urls, like video_720p.mp4, video-1080.mp4 or
+# video/480/file.mp4
+RE_RENDITION_HEIGHT = re.compile(r'(?<![0-9a-zA-Z])(144|240|360|480|540|576|'
+                                 r'720|1080|1440|2160)p?(?![0-9a-zA-Z])')
+
+
+def rendition_height(url):
+    """
+    Return the height of the video of a CDN url if it can be told from the
+    url, None otherwise.
+    """
+    path = url.split('?', 1)[0].split('://', 1)[-1]
+    path = path.split('/', 1)[1] if '/' in path else ''
+    heights = RE_RENDITION_HEIGHT.findall(path)
+    return int(heights[-1]) if heights else None
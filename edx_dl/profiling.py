@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""
+Profiling of a run, to find where a slow run spends its time or memory.
+
+cProfile only sees the thread that enables it (before python 3.12), so the
+profiler of a run starts a cProfile profiler in every thread started during
+the run (the threads fetching the pages and the downloads) and merges all of
+them into a single pstats file:
+
+    python -m pstats FILE       or any pstats viewer (snakeviz, gprof2dot)
+
+The memory tracer takes a tracemalloc snapshot after each phase of the run
+(outline, extraction, dedup, download) and logs the memory in use and the
+lines that allocated most of the memory during the phase.
+"""
+
+import cProfile
+import logging
+import pstats
+import sys
+import threading
+
+
+# since python 3.12 cProfile uses sys.monitoring, whose events come from
+# all the threads, and only one profiler can be enabled at a time
+PER_THREAD_PROFILES = sys.version_info < (3, 12)
+
+
+class RunProfiler(object):
+    """
+    cProfile profiler of the main thread and of every thread started while
+    it runs.
+    """
+    def __init__(self):
+        self._profiles = []
+        self._lock = threading.Lock()
+
+    def _new_profile(self):
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        return profile
+
+    def _start_thread(self, frame, event, arg):
+        # called by the first event of every new thread, enabling the
+        # profiler of the thread replaces this hook
+        self._new_profile().enable()
+
+    def start(self):
+        if PER_THREAD_PROFILES:
+            threading.setprofile(self._start_thread)
+        self._new_profile().enable()
+
+    def stop(self, filename):
+        """
+        Stop profiling and save the merged profiles of all the threads in
+        filename.
+        """
+        threading.setprofile(None)
+        with self._lock:
+            profiles = list(self._profiles)
+        # the main thread first, the profilers of the threads still running
+        # are disabled by collecting their stats
+        profiles[0].disable()
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            profile.create_stats()
+            if profile.stats:
+                stats.add(profile)
+        stats.dump_stats(filename)
+        logging.info('Profile of %d thread(s) saved in %s', len(profiles),
+                     filename)
+
+
+class MemoryTracer(object):
+    """
+    Traces the memory allocations with tracemalloc and reports the top
+    allocators of each phase of the run.
+    """
+    def __init__(self, limit=10):
+        """
+        @param limit: Number of allocators reported after each phase.
+        @type limit: int
+        """
+        import tracemalloc
+        self._tracemalloc = tracemalloc
+        self.limit = limit
+        self._previous = None
+
+    def start(self):
+        self._tracemalloc.start()
+
+    def stop(self):
+        self._tracemalloc.stop()
+        self._previous = None
+
+    def snapshot(self, phase):
+        """
+        Take a snapshot after phase and log the memory in use and the lines
+        that allocated the most since the previous snapshot.
+        """
+        tracemalloc = self._tracemalloc
+        if not tracemalloc.is_tracing():
+            return
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ])
+        current, peak = tracemalloc.get_traced_memory()
+        logging.info('Memory after %s: %.1f MiB in use, %.1f MiB peak',
+                     phase, current / 1024.0 ** 2, peak / 1024.0 ** 2)
+        if self._previous is None:
+            statistics = snapshot.statistics('lineno')
+        else:
+            statistics = snapshot.compare_to(self._previous, 'lineno')
+        for statistic in statistics[:self.limit]:
+            logging.info('  %s', statistic)
+        self._previous = snapshot
@@ -2,15 +2,60 @@
 # -*- coding: utf-8 -*-
 
 # This module contains generic functions, ideally useful to any other module
-from six.moves.urllib.request import urlopen, Request
-from six.moves import html_parser
+from six.moves.urllib.error import HTTPError, URLError
+from six.moves.urllib.parse import urlparse
+from six.moves import html_parser, http_client
 
+import calendar
+import codecs
+import contextlib
 import errno
+import functools
 import json
 import logging
 import os
+import random
+import socket
 import string
 import subprocess
+import threading
+import time
+import zlib
+
+from email.utils import parsedate_tz
+
+
+
+# HTTP status codes that mean the server wants us to slow down
+THROTTLE_STATUS_CODES = (429, 503)
+
+# HTTP status codes worth retrying, the rest are considered permanent errors
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+try:
+    _ConnectionError = ConnectionError
+except NameError:  # python2
+    _ConnectionError = socket.error
+
+
+class StalledTransferError(IOError):
+    """
+    Raised when the watchdog cancelled a transfer that made no progress.
+    """
+    pass
+
+
+# Network exceptions worth retrying (HTTPError is classified by status code)
+RETRYABLE_EXCEPTIONS = (URLError, socket.timeout, http_client.HTTPException,
+                        _ConnectionError, StalledTransferError)
+
+# Default deadlines (in seconds) for establishing a connection and for
+# waiting on each read from an established one. The watchdog cancels (and
+# the retry policy retries) transfers receiving no bytes before the read
+# deadline is hit, which remains as a backstop for sockets it can't reach.
+DEFAULT_CONNECT_TIMEOUT = 30
+DEFAULT_READ_TIMEOUT = 120
+DEFAULT_STALL_TIMEOUT = 60
 
 
 def get_filename_from_prefix(target_dir, filename_prefix):
@@ -21,7 +66,7 @@ def get_filename_from_prefix(target_dir, filename_prefix):
     # things clearer. A good refactoring would be to get the info from the
     # video_url or the current output, to avoid the iteration from the
     # current dir.
-    filenames = os.listdir(target_dir)
+    filenames = _directory_cache.listing(target_dir)
     for name in filenames:  # Find the filename of the downloaded video
         if name.startswith(filename_prefix):
             basename, _ = os.path.splitext(name)
@@ -32,14 +77,19 @@ def get_filename_from_prefix(target_dir, filename_prefix):
 def execute_command(cmd, args):
     """
     Creates a process with the given command cmd.
+
+    Returns True if the command succeeded and False if it failed and the
+    error was ignored.
     """
     try:
         subprocess.check_call(cmd)
     except subprocess.CalledProcessError as e:
         if args.ignore_errors:
             logging.warn('External command error ignored: %s', e)
+            return False
         else:
             raise e
+    return True
 
 
 def directory_name(initial_name):
@@ -50,18 +100,1199 @@ def directory_name(initial_name):
     return result if result != "" else "course_folder"
 
 
-def get_page_contents(url, headers):
+class AdaptiveLimiter(object):
+    """
+    Concurrency limiter shared by all the network requests (page fetches and
+    downloads).
+
+    The limit follows an AIMD (additive increase, multiplicative decrease)
+    policy: every healthy response grows the limit by roughly one slot per
+    "round" of requests, while a throttling or server error response divides
+    it by two. When the server sends a Retry-After header, no new request is
+    started until that moment has passed.
+    """
+    def __init__(self, initial=4, minimum=1, maximum=16, latency_target=5.0,
+                 decrease_factor=0.5):
+        """
+        @param initial: Number of concurrent requests allowed at start.
+        @type initial: int
+
+        @param minimum: Lower bound of the limit.
+        @type minimum: int
+
+        @param maximum: Upper bound of the limit.
+        @type maximum: int
+
+        @param latency_target: Time to first byte (in seconds) above which a
+            response is not considered healthy, so the limit is not grown.
+        @type latency_target: float
+
+        @param decrease_factor: Factor applied to the limit on 429/5xx.
+        @type decrease_factor: float
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.blocked_until = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """
+        Block until a request slot is available.
+        """
+        with self._cond:
+            while True:
+                wait = self.blocked_until - time.time()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    break
+                self._cond.wait(wait if wait > 0 else None)
+            self.in_flight += 1
+
+    def release(self, latency=None, status=None, retry_after=None):
+        """
+        Free a request slot and adapt the limit to the outcome of the
+        request.
+
+        @param latency: Time (in seconds) the server took to answer.
+        @type latency: float or None
+
+        @param status: HTTP status code of the response, None if the request
+            failed before getting one.
+        @type status: int or None
+
+        @param retry_after: Seconds to wait before starting new requests, as
+            requested by the server.
+        @type retry_after: float or None
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if status is not None and (status in THROTTLE_STATUS_CODES or
+                                       status >= 500):
+                self.limit = max(self.minimum,
+                                 self.limit * self.decrease_factor)
+                logging.debug('Server answered %d, concurrency reduced to %d',
+                              status, int(self.limit))
+            elif (status is not None and status < 400 and
+                  (latency is None or latency <= self.latency_target)):
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+            if retry_after:
+                self.blocked_until = max(self.blocked_until,
+                                         time.time() + retry_after)
+            self._cond.notify_all()
+
+
+_limiter = AdaptiveLimiter()
+
+
+def get_limiter():
+    """
+    Return the limiter of the network requests of the current session, by
+    default the one shared by all the network requests.
+    """
+    session = get_session()
+    if session is not None and session.limiter is not None:
+        return session.limiter
+    return _limiter
+
+
+def set_limiter(limiter):
+    """
+    Replace the limiter shared by all the network requests.
+    """
+    global _limiter
+    _limiter = limiter
+
+
+class Session(object):
+    """
+    Cookies of the requests to a site, and optionally a limiter of its
+    concurrent requests (the shared one otherwise).
+
+    The requests of a thread are made in its current session (see
+    use_session), so sessions with different sites can be used at the same
+    time from different threads.
+    """
+    def __init__(self, limiter=None):
+        self.limiter = limiter
+        self._cookiejar = None
+        self._opener = None
+        self._lock = threading.Lock()
+
+    def _build_opener(self):
+        # imported here since they are slow to import, see _urlopen
+        from six.moves.http_cookiejar import CookieJar
+        from six.moves.urllib.request import (
+            build_opener,
+            HTTPCookieProcessor,
+        )
+        with self._lock:
+            if self._opener is None:
+                self._cookiejar = CookieJar()
+                self._opener = build_opener(
+                    HTTPCookieProcessor(self._cookiejar))
+        return self._opener
+
+    @property
+    def cookiejar(self):
+        self._build_opener()
+        return self._cookiejar
+
+    def open(self, request, timeout):
+        """
+        Open request keeping the cookies of the session.
+        """
+        return (self._opener or self._build_opener()).open(request,
+                                                           timeout=timeout)
+
+
+_sessions = threading.local()
+_default_session = None
+
+
+def get_session():
+    """
+    Return the session of the current thread, by default the default
+    session (None if there is none).
+    """
+    return getattr(_sessions, 'session', None) or _default_session
+
+
+def set_session(session):
+    """
+    Set the session of the current thread.
+    """
+    _sessions.session = session
+
+
+def set_default_session(session):
+    """
+    Set the session of the threads that don't have one.
+    """
+    global _default_session
+    _default_session = session
+
+
+@contextlib.contextmanager
+def use_session(session):
+    """
+    Make the requests of the current thread in session while the block
+    runs.
+    """
+    previous = getattr(_sessions, 'session', None)
+    _sessions.session = session
+    try:
+        yield session
+    finally:
+        _sessions.session = previous
+
+
+def thread_pool(processes=None):
+    """
+    Return a pool of threads whose requests are made in the session of the
+    calling thread, with as many threads as its limiter allows by default.
+    """
+    from multiprocessing.dummy import Pool as ThreadPool
+    return ThreadPool(processes or get_limiter().maximum,
+                      initializer=set_session, initargs=(get_session(),))
+
+
+def parse_retry_after(value):
+    """
+    Return the number of seconds represented by the value of a Retry-After
+    header (either a number of seconds or an HTTP date), or None if the value
+    is missing or invalid.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    timestamp = calendar.timegm(date[:9]) - (date[9] or 0)
+    return max(0.0, timestamp - time.time())
+
+
+class RetryPolicy(object):
+    """
+    Retry policy with exponential backoff and (full) jitter used by every
+    network fetch.
+    """
+    def __init__(self, max_attempts=4, base_delay=1.0, max_delay=60.0):
+        """
+        @param max_attempts: Number of attempts before giving up (1 means
+            no retries at all).
+        @type max_attempts: int
+
+        @param base_delay: Delay (in seconds) of the first retry, it is
+            doubled on each subsequent attempt.
+        @type base_delay: float
+
+        @param max_delay: Upper bound of the delay between attempts.
+        @type max_delay: float
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_retryable(self, exception):
+        """
+        Tell if the given exception is a transient error.
+        """
+        if isinstance(exception, HTTPError):
+            return exception.code in RETRYABLE_STATUS_CODES
+        return isinstance(exception, RETRYABLE_EXCEPTIONS)
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Seconds to wait before the given (1-based) retry attempt.
+        """
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        delay = random.uniform(0, backoff)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func with the given arguments, retrying it on transient errors.
+        """
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                attempt += 1
+                if attempt >= self.max_attempts or not self.is_retryable(e):
+                    raise
+                retry_after = None
+                if isinstance(e, HTTPError):
+                    retry_after = parse_retry_after(e.info().get('Retry-After'))
+                delay = self.delay(attempt, retry_after)
+                logging.warn('Request failed (%s), retrying in %.1fs [%d/%d]',
+                             e, delay, attempt, self.max_attempts - 1)
+                time.sleep(delay)
+
+
+_retry_policy = RetryPolicy()
+
+
+def get_retry_policy():
+    """
+    Return the retry policy used by all the network fetches.
+    """
+    return _retry_policy
+
+
+def set_retry_policy(policy):
+    """
+    Replace the retry policy used by all the network fetches.
+    """
+    global _retry_policy
+    _retry_policy = policy
+
+
+_connect_timeout = DEFAULT_CONNECT_TIMEOUT
+_read_timeout = DEFAULT_READ_TIMEOUT
+
+
+def get_timeouts():
+    """
+    Return the (connect, read) deadlines used by all the network requests.
+    """
+    return _connect_timeout, _read_timeout
+
+
+def set_timeouts(connect, read):
+    """
+    Set the (connect, read) deadlines used by all the network requests.
+    """
+    global _connect_timeout
+    global _read_timeout
+    _connect_timeout = connect
+    _read_timeout = read
+
+
+def _response_socket(response):
+    """
+    Return the socket below the given response, or None if it could not be
+    found. The wrapping objects differ between python versions, so we just
+    walk down the chain of file objects.
+    """
+    obj = response
+    for _ in range(5):
+        if isinstance(obj, socket.socket):
+            return obj
+        obj = (getattr(obj, 'fp', None) or getattr(obj, 'raw', None) or
+               getattr(obj, '_sock', None))
+        if obj is None:
+            break
+    return None
+
+
+class _Transfer(object):
+    """
+    A transfer being watched by the Watchdog.
+    """
+    def __init__(self, response):
+        self.response = response
+        self.last_progress = time.time()
+        self.cancelled = False
+
+    def progress(self):
+        self.last_progress = time.time()
+
+    def cancel(self):
+        """
+        Abort the transfer. Shutting down the socket wakes up a thread
+        blocked reading from it, which closing the response does not.
+        """
+        self.cancelled = True
+        sock = _response_socket(self.response)
+        try:
+            if sock is not None:
+                sock.shutdown(socket.SHUT_RDWR)
+            else:
+                self.response.close()
+        except (socket.error, IOError, OSError):
+            pass
+
+
+class Watchdog(object):
+    """
+    Detects transfers that received no bytes for stall_timeout seconds and
+    cancels them, so that the read fails with a StalledTransferError (which
+    is retried) instead of hanging the thread forever.
+    """
+    def __init__(self, stall_timeout=DEFAULT_STALL_TIMEOUT):
+        """
+        @param stall_timeout: Seconds without receiving any byte after which
+            a transfer is cancelled. None or 0 disables the watchdog.
+        @type stall_timeout: float or None
+        """
+        self.stall_timeout = stall_timeout
+        self._transfers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def watch(self, response):
+        """
+        Start watching the given response and return its transfer object.
+        """
+        transfer = _Transfer(response)
+        if not self.stall_timeout:
+            return transfer
+        with self._lock:
+            self._transfers.add(transfer)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='edx-dl-watchdog')
+                self._thread.daemon = True
+                self._thread.start()
+        return transfer
+
+    def unwatch(self, transfer):
+        """
+        Stop watching the given transfer.
+        """
+        with self._lock:
+            self._transfers.discard(transfer)
+
+    def check(self, now=None):
+        """
+        Cancel the stalled transfers and return them.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            stalled = [t for t in self._transfers
+                       if now - t.last_progress > self.stall_timeout]
+            for transfer in stalled:
+                self._transfers.discard(transfer)
+        for transfer in stalled:
+            logging.warn('Transfer stalled for more than %gs, cancelling it',
+                         self.stall_timeout)
+            transfer.cancel()
+        return stalled
+
+    def _run(self):
+        interval = max(0.1, min(1.0, self.stall_timeout / 4.0))
+        while True:
+            time.sleep(interval)
+            self.check()
+
+
+_watchdog = Watchdog()
+
+
+def set_watchdog(watchdog):
+    """
+    Replace the watchdog of stalled transfers.
+    """
+    global _watchdog
+    _watchdog = watchdog
+
+
+_RATE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_rate(value):
+    """
+    Return the bytes per second of a rate like "500K", "1.5M" or "100000"
+    (the youtube-dl syntax). 0 means no limit and is returned as None.
+    """
+    value = value.strip().upper()
+    unit = value[-1:] if value[-1:] in _RATE_UNITS else ''
+    try:
+        rate = float(value[:len(value) - len(unit)]) * _RATE_UNITS[unit]
+    except ValueError:
+        raise ValueError('Invalid rate: %s' % value)
+    if rate < 0:
+        raise ValueError('Invalid rate: %s' % value)
+    return int(rate) or None
+
+
+def _parse_clock(value):
+    hours, minutes = value.split(':')
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError('Invalid time: %s' % value)
+    return hours * 60 + minutes
+
+
+def parse_rate_schedule(value):
+    """
+    Return the list of (start, end, rate) windows of a schedule like
+    "22:00-06:00=0,12:00-14:00=2M", start and end being minutes since
+    midnight (a window can wrap around midnight) and rate a value of
+    parse_rate.
+    """
+    schedule = []
+    for entry in value.split(','):
+        if not entry.strip():
+            continue
+        try:
+            window, rate = entry.split('=')
+            start, end = window.split('-')
+            schedule.append((_parse_clock(start), _parse_clock(end),
+                             parse_rate(rate)))
+        except ValueError:
+            raise ValueError('Invalid schedule entry: %s' % entry)
+    return schedule
+
+
+class BandwidthLimiter(object):
+    """
+    Token bucket shared by all the transfers, so that together they stay
+    under a bandwidth budget. The rate can change with the time of day.
+    """
+    def __init__(self, rate, schedule=(), burst=1.0):
+        """
+        @param rate: Bytes per second, None for no limit.
+        @type rate: int
+
+        @param schedule: Windows of the day with a different rate, as given
+            by parse_rate_schedule. The first window containing the current
+            time wins.
+        @type schedule: [(int, int, int)]
+
+        @param burst: Seconds worth of bytes that can be consumed at once
+            after a quiet period.
+        @type burst: float
+        """
+        self.rate = rate
+        self.schedule = list(schedule)
+        self.burst = burst
+        self._tokens = 0.0
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def current_rate(self, now=None):
+        """
+        Return the rate (bytes per second, None for no limit) in force at
+        the given timestamp (default: now).
+        """
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        for start, end, rate in self.schedule:
+            if start <= end:
+                inside = start <= minute < end
+            else:
+                inside = minute >= start or minute < end
+            if inside:
+                return rate
+        return self.rate
+
+    def consume(self, nbytes, waiting=None):
+        """
+        Take nbytes from the bucket, sleeping as long as needed to keep the
+        rate. waiting is called every second while sleeping (e.g. to tell
+        the watchdog that the transfer is not stalled).
+        """
+        with self._lock:
+            now = time.time()
+            rate = self.current_rate(now)
+            if rate is None:
+                self._last = now
+                return
+            self._tokens = min(self._tokens + (now - self._last) * rate,
+                               rate * self.burst)
+            self._last = now
+            # the tokens can go negative: the following transfers wait for
+            # the debt to be paid, which keeps the bucket fair across threads
+            self._tokens -= nbytes
+            delay = -self._tokens / rate
+        while delay > 0:
+            time.sleep(min(delay, 1.0))
+            delay -= 1.0
+            if waiting is not None:
+                waiting()
+
+
+_bandwidth_limiter = BandwidthLimiter(None)
+
+
+def get_bandwidth_limiter():
+    """
+    Return the bandwidth limiter shared by all the transfers.
+    """
+    return _bandwidth_limiter
+
+
+def set_bandwidth_limiter(limiter):
+    """
+    Replace the bandwidth limiter shared by all the transfers.
+    """
+    global _bandwidth_limiter
+    _bandwidth_limiter = limiter
+
+
+def read_response(response, write, chunk_size=64 * 1024):
+    """
+    Read the whole body of response calling write with each chunk, under
+    the surveillance of the watchdog.
+    """
+    for chunk in iter_response(response, chunk_size):
+        write(chunk)
+
+
+def iter_response(response, chunk_size=64 * 1024):
+    """
+    Generator of the chunks of the body of response, under the surveillance
+    of the watchdog.
+
+    The chunks are what each read from the socket gives (up to chunk_size
+    bytes), so that the watchdog sees every byte that arrives instead of
+    waiting for a full chunk on slow links.
+    """
+    read = getattr(response, 'read1', None)
+    if read is None:  # python2
+        read = response.read
+        chunk_size = min(chunk_size, 8 * 1024)
+    transfer = _watchdog.watch(response)
+    expected = response.info().get('Content-Length')
+    received = 0
+    try:
+        while True:
+            chunk = read(chunk_size)
+            if not chunk:
+                break
+            received += len(chunk)
+            transfer.progress()
+            _bandwidth_limiter.consume(len(chunk), transfer.progress)
+            yield chunk
+        # reads with a size don't complain when the connection is closed
+        # before the end of the body
+        if expected is not None and expected.isdigit() and \
+                received < int(expected):
+            raise http_client.IncompleteRead(b'', int(expected) - received)
+    except Exception:
+        if transfer.cancelled:
+            raise StalledTransferError('Transfer stalled')
+        raise
+    finally:
+        _watchdog.unwatch(transfer)
+    if transfer.cancelled:
+        raise StalledTransferError('Transfer stalled')
+
+
+class LimitedResponse(object):
+    """
+    Wrapper of a response opened by open_url that keeps its slot in the
+    limiter until the response is closed, so that the limiter bounds the
+    number of transfers and not only the number of connections being set
+    up. The outcome (time to first byte and status) is reported to the
+    limiter when the slot is released.
+    """
+    def __init__(self, response, limiter, start):
+        self._response = response
+        self._limiter = limiter
+        self._start = start
+        self._latency = None
+        self._failed = False
+        self._released = False
+        self.read = functools.partial(self._read, response.read)
+        if hasattr(response, 'read1'):
+            self.read1 = functools.partial(self._read, response.read1)
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def _read(self, read, *args):
+        try:
+            data = read(*args)
+        except Exception:
+            self._failed = True
+            raise
+        if self._latency is None:
+            self._latency = time.time() - self._start
+        return data
+
+    def release(self):
+        """
+        Give back the slot of the response to the limiter (only once).
+        """
+        if self._released:
+            return
+        self._released = True
+        latency = self._latency
+        if latency is None:
+            latency = time.time() - self._start
+        status = None if self._failed else self._response.getcode()
+        self._limiter.release(latency=latency, status=status)
+
+    def close(self):
+        self.release()
+        self._response.close()
+
+
+def _urlopen(request, timeout):
+    session = get_session()
+    if session is not None:
+        return session.open(request, timeout)
+    # urllib.request is imported here since it is slow to import (it
+    # imports ssl) and some runs never get to make a request
+    from six.moves.urllib.request import urlopen
+    return urlopen(request, timeout=timeout)
+
+
+def open_url(request, limiter=None):
+    """
+    Open the given url (or Request) in the current session, waiting for a
+    slot in its limiter. The slot is held until the returned response is
+    closed, so callers must always close it.
+
+    The connection is subject to the connect deadline and every read of
+    the response to the read deadline.
+    """
+    limiter = limiter or get_limiter()
+    limiter.acquire()
+    start = time.time()
+    try:
+        response = _urlopen(request, timeout=_connect_timeout)
+    except HTTPError as e:
+        retry_after = parse_retry_after(e.info().get('Retry-After'))
+        limiter.release(status=e.code, retry_after=retry_after)
+        raise
+    except:
+        limiter.release()
+        raise
+    sock = _response_socket(response)
+    if sock is not None:
+        sock.settimeout(_read_timeout)
+    return LimitedResponse(response, limiter, start)
+
+
+def download_file(url, filename, chunk_size=64 * 1024, new_hash=None):
+    """
+    Download the contents of url into filename, retrying on transient
+    errors.
+
+    If new_hash (a function returning a hashlib object) is given, the
+    contents are hashed while they are written and the hex digest is
+    returned.
+    """
+    return _retry_policy.call(_download_file, url, filename, chunk_size,
+                              new_hash)
+
+
+def _download_file(url, filename, chunk_size, new_hash=None):
+    # the file is written under a temporary name and only moved into place
+    # once complete, so an interrupted transfer never looks like a finished
+    # download
+    partial_filename = filename + '.part'
+    hash_ = new_hash() if new_hash is not None else None
+    start = time.time()
+    received = 0
+    response = open_url(url)
+    try:
+        with open(partial_filename, 'wb') as f:
+            for chunk in iter_response(response, chunk_size):
+                f.write(chunk)
+                received += len(chunk)
+                if hash_ is not None:
+                    hash_.update(chunk)
+    except:
+        if os.path.exists(partial_filename):
+            os.remove(partial_filename)
+        _throughput_tracker.penalize(url_host(url))
+        raise
+    finally:
+        response.close()
+    _throughput_tracker.record(url_host(url), received, time.time() - start)
+    if os.path.exists(filename):  # os.rename doesn't overwrite on Windows
+        os.remove(filename)
+    os.rename(partial_filename, filename)
+    return hash_.hexdigest() if hash_ is not None else None
+
+
+def get_content_length(url):
+    """
+    Return the size in bytes of the contents of url announced by a HEAD
+    request, or None if the server doesn't announce it.
+    """
+    return _retry_policy.call(_get_content_length, url)
+
+
+def _get_content_length(url):
+    from six.moves.urllib.request import Request
+    request = Request(url)
+    request.get_method = lambda: 'HEAD'
+    response = open_url(request)
+    try:
+        length = response.info().get('Content-Length')
+    finally:
+        response.close()
+    try:
+        return int(length)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_free_space(path):
+    """
+    Return the bytes available to the user in the filesystem of path (which
+    may not exist yet), or None if it can't be known (e.g. on Windows).
+    """
+    if not hasattr(os, 'statvfs'):
+        return None
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def url_host(url):
+    """
+    Return the host of url, the unit of the throughput estimates.
+    """
+    return urlparse(url).netloc.lower()
+
+
+class ThroughputTracker(object):
+    """
+    Estimates of the throughput (bytes per second) of the hosts the files
+    are downloaded from, kept across the run as an exponentially weighted
+    moving average of the transfers.
+    """
+    def __init__(self, weight=0.3):
+        """
+        @param weight: Weight of the last transfer in the average.
+        @type weight: float
+        """
+        self.weight = weight
+        self._estimates = {}
+        self._lock = threading.Lock()
+
+    def estimate(self, host):
+        """
+        Return the throughput estimate of host, None if never measured.
+        """
+        return self._estimates.get(host)
+
+    def record(self, host, nbytes, seconds):
+        """
+        Add a transfer of nbytes in the given seconds to the estimate.
+        """
+        rate = nbytes / max(seconds, 1e-3)
+        with self._lock:
+            previous = self._estimates.get(host)
+            if previous is not None:
+                rate = self.weight * rate + (1 - self.weight) * previous
+            self._estimates[host] = rate
+
+    def penalize(self, host):
+        """
+        Halve the estimate of host after a failed transfer.
+        """
+        with self._lock:
+            self._estimates[host] = self._estimates.get(host, 0.0) / 2
+
+
+_throughput_tracker = ThroughputTracker()
+
+
+def get_throughput_tracker():
+    """
+    Return the throughput estimates of the hosts used in this run.
+    """
+    return _throughput_tracker
+
+
+def probe_throughput(url, nbytes=256 * 1024):
+    """
+    Measure the throughput of the host of url with a ranged read of its
+    first nbytes, record it and return it (bytes per second). Servers
+    ignoring the range are cut after nbytes anyway.
+    """
+    from six.moves.urllib.request import Request
+    request = Request(url, headers={'Range': 'bytes=0-%d' % (nbytes - 1)})
+    start = time.time()
+    received = 0
+    response = open_url(request)
+    try:
+        read = getattr(response, 'read1', response.read)
+        while received < nbytes:
+            chunk = read(min(64 * 1024, nbytes - received))
+            if not chunk:
+                break
+            received += len(chunk)
+    finally:
+        response.close()
+    host = url_host(url)
+    _throughput_tracker.record(host, received, time.time() - start)
+    _bandwidth_limiter.consume(received)
+    return _throughput_tracker.estimate(host)
+
+
+_archive = None
+_replay = False
+
+
+def set_archive(archive, replay=False):
+    """
+    Set the page archive (see archive.PageArchive) where the fetched pages
+    are recorded or, if replay is True, from where they are served instead
+    of fetching them. None disables it.
+    """
+    global _archive
+    global _replay
+    _archive = archive
+    _replay = replay
+
+
+class ConditionalCache(object):
+    """
+    Last contents and validators (ETag and Last-Modified) of the pages
+    fetched with conditional requests, so that fetching them again only
+    transfers them if they changed.
+    """
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def validators(self, url):
+        """
+        Return the headers making a request for url conditional.
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+        if entry is None:
+            return {}
+        etag, last_modified, _ = entry
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def contents(self, url):
+        with self._lock:
+            return self._entries[url][2]
+
+    def store(self, url, info, contents):
+        """
+        Keep contents of url if the response info has validators.
+        """
+        etag = info.get('ETag')
+        last_modified = info.get('Last-Modified')
+        if etag or last_modified:
+            with self._lock:
+                self._entries[url] = (etag, last_modified, contents)
+
+
+_conditional_cache = None
+
+
+def set_conditional_cache(cache):
+    """
+    Set the ConditionalCache of the pages fetched with conditional=True,
+    None makes them normal requests.
+    """
+    global _conditional_cache
+    _conditional_cache = cache
+
+
+def get_page_contents(url, headers, conditional=False):
     """
     Get the contents of the page at the URL given by url. While making the
     request, we use the headers given in the dictionary in headers.
+
+    Transient errors are retried following the shared retry policy. If
+    conditional is True and a ConditionalCache is set, the page is only
+    transferred if it changed since it was last fetched.
+    """
+    if _archive is not None and _replay:
+        return _archive.get(url)
+    if conditional and _conditional_cache is not None:
+        page = _retry_policy.call(_get_page_contents_if_modified,
+                                  _conditional_cache, url, headers)
+    else:
+        page = _retry_policy.call(_get_page_contents, url, headers)
+    if _archive is not None:
+        _archive.put(url, page)
+    return page
+
+
+def _get_charset(response):
+    """
+    Return the charset of the response, utf-8 if not given.
     """
-    result = urlopen(Request(url, None, headers))
     try:
         # for python3
-        charset = result.headers.get_content_charset(failobj="utf-8")
+        return response.headers.get_content_charset(failobj="utf-8")
     except:
-        charset = result.info().getparam('charset') or 'utf-8'
-    return result.read().decode(charset)
+        return response.info().getparam('charset') or 'utf-8'
+
+
+_brotli = []
+
+
+def _get_brotli():
+    """
+    Return the (optional) brotli module, or None if it is not installed. It
+    is only imported the first time it is needed.
+    """
+    if not _brotli:
+        try:
+            import brotli
+        except ImportError:
+            brotli = None
+        _brotli.append(brotli)
+    return _brotli[0]
+
+
+def accepted_encodings():
+    """
+    Return the content encodings we can decompress, sent in the
+    Accept-Encoding header of the page requests.
+    """
+    return ['gzip', 'deflate'] + (['br'] if _get_brotli() else [])
+
+
+class TransferStats(object):
+    """
+    Thread safe counters of the bytes of the pages received on the wire and
+    after decompressing them.
+    """
+    def __init__(self):
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, wire_bytes, decoded_bytes):
+        with self._lock:
+            self.wire_bytes += wire_bytes
+            self.decoded_bytes += decoded_bytes
+
+    def saved_ratio(self):
+        """
+        Return the fraction of bytes saved by the compression.
+        """
+        if self.decoded_bytes == 0:
+            return 0.0
+        return 1.0 - float(self.wire_bytes) / self.decoded_bytes
+
+
+transfer_stats = TransferStats()
+
+
+class _IdentityDecoder(object):
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+class _DeflateDecoder(object):
+    """
+    Decoder of the deflate content encoding. Some servers send raw deflate
+    streams instead of zlib ones, so we switch to raw mode if the zlib
+    header is not there.
+    """
+    def __init__(self):
+        self._decoder = zlib.decompressobj()
+        self._first = True
+
+    def decompress(self, data):
+        if self._first:
+            self._first = False
+            try:
+                return self._decoder.decompress(data)
+            except zlib.error:
+                self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decoder.decompress(data)
+
+    def flush(self):
+        return self._decoder.flush()
+
+
+class _BrotliDecoder(object):
+    def __init__(self):
+        self._decoder = _get_brotli().Decompressor()
+
+    def decompress(self, data):
+        return self._decoder.process(data)
+
+    def flush(self):
+        return b''
+
+
+def _content_decoder(encoding):
+    """
+    Return a streaming decoder for the given Content-Encoding.
+    """
+    encoding = (encoding or 'identity').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        decoder = _DeflateDecoder()
+    elif encoding == 'br' and _get_brotli() is not None:
+        decoder = _BrotliDecoder()
+    elif encoding == 'identity':
+        decoder = _IdentityDecoder()
+    else:
+        raise ValueError('Unsupported content encoding: %s' % encoding)
+    return decoder
+
+
+def iter_decoded_response(response, chunk_size=64 * 1024):
+    """
+    Generator of the chunks of the body of response, decompressed according
+    to its Content-Encoding while it is streamed. The transfer_stats are
+    updated with the bytes received and produced.
+    """
+    decoder = _content_decoder(response.info().get('Content-Encoding'))
+    wire_bytes = decoded_bytes = 0
+    try:
+        for chunk in iter_response(response, chunk_size):
+            wire_bytes += len(chunk)
+            data = decoder.decompress(chunk)
+            if data:
+                decoded_bytes += len(data)
+                yield data
+        data = decoder.flush()
+        if data:
+            decoded_bytes += len(data)
+            yield data
+    finally:
+        transfer_stats.add(wire_bytes, decoded_bytes)
+
+
+def _page_request(url, headers):
+    """
+    Build the request of a page, asking for a compressed response.
+    """
+    headers = dict(headers)
+    headers['Accept-Encoding'] = ', '.join(accepted_encodings())
+    from six.moves.urllib.request import Request
+    return Request(url, None, headers)
+
+
+def iter_page_contents(url, headers, chunk_size=64 * 1024):
+    """
+    Generator of the decoded contents of the page at the URL given by url,
+    in chunks of text. The page is decoded incrementally, so the full page
+    is never held in memory.
+
+    Unlike get_page_contents, transient errors are not retried here since
+    part of the page may already have been consumed, the caller should
+    retry the whole processing of the page instead.
+    """
+    if _archive is None:
+        return _iter_page_contents(url, headers, chunk_size)
+    if _replay:
+        return _archive.iter_text(url, chunk_size)
+    return _iter_and_record(_archive, url,
+                            _iter_page_contents(url, headers, chunk_size))
+
+
+def _iter_and_record(archive, url, chunks):
+    """
+    Pass the chunks of the page of url through, recording them in the
+    archive. The page is recorded only if all of it was read.
+    """
+    writer = archive.writer(url)
+    try:
+        for chunk in chunks:
+            writer.write(chunk)
+            yield chunk
+    except:
+        writer.abort()
+        raise
+    else:
+        writer.close()
+
+
+def _iter_page_contents(url, headers, chunk_size):
+    result = open_url(_page_request(url, headers))
+    try:
+        decoder = codecs.getincrementaldecoder(_get_charset(result))()
+        for chunk in iter_decoded_response(result, chunk_size):
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+        text = decoder.decode(b'', final=True)
+        if text:
+            yield text
+    finally:
+        result.close()
+
+
+def _get_page_contents(url, headers, response_info=None):
+    result = open_url(_page_request(url, headers))
+    charset = _get_charset(result)
+    chunks = []
+    try:
+        for chunk in iter_decoded_response(result):
+            chunks.append(chunk)
+    finally:
+        result.close()
+    if response_info is not None:
+        response_info.append(result.info())
+    return b''.join(chunks).decode(charset)
+
+
+def _get_page_contents_if_modified(cache, url, headers):
+    conditional_headers = dict(headers)
+    conditional_headers.update(cache.validators(url))
+    response_info = []
+    try:
+        page = _get_page_contents(url, conditional_headers, response_info)
+    except HTTPError as e:
+        if e.code != 304:
+            raise
+        logging.debug('Not modified: %s', url)
+        return cache.contents(url)
+    cache.store(url, response_info[0], page)
+    return page
 
 
 def get_page_contents_as_json(url, headers):
@@ -97,6 +1328,117 @@ def remove_duplicates(orig_list, seen=set()):
 
 
 # The next functions come from coursera-dl/coursera
+class _ListedFile(object):
+    """
+    Entry of a directory listing on python versions without os.scandir.
+    """
+    def __init__(self, directory, name):
+        self.path = os.path.join(directory, name)
+        self._stat = None
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+
+class DirectoryCache(object):
+    """
+    Listings of the output directories, read once per directory so that
+    checking whether thousands of files were already downloaded doesn't
+    cost one round trip per file (which is slow on network filesystems).
+
+    The entries stat their file at most once (os.scandir gets the stat for
+    free on some platforms), and callers keep the listings up to date
+    through add() and forget() when they create files.
+    """
+    def __init__(self):
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def listing(self, directory):
+        """
+        Return a dict {name: entry} of the files in directory (empty if it
+        doesn't exist), the entries having is_dir() and stat() methods.
+        """
+        directory = os.path.normpath(directory)
+        with self._lock:
+            listing = self._listings.get(directory)
+            if listing is None:
+                listing = self._listings[directory] = self._read(directory)
+            return listing
+
+    @staticmethod
+    def _read(directory):
+        try:
+            scandir = getattr(os, 'scandir', None)
+            if scandir is not None:
+                return dict((entry.name, entry) for entry in scandir(directory))
+            return dict((name, _ListedFile(directory, name))
+                        for name in os.listdir(directory))
+        except OSError as exc:
+            if exc.errno in (errno.ENOENT, errno.ENOTDIR):
+                return {}
+            raise
+
+    def exists(self, path):
+        directory, name = os.path.split(path)
+        return name in self.listing(directory or os.curdir)
+
+    def is_dir(self, path):
+        directory, name = os.path.split(os.path.normpath(path))
+        entry = self.listing(directory or os.curdir).get(name)
+        return entry is not None and entry.is_dir()
+
+    def size(self, path):
+        """
+        Return the size of the file at path, or None if it doesn't exist.
+        """
+        directory, name = os.path.split(path)
+        entry = self.listing(directory or os.curdir).get(name)
+        return entry.stat().st_size if entry is not None else None
+
+    def add(self, path):
+        """
+        Record that path was created (or removed) since it was listed.
+        """
+        directory, name = os.path.split(os.path.normpath(path))
+        directory = directory or os.curdir
+        with self._lock:
+            listing = self._listings.get(directory)
+            if listing is None:
+                return
+            if os.path.lexists(path):
+                listing[name] = _ListedFile(directory, name)
+            else:
+                listing.pop(name, None)
+
+    def forget(self, directory):
+        """
+        Drop the listing of directory, e.g. after an external program wrote
+        files of unknown names in it.
+        """
+        with self._lock:
+            self._listings.pop(os.path.normpath(directory), None)
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
+
+
+_directory_cache = DirectoryCache()
+
+
+def get_directory_cache():
+    """
+    Return the cache of the listings of the output directories.
+    """
+    return _directory_cache
+
+
 def mkdir_p(path, mode=0o777):
     """
     Create subdirectory hierarchy given in the paths argument.
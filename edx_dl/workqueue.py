@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+"""
+Work queue shared by several edx-dl processes on the same host.
+
+One process plans the run and adds its downloads to the queue, any number of
+worker processes then lease the downloads one at a time, download them and
+mark them as done. The queue is a sqlite database in WAL mode, so the
+workers don't block each other while reading it and every change is an
+atomic transaction. A lease expires if its worker doesn't renew it (e.g.
+because it crashed) and the download is then given to another worker.
+"""
+
+import contextlib
+import sqlite3
+import threading
+import time
+
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+DEFAULT_LEASE_TIMEOUT = 600
+DEFAULT_MAX_ATTEMPTS = 3
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL,
+    filename TEXT NOT NULL UNIQUE,
+    kind TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+)
+'''
+
+
+class Job(object):
+    """
+    A download leased from the queue.
+    """
+    __slots__ = ('id', 'url', 'filename', 'kind')
+
+    def __init__(self, id, url, filename, kind):
+        self.id = id
+        self.url = url
+        self.filename = filename
+        self.kind = kind
+
+    def __repr__(self):
+        return self.url + " => " + self.filename
+
+
+class WorkQueue(object):
+    """
+    Queue of (url, filename, kind) downloads stored in a sqlite database.
+    """
+    def __init__(self, filename, lease_timeout=DEFAULT_LEASE_TIMEOUT,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+        @param filename: Filename of the database, created if needed.
+        @type filename: str
+
+        @param lease_timeout: Seconds a lease lasts unless it is renewed.
+        @type lease_timeout: float
+
+        @param max_attempts: Attempts of a download before it is marked as
+            failed.
+        @type max_attempts: int
+        """
+        self.filename = filename
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self._db = self._connect()
+        with self._transaction() as db:
+            db.execute(_SCHEMA)
+
+    def _connect(self):
+        # autocommit mode, the transactions are opened explicitly
+        db = sqlite3.connect(self.filename, timeout=60,
+                             isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        return db
+
+    @contextlib.contextmanager
+    def _transaction(self, db=None):
+        """
+        Run a write transaction, taking the write lock from the beginning
+        so that two workers never lease the same job.
+        """
+        db = db or self._db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except:
+            db.execute('ROLLBACK')
+            raise
+        else:
+            db.execute('COMMIT')
+
+    def close(self):
+        self._db.close()
+
+    def add(self, downloads):
+        """
+        Add the (url, filename, kind) downloads, ignoring the filenames
+        already in the queue. Returns the number of downloads added.
+        """
+        with self._transaction() as db:
+            before = db.total_changes
+            db.executemany('INSERT OR IGNORE INTO jobs (url, filename, kind) '
+                           'VALUES (?, ?, ?)', downloads)
+            return db.total_changes - before
+
+    def lease(self, worker, now=None):
+        """
+        Lease the next pending download (or one whose lease expired) to
+        worker. Returns the Job, or None if there is nothing to lease.
+        """
+        now = time.time() if now is None else now
+        with self._transaction() as db:
+            row = db.execute('SELECT id, url, filename, kind FROM jobs '
+                             'WHERE state = ? OR (state = ? AND '
+                             'lease_until < ?) ORDER BY id LIMIT 1',
+                             (PENDING, LEASED, now)).fetchone()
+            if row is None:
+                return None
+            db.execute('UPDATE jobs SET state = ?, worker = ?, '
+                       'lease_until = ?, attempts = attempts + 1 '
+                       'WHERE id = ?',
+                       (LEASED, worker, now + self.lease_timeout, row[0]))
+        return Job(*row)
+
+    def renew(self, job, worker, db=None):
+        """
+        Extend the lease of job, returns False if the worker lost it.
+        """
+        with self._transaction(db) as db:
+            cursor = db.execute('UPDATE jobs SET lease_until = ? '
+                                'WHERE id = ? AND worker = ? AND state = ?',
+                                (time.time() + self.lease_timeout, job.id,
+                                 worker, LEASED))
+            return cursor.rowcount == 1
+
+    def complete(self, job, worker):
+        """
+        Mark job as done.
+        """
+        with self._transaction() as db:
+            db.execute('UPDATE jobs SET state = ?, lease_until = NULL '
+                       'WHERE id = ? AND worker = ?', (DONE, job.id, worker))
+
+    def fail(self, job, worker, retry=True):
+        """
+        Give job back to the queue, or mark it as failed if retry is False
+        or it already had all its attempts.
+        """
+        with self._transaction() as db:
+            db.execute('UPDATE jobs SET state = CASE WHEN ? AND '
+                       'attempts < ? THEN ? ELSE ? END, lease_until = NULL '
+                       'WHERE id = ? AND worker = ?',
+                       (retry, self.max_attempts, PENDING, FAILED, job.id,
+                        worker))
+
+    def counts(self):
+        """
+        Return a dict {state: number of downloads}.
+        """
+        return dict(self._db.execute('SELECT state, COUNT(*) FROM jobs '
+                                     'GROUP BY state').fetchall())
+
+    def failures(self):
+        """
+        Return the (url, filename, kind) of the failed downloads.
+        """
+        return self._db.execute('SELECT url, filename, kind FROM jobs '
+                                'WHERE state = ? ORDER BY id',
+                                (FAILED,)).fetchall()
+
+    @contextlib.contextmanager
+    def keep_leased(self, job, worker):
+        """
+        Renew the lease of job in the background while the block runs, for
+        downloads lasting longer than the lease.
+        """
+        stop = threading.Event()
+
+        def renew():
+            db = self._connect()
+            try:
+                while not stop.wait(self.lease_timeout / 3.0):
+                    self.renew(job, worker, db)
+            finally:
+                db.close()
+
+        thread = threading.Thread(target=renew)
+        thread.daemon = True
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
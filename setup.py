@@ -95,7 +95,8 @@ setup(
 
     install_requires=requirements,
     extras_require=dict(
-        dev=dev_requirements
+        dev=dev_requirements,
+        brotli=['brotli'],
     ),
 
     description='Simple tool to download video and lecture materials from edx.org.',
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+
+import pytest
+
+from edx_dl import utils
+from edx_dl.archive import PageArchive, PageNotArchivedError
+
+
+def test_put_and_get(tmpdir):
+    archive = PageArchive(str(tmpdir))
+    archive.put('http://a', 'caf\xe9 ' * 10000)
+    assert archive.get('http://a') == 'caf\xe9 ' * 10000
+    assert list(archive.iter_text('http://a', chunk_size=10))[0] != ''
+
+
+def test_content_addressed(tmpdir):
+    archive = PageArchive(str(tmpdir))
+    archive.put('http://a', 'same page')
+    archive.put('http://b', 'same page')
+    objects = [f for _, _, files in os.walk(archive.objects_dir)
+               for f in files]
+    assert len(objects) == 1
+
+
+def test_index_is_persistent(tmpdir):
+    archive = PageArchive(str(tmpdir))
+    archive.put('http://a', 'first')
+    archive.put('http://a', 'second')
+
+    archive = PageArchive(str(tmpdir))
+    assert len(archive) == 1
+    assert archive.get('http://a') == 'second'
+
+
+def test_missing_page(tmpdir):
+    archive = PageArchive(str(tmpdir))
+    with pytest.raises(PageNotArchivedError):
+        archive.get('http://missing')
+
+
+def test_aborted_pages_are_not_recorded(tmpdir):
+    archive = PageArchive(str(tmpdir))
+
+    def failing_chunks():
+        yield 'partial'
+        raise IOError('connection lost')
+
+    with pytest.raises(IOError):
+        list(utils._iter_and_record(archive, 'http://a', failing_chunks()))
+    assert 'http://a' not in archive
+    assert os.listdir(archive.objects_dir) == []
+
+
+def test_replay_serves_pages_from_archive(tmpdir):
+    archive = PageArchive(str(tmpdir))
+    archive.put('http://a', 'archived page')
+    utils.set_archive(archive, replay=True)
+    try:
+        assert utils.get_page_contents('http://a', {}) == 'archived page'
+        assert ''.join(utils.iter_page_contents('http://a', {})) == 'archived page'
+    finally:
+        utils.set_archive(None)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+
+import pytest
+
+from edx_dl import checksums
+
+
+def _record(directory, name, contents):
+    filename = str(directory.join(name))
+    with open(filename, 'wb') as f:
+        f.write(contents)
+    checksums.record_checksum(filename,
+                              hashlib.sha256(contents).hexdigest())
+    return filename
+
+
+def test_record_and_read_manifest(tmpdir):
+    _record(tmpdir, 'a.pdf', b'first')
+    _record(tmpdir, 'a.pdf', b'second')
+    manifest = checksums.read_manifest(str(tmpdir))
+    assert list(manifest) == ['a.pdf']
+    assert manifest['a.pdf']['size'] == 6
+    assert manifest['a.pdf']['sha256'] == hashlib.sha256(b'second').hexdigest()
+
+
+@pytest.mark.parametrize('full', [False, True])
+def test_verify(tmpdir, full):
+    section = tmpdir.mkdir('section')
+    _record(section, 'ok.pdf', b'fine')
+    missing = _record(section, 'missing.pdf', b'gone')
+    truncated = _record(section, 'truncated.mp4', b'0123456789')
+    corrupt = _record(section, 'corrupt.mp4', b'0123456789')
+    silent = _record(section, 'silent.mp4', b'0123456789')
+
+    os.remove(missing)
+    with open(truncated, 'wb') as f:
+        f.write(b'01234')
+    # same size, modification time changed: rehashed by the quick mode
+    with open(corrupt, 'wb') as f:
+        f.write(b'9876543210')
+    os.utime(corrupt, (0, 0))
+    # same size and modification time: only found by the full mode
+    stat = os.stat(silent)
+    with open(silent, 'wb') as f:
+        f.write(b'xxxxxxxxxx')
+    os.utime(silent, (stat.st_atime, stat.st_mtime))
+
+    results = dict(checksums.verify(str(tmpdir), full=full, processes=2))
+
+    assert results[str(section.join('ok.pdf'))] == checksums.OK
+    assert results[missing] == checksums.MISSING
+    assert results[truncated] == checksums.WRONG_SIZE
+    assert results[corrupt] == checksums.WRONG_CHECKSUM
+    assert results[silent] == (checksums.WRONG_CHECKSUM if full
+                               else checksums.OK)
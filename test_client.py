@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from edx_dl import edx_dl
+from edx_dl.client import EdxClient
+from edx_dl.common import (
+    Course,
+    EdxDlError,
+    ExitCode,
+    PlannedDownload,
+    Section,
+    SubSection,
+    Unit,
+    Video,
+)
+
+
+COURSES = [
+    Course(id='c1', name='One', url='http://x/courses/c1/info',
+           state='Started'),
+    Course(id='c2', name='Two', url='http://x/courses/c2/info',
+           state='Not yet'),
+]
+
+SECTIONS = [Section(position=1, name='Intro', url='http://x/s',
+                    subsections=[SubSection(position=1, name='A',
+                                            url='http://x/a'),
+                                 SubSection(position=2, name='B',
+                                            url='http://x/b')])]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # clean_filename relies on HTMLParser.unescape, gone in python >= 3.9
+    monkeypatch.setattr(edx_dl, 'clean_filename', lambda name: name)
+    monkeypatch.setattr(edx_dl, 'directory_name', lambda name: name)
+    monkeypatch.setattr(edx_dl, 'login',
+                        lambda username, password: {'session': username})
+    monkeypatch.setattr(edx_dl, 'get_courses_info',
+                        lambda url, headers: COURSES)
+    requested = []
+
+    def get_available_sections(url, headers):
+        requested.append(url)
+        return SECTIONS
+
+    def extract_units(url, headers, file_formats):
+        video = Video(video_youtube_url=None, available_subs_url=None,
+                      sub_template_url=None, mp4_urls=['http://cdn/v.mp4'])
+        return [Unit(videos=[video],
+                     resources_urls=['http://x/notes.pdf'])]
+
+    monkeypatch.setattr(edx_dl, 'get_available_sections',
+                        get_available_sections)
+    monkeypatch.setattr(edx_dl, 'extract_units', extract_units)
+    client = EdxClient('user', 'secret')
+    client.requested = requested
+    return client
+
+
+def test_unknown_platform_raises():
+    with pytest.raises(EdxDlError) as excinfo:
+        EdxClient('user', 'secret', platform='nowhere')
+    assert excinfo.value.exit_code == ExitCode.UNKNOWN_PLATFORM
+
+
+def test_list_and_select_courses(client):
+    assert client.headers == {'session': 'user'}
+    assert client.list_courses() == COURSES[:1]
+    assert client.list_courses(started_only=False) == COURSES
+    assert client.select_courses(['http://x/courses/c1/info']) == COURSES[:1]
+    with pytest.raises(EdxDlError) as excinfo:
+        client.select_courses(['http://x/courses/c2/info'])
+    assert excinfo.value.exit_code == ExitCode.INVALID_COURSE_URL
+
+
+def test_outline_and_units(client):
+    assert client.outline(COURSES[0]) == SECTIONS
+    assert client.requested == ['http://x/courses/c1/course']
+    units = client.iter_units(['http://x/a', 'http://x/b'])
+    assert sorted(url for url, _ in units) == ['http://x/a', 'http://x/b']
+
+
+def test_plan_downloads(client, tmpdir):
+    planned = client.plan_downloads({COURSES[0]: SECTIONS},
+                                    output_dir=str(tmpdir),
+                                    prefer_cdn_videos=True)
+    # both subsections have the same resources, they are planned once
+    assert sorted((p.kind, p.url) for p in planned) == [
+        (PlannedDownload.RESOURCE, 'http://x/notes.pdf'),
+        (PlannedDownload.VIDEO, 'http://cdn/v.mp4')]
+
+
+def test_plan_downloads_without_units(client):
+    with pytest.raises(EdxDlError) as excinfo:
+        client.plan_downloads({COURSES[0]: SECTIONS},
+                              all_units={'http://x/a': [], 'http://x/b': []})
+    assert excinfo.value.exit_code == ExitCode.NO_DOWNLOADABLE_VIDEO
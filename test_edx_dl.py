@@ -1,14 +1,35 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import json
+import os
+import subprocess
+import sys
+import threading
+
+from email.message import Message
+
 import pytest
+from six.moves import BaseHTTPServer
+from six.moves.urllib.error import HTTPError
+
 from edx_dl import edx_dl, parsing
-from edx_dl.common import Unit, Video, DEFAULT_FILE_FORMATS
+from edx_dl.common import (
+    Course,
+    PlannedDownload,
+    Section,
+    SubSection,
+    Unit,
+    Video,
+    DEFAULT_FILE_FORMATS,
+)
+from edx_dl.utils import ThroughputTracker
 
 
 def test_failed_login():
     resp = edx_dl.edx_login(
-        edx_dl.LOGIN_API, edx_dl.edx_get_headers(), "guest", "guest")
+        edx_dl.get_site().login_api, edx_dl.edx_get_headers(), "guest",
+        "guest")
     assert not resp.get('success', False)
 
 
@@ -149,3 +170,724 @@ def test_extract_subtitle_urls():
     actual = page_extractor.extract_subtitle_urls(text, "https://base.url")
     print("actual", actual)
     assert expected == actual
+
+
+def test_failures_file_roundtrip(tmpdir):
+    failures = [('http://example.com/a.pdf', 'Downloaded/a.pdf', 'url'),
+                ('http://example.com/sub', 'Downloaded/a.en.srt', 'subtitle')]
+    filename = str(tmpdir.join('failures'))
+    edx_dl.write_failures_file(failures, filename)
+    assert edx_dl.read_failures_file(filename) == failures
+
+
+def test_retry_deferred_downloads(monkeypatch, tmpdir):
+    attempts = []
+
+    def mock_download_url(url, filename, headers, args):
+        attempts.append(url)
+        if url.endswith('bad'):
+            edx_dl._defer_download(url, filename, 'url')
+
+    monkeypatch.setattr(edx_dl, 'download_url', mock_download_url)
+    edx_dl._defer_download('http://example.com/good', str(tmpdir.join('g')), 'url')
+    edx_dl._defer_download('http://example.com/bad', str(tmpdir.join('b')), 'url')
+
+    failures = edx_dl.retry_deferred_downloads({}, None)
+
+    assert attempts == ['http://example.com/good', 'http://example.com/bad']
+    assert failures == [('http://example.com/bad', str(tmpdir.join('b')), 'url')]
+    assert edx_dl.retry_deferred_downloads({}, None) == []
+
+
+def test_cache_roundtrip_keeps_compact_units(tmpdir, all_units):
+    filename = str(tmpdir.join('cache'))
+    edx_dl.write_units_to_cache(all_units, filename)
+
+    def no_extraction(urls, headers, file_formats):
+        assert urls == []
+        return {}
+
+    cached = edx_dl.extract_all_units_with_cache(list(all_units.keys()), {},
+                                                 DEFAULT_FILE_FORMATS,
+                                                 filename=filename,
+                                                 extractor=no_extraction)
+    unit = cached['nonempty_section'][2]
+    assert not hasattr(unit, '__dict__')
+    assert unit.resources_urls == ('3',)
+    assert unit.videos[0].mp4_urls == ('1', '2')
+
+
+def test_dedup_units_counts(all_units):
+    all_units['repeated_section'] = [
+        Unit(videos=[Video(video_youtube_url='https://youtube.com/watch?v=x',
+                           available_subs_url='subs',
+                           sub_template_url='template',
+                           mp4_urls=['1', '4'])],
+             resources_urls=['3', '5']),
+        Unit(videos=[], resources_urls=['5']),
+    ]
+    filtered_units, num_all_urls, num_filtered_urls = \
+        edx_dl.dedup_units(all_units)
+
+    assert num_all_urls == edx_dl.num_urls_in_units_dict(all_units)
+    assert num_filtered_urls == edx_dl.num_urls_in_units_dict(filtered_units)
+    assert num_all_urls - num_filtered_urls == 3
+
+    urls = [url for units in filtered_units.values() for unit in units
+            for url in unit.resources_urls +
+            tuple(u for video in unit.videos for u in video.mp4_urls)]
+    assert sorted(urls) == ['1', '2', '3', '4', '5']
+    # units without repeated urls are not rebuilt
+    assert filtered_units['nonempty_section'][0] is all_units['nonempty_section'][2]
+
+
+def _http_error(code):
+    return HTTPError('http://example.com', code, 'error', Message(), None)
+
+
+@pytest.mark.parametrize('code,deferred', [(404, False), (503, True)])
+def test_download_subtitle_defers_only_transient_errors(monkeypatch, tmpdir,
+                                                        code, deferred):
+    def failing_fetch_subtitle(url, headers):
+        raise _http_error(code)
+
+    monkeypatch.setattr(edx_dl, '_fetch_subtitle', failing_fetch_subtitle)
+    filename = str(tmpdir.join('a.en.srt'))
+    edx_dl.download_subtitle('http://example.com/sub', filename, {}, None)
+
+    failures = edx_dl.retry_deferred_downloads({}, None) if deferred else []
+    assert edx_dl._deferred_downloads == []
+    assert len(failures) == int(deferred)
+
+
+def test_finish_downloads_removes_stale_failures_file(tmpdir):
+    class Args(object):
+        dry_run = False
+        failures_file = str(tmpdir.join('failures'))
+
+    edx_dl.write_failures_file([('u', 'f', 'url')], Args.failures_file)
+    edx_dl._finish_downloads({}, Args)
+    assert not os.path.exists(Args.failures_file)
+
+
+def _planning_args(output_dir, prefer_cdn_videos=True, subtitles=False):
+    class Args(object):
+        pass
+    args = Args()
+    args.output_dir = output_dir
+    args.prefer_cdn_videos = prefer_cdn_videos
+    args.subtitles = subtitles
+    args.cdn_quality = 'best'
+    args.shard = None
+    return args
+
+
+@pytest.fixture
+def plain_filenames(monkeypatch):
+    # clean_filename relies on HTMLParser.unescape, gone in python >= 3.9
+    monkeypatch.setattr(edx_dl, 'clean_filename', lambda name: name)
+    monkeypatch.setattr(edx_dl, 'directory_name', lambda name: name)
+
+
+def _planning_selections():
+    course = Course(id='c', name='Course', url='http://x/c', state='Started')
+    section = Section(position=1, name='Intro', url='http://x/s',
+                      subsections=[SubSection(position=1, name='A',
+                                              url='http://x/a'),
+                                   SubSection(position=2, name='B',
+                                              url='http://x/b')])
+    all_units = {
+        'http://x/a': [Unit(videos=[Video(video_youtube_url='https://youtube.com/watch?v=x',
+                                          available_subs_url='http://x/subs',
+                                          sub_template_url='http://x/sub/%s',
+                                          mp4_urls=['http://cdn/v.mp4'])],
+                            resources_urls=['http://x/notes.pdf'])],
+        'http://x/b': [Unit(videos=[], resources_urls=['http://x/slides.pdf'])],
+    }
+    return {course: [section]}, all_units
+
+
+def test_iter_planned_downloads(monkeypatch, plain_filenames):
+    monkeypatch.setattr(edx_dl, 'get_subtitles_urls',
+                        lambda available, template, headers:
+                        {'en': 'http://x/sub/en'})
+    selections, all_units = _planning_selections()
+    target_dir = os.path.join('out', 'Course', '01-Intro')
+
+    planned = list(edx_dl.iter_planned_downloads(
+        _planning_args('out', subtitles=True), selections, all_units, {}))
+
+    assert [(p.url, p.target_dir, p.filename, p.kind) for p in planned] == [
+        ('http://cdn/v.mp4', target_dir, '01-v.mp4', PlannedDownload.VIDEO),
+        ('http://x/sub/en', target_dir, '01-v.en.json',
+         PlannedDownload.SUBTITLE),
+        ('http://x/notes.pdf', target_dir, '01-notes.pdf',
+         PlannedDownload.RESOURCE),
+        ('http://x/slides.pdf', target_dir, '02-slides.pdf',
+         PlannedDownload.RESOURCE),
+    ]
+
+    planned = list(edx_dl.iter_planned_downloads(
+        _planning_args('out', prefer_cdn_videos=False), selections,
+        all_units, {}))
+    assert planned[0].url == 'https://youtube.com/watch?v=x'
+    assert planned[0].filename == '01-%(title)s-%(id)s.%(ext)s'
+
+
+@pytest.mark.parametrize('format_', ['aria2c', 'jsonl'])
+def test_save_manifest(tmpdir, plain_filenames, format_):
+    selections, all_units = _planning_selections()
+    planned = edx_dl.iter_planned_downloads(
+        _planning_args('out', prefer_cdn_videos=False), selections,
+        all_units, {})
+    filename = str(tmpdir.join('manifest'))
+
+    written = edx_dl.save_manifest(planned, format_, filename)
+
+    with open(filename) as f:
+        contents = f.read()
+    target_dir = os.path.join('out', 'Course', '01-Intro')
+    if format_ == 'aria2c':
+        # aria2c can't download youtube videos
+        assert written == 2
+        assert contents == ('http://x/notes.pdf\n  dir=%s\n  out=01-notes.pdf\n'
+                            'http://x/slides.pdf\n  dir=%s\n  out=02-slides.pdf\n'
+                            % (target_dir, target_dir))
+    else:
+        records = [json.loads(line) for line in contents.splitlines()]
+        assert written == 3
+        assert records[1] == {'url': 'http://x/notes.pdf', 'dir': target_dir,
+                              'filename': '01-notes.pdf', 'kind': 'resource'}
+        assert records[0]['kind'] == 'video'
+
+
+def test_size_planning(tmpdir, plain_filenames):
+    selections, all_units = _planning_selections()
+    args = _planning_args(str(tmpdir), prefer_cdn_videos=False)
+    planned = list(edx_dl.iter_planned_downloads(args, selections,
+                                                 all_units, {}))
+    sizes = {'http://x/notes.pdf': 100, 'http://x/slides.pdf': None}
+    # already downloaded files don't count
+    target_dir = tmpdir.join('Course', '01-Intro')
+    target_dir.ensure(dir=True)
+    assert edx_dl.report_sizes(planned, sizes) == 100
+    target_dir.join('01-notes.pdf').write('x')
+    # the listings of the directories are read once per run
+    edx_dl.get_directory_cache().clear()
+    assert edx_dl.report_sizes(planned, sizes) == 0
+
+    sizes['http://x/slides.pdf'] = 10
+    assert [p.url for p in edx_dl.sort_by_size(planned, sizes, 'smallest')] \
+        == ['http://x/slides.pdf', 'http://x/notes.pdf']
+    assert [p.url for p in edx_dl.sort_by_size(planned, sizes, 'largest')] \
+        == ['http://x/notes.pdf', 'http://x/slides.pdf']
+
+    assert edx_dl.has_free_space(str(tmpdir), 0)
+    assert not edx_dl.has_free_space(str(tmpdir), 2 ** 70) or \
+        edx_dl.get_free_space(str(tmpdir)) is None
+
+
+def test_skip_or_download_lists_each_directory_once(monkeypatch, tmpdir):
+    tmpdir.join('01-a.pdf').write('a')
+    downloads = dict(('http://x/%d.pdf' % i, str(tmpdir.join('%02d-%d.pdf' % (i, i))))
+                     for i in range(20))
+    downloads['http://x/a.pdf'] = str(tmpdir.join('01-a.pdf'))
+    downloaded = []
+    monkeypatch.setattr(edx_dl.os.path, 'exists', None)
+    edx_dl.get_directory_cache().clear()
+
+    class Args(object):
+        dry_run = False
+
+    def mock_download(url, filename, headers, args):
+        downloaded.append(url)
+        open(filename, 'w').close()
+
+    edx_dl.skip_or_download(downloads, {}, Args, mock_download)
+    assert len(downloaded) == 20 and 'http://x/a.pdf' not in downloaded
+
+    # the files just downloaded are known without listing again
+    del downloaded[:]
+    edx_dl.skip_or_download(downloads, {}, Args, mock_download)
+    assert downloaded == []
+
+
+@pytest.mark.parametrize('quality,expected', [
+    ('best', 'http://cdn/v_720p.mp4'),
+    ('smallest', 'http://cdn/v_360p.mp4'),
+    (480, 'http://cdn/v_360p.mp4'),
+    (1080, 'http://cdn/v_720p.mp4'),
+    (240, 'http://cdn/v_360p.mp4'),
+])
+def test_select_rendition_by_height(quality, expected):
+    urls = ['http://cdn/v_360p.mp4', 'http://mirror/v_360p.mp4',
+            'http://cdn/v_720p.mp4']
+    assert edx_dl.select_rendition(urls, quality) == [expected]
+    assert edx_dl.select_rendition(urls, 'all') == urls
+
+
+def test_select_rendition_by_size(monkeypatch):
+    sizes = {'http://cdn/low.mp4': 10, 'http://cdn/high.mp4': 100}
+    monkeypatch.setattr(edx_dl, 'get_content_length', sizes.get)
+    urls = ['http://cdn/low.mp4', 'http://cdn/high.mp4']
+    assert edx_dl.select_rendition(urls, 'best') == ['http://cdn/high.mp4']
+    assert edx_dl.select_rendition(urls, 'smallest') == ['http://cdn/low.mp4']
+    # a single rendition on two hosts needs no request at all
+    monkeypatch.setattr(edx_dl, 'get_content_length', None)
+    assert edx_dl.select_rendition(['http://a/v.mp4', 'http://b/v.mp4'],
+                                   'best') == ['http://a/v.mp4']
+
+
+def _auto_source_args(ignore_errors=False):
+    class Args(object):
+        cdn_quality = 'best'
+        dry_run = False
+    Args.ignore_errors = ignore_errors
+    return Args
+
+
+def test_rank_sources_probes_unknown_hosts(monkeypatch):
+    tracker = ThroughputTracker()
+    monkeypatch.setattr(edx_dl, 'get_throughput_tracker', lambda: tracker)
+    probed = []
+
+    def mock_probe(url):
+        probed.append(url)
+        tracker.record(edx_dl.url_host(url), 10 if 'slow' in url else 100, 1)
+
+    monkeypatch.setattr(edx_dl, 'probe_throughput', mock_probe)
+    tracker.record('fast.example.com', 1000, 1)
+    urls = ['http://slow.example.com/v.mp4', 'http://fast.example.com/v.mp4',
+            'http://mid.example.com/v.mp4', 'https://youtube.com/watch?v=x']
+
+    assert edx_dl.rank_sources(urls) == [urls[1], urls[2], urls[0], urls[3]]
+    assert probed == [urls[0], urls[2]]
+
+
+def test_download_fastest_source_fails_over(monkeypatch, tmpdir):
+    video = Video(video_youtube_url='https://youtube.com/watch?v=abc',
+                  available_subs_url=None, sub_template_url=None,
+                  mp4_urls=['http://a/v.mp4', 'http://b/v.mp4'])
+    monkeypatch.setattr(edx_dl, 'rank_sources', lambda urls: urls)
+    attempts = []
+
+    def mock_download_source(url, target_dir, filename_prefix, args):
+        attempts.append(url)
+        if url != 'https://youtube.com/watch?v=abc':
+            raise _http_error(503)
+
+    monkeypatch.setattr(edx_dl, '_download_source', mock_download_source)
+    edx_dl.get_directory_cache().clear()
+    edx_dl.download_fastest_source(video, _auto_source_args(), str(tmpdir),
+                                   '01', {})
+    assert attempts == ['http://a/v.mp4', 'http://b/v.mp4',
+                        'https://youtube.com/watch?v=abc']
+
+    # all the sources failing: deferred with --ignore-errors
+    def failing_download_source(url, target_dir, filename_prefix, args):
+        raise _http_error(503)
+
+    monkeypatch.setattr(edx_dl, '_download_source', failing_download_source)
+    edx_dl.download_fastest_source(video, _auto_source_args(True),
+                                   str(tmpdir), '01', {})
+    assert [url for url, _, _ in edx_dl._deferred_downloads] == \
+        ['http://a/v.mp4']
+    del edx_dl._deferred_downloads[:]
+
+    # already downloaded from youtube: nothing to do
+    tmpdir.join('01-title-abc.mp4').write('')
+    edx_dl.get_directory_cache().clear()
+    monkeypatch.setattr(edx_dl, '_download_source', None)
+    edx_dl.download_fastest_source(video, _auto_source_args(), str(tmpdir),
+                                   '01', {})
+
+
+def _outline(*subsections):
+    return [Section(position=1, name='Week 1', url='http://x/w1',
+                    subsections=[SubSection(position, name, url)
+                                 for position, name, url in subsections])]
+
+
+def test_outline_file_roundtrip(tmpdir):
+    filename = str(tmpdir.join('outline'))
+    assert edx_dl.read_outline_file(filename) == {}
+    edx_dl.write_outline_file({'c': _outline((1, 'A', 'http://x/a'))},
+                              filename)
+    sections = edx_dl.read_outline_file(filename)['c']
+    assert sections[0].name == 'Week 1'
+    assert sections[0].subsections[0].url == 'http://x/a'
+
+
+def test_diff_outline():
+    old = _outline((1, 'A', 'http://x/a'), (2, 'B', 'http://x/b'),
+                   (3, 'C', 'http://x/c'))
+    new = _outline((1, 'A', 'http://x/a'), (2, 'B (updated)', 'http://x/b'),
+                   (3, 'D', 'http://x/d'))
+    added, changed, removed = edx_dl.diff_outline(old, new)
+    assert [s.url for s in added] == ['http://x/d']
+    assert [s.url for s in changed] == ['http://x/b']
+    assert [s.url for s in removed] == ['http://x/c']
+
+    added, changed, removed = edx_dl.diff_outline(None, new)
+    assert len(added) == 3 and changed == removed == []
+
+
+def test_sync_selections():
+    course = Course(id='c', name='Course', url='http://x/c', state='Started')
+    week1 = _outline((1, 'A', 'http://x/a'))[0]
+    week2 = Section(position=2, name='Week 2', url='http://x/w2',
+                    subsections=[SubSection(1, 'E', 'http://x/e')])
+    all_selections = {course: [week1, week2]}
+
+    selections, changed_urls = edx_dl.sync_selections(
+        all_selections, all_selections, {'c': [week1]})
+    assert selections == {course: [week2]}
+    assert changed_urls == set(['http://x/e'])
+
+    selections, changed_urls = edx_dl.sync_selections(
+        all_selections, all_selections, {'c': [week1, week2]})
+    assert selections == {} and changed_urls == set()
+
+
+def test_extract_all_units_with_cache_refreshes_urls(tmpdir, all_units):
+    filename = str(tmpdir.join('cache'))
+    edx_dl.write_units_to_cache(all_units, filename)
+    extracted = []
+
+    def extractor(urls, headers, file_formats):
+        extracted.extend(urls)
+        return dict((url, []) for url in urls)
+
+    units = edx_dl.extract_all_units_with_cache(
+        ['empty_section', 'nonempty_section', 'new'], {},
+        DEFAULT_FILE_FORMATS, filename=filename, extractor=extractor,
+        refresh_urls=['nonempty_section'])
+    assert extracted == ['nonempty_section', 'new']
+    assert units['nonempty_section'] == []
+
+
+def test_watch_polls_courses_on_their_schedule(monkeypatch):
+    class Args(object):
+        watch = 100.0
+        sync = False
+
+    courses = [Course(id=name, name=name, url='http://x/' + name,
+                      state='Started') for name in ('a', 'b')]
+    clock = [1000.0]
+    processed = []
+    dashboards = []
+
+    def mock_select_courses(args, headers):
+        dashboards.append(clock[0])
+        return courses
+
+    def mock_sleep(seconds):
+        if clock[0] > 1250:
+            raise KeyboardInterrupt
+        clock[0] += seconds
+
+    monkeypatch.setattr(edx_dl, 'select_courses', mock_select_courses)
+    monkeypatch.setattr(edx_dl, 'get_all_selections',
+                        lambda args, selected, headers, api_blocks: selected)
+    monkeypatch.setattr(edx_dl, 'process_selections',
+                        lambda args, headers, formats, selected, api_blocks:
+                        processed.append((selected[0].id, clock[0])))
+    monkeypatch.setattr(edx_dl.time, 'time', lambda: clock[0])
+    monkeypatch.setattr(edx_dl.time, 'sleep', mock_sleep)
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            edx_dl.watch(Args, {}, DEFAULT_FILE_FORMATS)
+    finally:
+        edx_dl.set_conditional_cache(None)
+
+    assert Args.sync
+    assert processed[:2] == [('a', 1000.0), ('b', 1000.0)]
+    assert 3 <= len(dashboards) <= 4
+    for name in ('a', 'b'):
+        times = [t for course, t in processed if course == name]
+        assert len(times) >= 3
+        assert all(80 <= t2 - t1 <= 120 for t1, t2 in zip(times, times[1:]))
+
+
+def test_in_shard_partitions_the_keys():
+    keys = ['http://x/%d.pdf' % i for i in range(300)]
+    shards = [[key for key in keys if edx_dl.in_shard(key, (k, 3))]
+              for k in (1, 2, 3)]
+    assert sorted(sum(shards, [])) == sorted(keys)
+    assert all(shard for shard in shards)
+    assert all(edx_dl.in_shard(key, None) for key in keys)
+
+
+def _write_shards(tmpdir, selections, all_units, count):
+    filenames = []
+    for index in range(1, count + 1):
+        args = _planning_args('out')
+        args.shard = (index, count)
+        filename = str(tmpdir.join('shard-%d' % index))
+        edx_dl.write_shard_manifest(
+            edx_dl.iter_planned_downloads(args, selections, all_units, {}),
+            args.shard,
+            edx_dl.plan_fingerprint(edx_dl._iter_shard_keys(args, selections,
+                                                            all_units)),
+            filename)
+        filenames.append(filename)
+    return filenames
+
+
+def test_merge_shard_manifests(tmpdir, plain_filenames):
+    selections, all_units = _planning_selections()
+    filenames = _write_shards(tmpdir, selections, all_units, 2)
+    merged = str(tmpdir.join('merged'))
+
+    assert edx_dl.merge_shard_manifests(filenames, merged)
+    with open(merged) as f:
+        urls = sorted(json.loads(line)['url'] for line in f)
+    assert urls == ['http://cdn/v.mp4', 'http://x/notes.pdf',
+                    'http://x/slides.pdf']
+
+    # a missing shard, the same shard twice, or shards of different runs
+    assert not edx_dl.merge_shard_manifests(filenames[:1], merged)
+    assert not edx_dl.merge_shard_manifests(filenames[:1] * 2, merged)
+    all_units['http://x/b'] = []
+    other_run = _write_shards(tmpdir.mkdir('other'), selections, all_units, 2)
+    assert not edx_dl.merge_shard_manifests([filenames[0], other_run[1]],
+                                            merged)
+
+
+def test_plan_and_work_queue(monkeypatch, tmpdir, plain_filenames):
+    selections, all_units = _planning_selections()
+    queue_filename = str(tmpdir.join('queue'))
+    edx_dl.plan_queue(edx_dl.iter_planned_downloads(
+        _planning_args(str(tmpdir)), selections, all_units, {}),
+        queue_filename)
+
+    downloaded = []
+
+    def mock_download_url(url, filename, headers, args):
+        if url.endswith('slides.pdf'):
+            raise _http_error(404)
+        downloaded.append(url)
+        open(filename, 'w').close()
+
+    monkeypatch.setattr(edx_dl, 'download_url', mock_download_url)
+    edx_dl.get_directory_cache().clear()
+
+    class Args(object):
+        dry_run = False
+        lease_timeout = 60
+        failures_file = str(tmpdir.join('failures'))
+
+    edx_dl.work_queue(queue_filename, {}, Args)
+
+    assert sorted(downloaded) == ['http://cdn/v.mp4', 'http://x/notes.pdf']
+    assert [url for url, _, _ in
+            edx_dl.read_failures_file(Args.failures_file)] == \
+        ['http://x/slides.pdf']
+
+
+def test_extract_all_units_with_processes(monkeypatch):
+    with open('test/html/multiple_units_no_youtube_ids.html', 'r') as f:
+        page = f.read()
+    urls = ['http://example.com/%d' % i for i in range(4)]
+
+    def mock_get_page_contents(url, headers):
+        assert url in urls
+        return page
+
+    monkeypatch.setattr(edx_dl, 'get_page_contents', mock_get_page_contents)
+    all_units = edx_dl.extract_all_units_with_processes(urls, {},
+                                                        DEFAULT_FILE_FORMATS,
+                                                        processes=2)
+    expected = parsing.ClassicEdXPageExtractor().extract_units_from_html(
+        page, edx_dl.get_site().base_url, DEFAULT_FILE_FORMATS)
+
+    assert sorted(all_units.keys()) == urls
+    for units in all_units.values():
+        assert ([unit.videos[0].mp4_urls for unit in units] ==
+                [unit.videos[0].mp4_urls for unit in expected])
+
+
+def test_get_file_formats_keeps_the_defaults():
+    defaults = list(DEFAULT_FILE_FORMATS)
+    assert edx_dl.get_file_formats(['mkv']) == defaults + ['mkv']
+    assert edx_dl.get_file_formats(['mkv'], overwrite=True) == ['mkv']
+    assert DEFAULT_FILE_FORMATS == defaults
+
+
+def _blocks_api_server(pages):
+    """
+    Serve the JSON of pages {path: data} on a local port, 404 for any
+    other path. Returns the server and its base url.
+    """
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            if path not in pages:
+                self.send_error(404)
+                return
+            body = json.dumps(pages[path]).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+def _api_blocks(base_url, html_enabled):
+    return {
+        'c': {'id': 'c', 'type': 'course', 'children': ['ch']},
+        'ch': {'id': 'ch', 'type': 'chapter', 'display_name': 'Week 1',
+               'children': ['s1', 's2']},
+        's1': {'id': 's1', 'type': 'sequential', 'display_name': 'Video',
+               'lms_web_url': base_url + '/jump/s1', 'children': ['v1']},
+        'v1': {'id': 'v1', 'type': 'vertical', 'children': ['video']},
+        'video': {'id': 'video', 'type': 'video', 'student_view_data': {
+            'encoded_videos': {'desktop_mp4': {'url': 'http://cdn/v.mp4'}}}},
+        's2': {'id': 's2', 'type': 'sequential', 'display_name': 'Notes',
+               'lms_web_url': base_url + '/jump/s2', 'children': ['v2']},
+        'v2': {'id': 'v2', 'type': 'vertical', 'children': ['html']},
+        'html': {'id': 'html', 'type': 'html', 'student_view_data': {
+            'enabled': html_enabled,
+            'html': '<a href="/static/notes.pdf">notes</a>'}},
+    }
+
+
+def _blocks_api_args():
+    class Args(object):
+        pass
+    args = Args()
+    args.blocks_api = True
+    return args
+
+
+def _mock_site(monkeypatch, base_url):
+    monkeypatch.setitem(edx_dl.OPENEDX_SITES, 'mock',
+                        {'url': base_url, 'courseware-selector': None})
+    return edx_dl.OpenEdxSite('mock')
+
+
+def test_blocks_api_outline_and_units(monkeypatch):
+    pages = {'/api/user/v1/me': {'username': 'student'}}
+    server, base_url = _blocks_api_server(pages)
+    pages['/api/courses/v1/blocks/'] = {'root': 'c',
+                                        'blocks': _api_blocks(base_url, False)}
+    site = _mock_site(monkeypatch, base_url)
+    course = Course(id='course-v1:o+c+r', name='Course',
+                    url=base_url + '/courses/course-v1:o+c+r/info',
+                    state='Started')
+    try:
+        api_blocks = {}
+        with edx_dl.use_site(site):
+            all_selections = edx_dl.get_all_selections(
+                _blocks_api_args(), [course], {}, api_blocks)
+    finally:
+        server.shutdown()
+
+    sections = all_selections[course]
+    urls = [subsection.url for subsection in sections[0].subsections]
+    assert urls == [base_url + '/jump/s1', base_url + '/jump/s2']
+    assert sorted(api_blocks) == urls
+
+    scraped = []
+
+    def page_extractor(urls, headers, file_formats):
+        scraped.extend(urls)
+        return dict((url, []) for url in urls)
+
+    all_units = edx_dl.extract_all_units_with_api(
+        urls, {}, DEFAULT_FILE_FORMATS, api_blocks, page_extractor)
+    # the html of s2 is not given by the api, its page is scraped
+    assert scraped == [base_url + '/jump/s2']
+    assert list(all_units[urls[0]][0].videos[0].mp4_urls) == \
+        ['http://cdn/v.mp4']
+
+
+def test_blocks_api_falls_back_to_pages(monkeypatch):
+    server, base_url = _blocks_api_server(
+        {'/api/user/v1/me': {'username': 'student'}})
+    site = _mock_site(monkeypatch, base_url)
+    sections = [Section(position=1, name='Intro', url='http://x/s',
+                        subsections=[])]
+    requested = []
+
+    def get_available_sections(url, headers):
+        requested.append(url)
+        return sections
+
+    monkeypatch.setattr(edx_dl, 'get_available_sections',
+                        get_available_sections)
+    course = Course(id='course-v1:o+c+r', name='Course',
+                    url=base_url + '/courses/course-v1:o+c+r/info',
+                    state='Started')
+    try:
+        api_blocks = {}
+        with edx_dl.use_site(site):
+            all_selections = edx_dl.get_all_selections(
+                _blocks_api_args(), [course], {}, api_blocks)
+    finally:
+        server.shutdown()
+
+    assert all_selections == {course: sections}
+    assert requested == [base_url + '/courses/course-v1:o+c+r/courseware']
+    assert api_blocks == {}
+
+
+def test_sites_have_separate_sessions(monkeypatch):
+    sites = [_mock_site(monkeypatch, 'http://127.0.0.1:1'),
+             edx_dl.OpenEdxSite('edge')]
+    seen = {}
+
+    def run(site):
+        with edx_dl.use_site(site):
+            pool = edx_dl.thread_pool(2)
+            try:
+                seen[site.name] = pool.map(lambda _: edx_dl.get_site(),
+                                           range(4))
+            finally:
+                pool.close()
+                pool.join()
+
+    threads = [threading.Thread(target=run, args=(site,)) for site in sites]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # the threads of the pools work in the site that started them
+    assert seen == {'mock': [sites[0]] * 4, 'edge': [sites[1]] * 4}
+    assert sites[0].cookiejar is not sites[1].cookiejar
+    assert edx_dl.get_site().name == 'edx'
+
+
+# Modules that are slow to import and must only be imported when needed
+LAZY_MODULES = ['bs4', 'html5lib', 'http.cookiejar', 'urllib.request',
+                'multiprocessing', 'pickle', 'hashlib', 'mmap', 'brotli',
+                'sqlite3', 'cProfile', 'tracemalloc']
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason="-X importtime needs python 3.7")
+def test_import_time():
+    """
+    Make sure that importing the cli module (paid by --version, --help and
+    argument errors) does not import heavy modules.
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', 'import edx_dl.edx_dl'],
+        stderr=subprocess.STDOUT).decode('utf-8')
+    imported = set(line.split('|')[-1].strip()
+                   for line in output.splitlines()
+                   if line.startswith('import time:'))
+
+    assert 'edx_dl.edx_dl' in imported
+    for module in LAZY_MODULES:
+        assert module not in imported, module
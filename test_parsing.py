@@ -11,9 +11,13 @@ from edx_dl.common import DEFAULT_FILE_FORMATS
 
 from edx_dl.parsing import (
     edx_json2srt,
+    BlocksApiExtractor,
     ClassicEdXPageExtractor,
     CurrentEdXPageExtractor,
     is_youtube_url,
+    iter_unit_blocks,
+    rendition_height,
+    RE_UNITS,
 )
 
 
@@ -152,3 +156,140 @@ def test_is_youtube_url():
         assert not is_youtube_url(url)
     for url in valid_urls:
         assert is_youtube_url(url)
+
+
+def _chunks(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize('size', [64, 4096, 65536])
+@pytest.mark.parametrize('file', ['test/html/multiple_units.html',
+                                  'test/html/old_multiple_units.html'])
+def test_iter_unit_blocks_matches_findall(file, size):
+    with open(file, "r") as f:
+        page = f.read()
+    blocks = list(iter_unit_blocks(_chunks(page, size)))
+    assert len(blocks) > 0
+    assert blocks == RE_UNITS.findall(page)
+
+
+def test_iter_unit_blocks_split_inside_unit_start():
+    with open('test/html/multiple_units.html', "r") as f:
+        page = f.read()
+    split = page.index('seq_contents_') + len('seq_cont')
+    blocks = list(iter_unit_blocks([page[:split], page[split:]]))
+    assert blocks == RE_UNITS.findall(page)
+
+
+def test_iter_unit_blocks_drops_false_starts():
+    page = ('<div id="seq_contents_x">' + 'a' * 1000 +
+            '<div id="seq_contents_1">unit</div>' + 'b' * 1000)
+    consumed = []
+
+    def tracked(text):
+        for chunk in _chunks(text, 100):
+            consumed.append(chunk)
+            yield chunk
+
+    blocks = iter_unit_blocks(tracked(page))
+    assert next(blocks) == '<div id="seq_contents_1">unit</div>'
+    # the unit was emitted as soon as it was complete
+    assert len(consumed) == 11
+    assert list(blocks) == []
+
+
+def test_extract_units_from_stream():
+    site = 'https://courses.edx.org'
+    with open("test/html/multiple_units_no_youtube_ids.html", "r") as f:
+        page = f.read()
+    extractor = ClassicEdXPageExtractor()
+    units = extractor.extract_units_from_html(page, site, DEFAULT_FILE_FORMATS)
+    streamed = extractor.extract_units_from_stream(_chunks(page, 100), site,
+                                                   DEFAULT_FILE_FORMATS)
+    assert len(units) > 0
+    assert ([u.videos[0].mp4_urls for u in units] ==
+            [u.videos[0].mp4_urls for u in streamed])
+
+
+@pytest.mark.parametrize('url,height', [
+    ('https://cdn.example.com/course/video_720p.mp4', 720),
+    ('https://cdn.example.com/course/video-1080.mp4', 1080),
+    ('https://cdn.example.com/480/video.mp4', 480),
+    ('https://cdn.example.com/course/video_DTH.mp4', None),
+    ('https://cdn720.example.com/course/video2160x.mp4', None),
+])
+def test_rendition_height(url, height):
+    assert rendition_height(url) == height
+
+
+def _course_blocks(html_data):
+    course = 'block-v1:org+c+run+type@'
+    return {
+        course + 'course+block@c': {
+            'id': course + 'course+block@c', 'type': 'course',
+            'children': [course + 'chapter+block@ch']},
+        course + 'chapter+block@ch': {
+            'id': course + 'chapter+block@ch', 'type': 'chapter',
+            'display_name': 'Week 1',
+            'children': [course + 'sequential+block@s']},
+        course + 'sequential+block@s': {
+            'id': course + 'sequential+block@s', 'type': 'sequential',
+            'display_name': 'Lecture', 'lms_web_url': 'https://x/jump/s',
+            'children': [course + 'vertical+block@v']},
+        course + 'vertical+block@v': {
+            'id': course + 'vertical+block@v', 'type': 'vertical',
+            'children': [course + 'video+block@vid',
+                         course + 'html+block@h']},
+        course + 'video+block@vid': {
+            'id': course + 'video+block@vid', 'type': 'video',
+            'student_view_data': {
+                'encoded_videos': {
+                    'youtube': {'url': 'https://www.youtube.com/watch?v=abc'},
+                    'desktop_mp4': {'url': 'https://cdn/v_720.mp4'},
+                    'mobile_low': {'url': 'https://cdn/v_360.mp4'},
+                    'hls': {'url': 'https://cdn/v.m3u8'}},
+                'transcripts': {'en': 'https://x/en.srt'}}},
+        course + 'html+block@h': {
+            'id': course + 'html+block@h', 'type': 'html',
+            'student_view_data': html_data},
+    }
+
+
+def test_blocks_api_extract_sections():
+    blocks = _course_blocks({})
+    extractor = BlocksApiExtractor('https://x', 'course-v1:org+c+run')
+    page = {'blocks': blocks}
+    blocks, root, next_url = extractor.parse_blocks_page(page)
+    assert root == 'block-v1:org+c+run+type@course+block@c'
+    assert next_url is None
+    sections = extractor.extract_sections(blocks, root)
+    assert [s.name for s in sections] == ['Week 1']
+    assert [(s.position, s.name, s.url) for s in sections[0].subsections] == \
+        [(1, 'Lecture', 'https://x/jump/s')]
+
+
+def test_blocks_api_extract_units():
+    html = {'enabled': True,
+            'html': '<p><a href="/static/notes.pdf">notes</a> '
+                    '<a href="https://x/page">page</a></p>'}
+    blocks = _course_blocks(html)
+    extractor = BlocksApiExtractor('https://x', 'course-v1:org+c+run')
+    units = extractor.extract_units(
+        blocks, 'block-v1:org+c+run+type@sequential+block@s', ['pdf'])
+    assert len(units) == 1
+    video = units[0].videos[0]
+    assert video.video_youtube_url == 'https://www.youtube.com/watch?v=abc'
+    assert list(video.mp4_urls) == ['https://cdn/v_720.mp4',
+                                    'https://cdn/v_360.mp4']
+    assert video.sub_template_url == (
+        'https://x/courses/course-v1:org+c+run/xblock/'
+        'block-v1:org+c+run+type@video+block@vid/handler/transcript/'
+        'translation/%s')
+    assert list(units[0].resources_urls) == ['https://x/static/notes.pdf']
+
+
+def test_blocks_api_needs_page_without_html_data():
+    blocks = _course_blocks({'enabled': False})
+    extractor = BlocksApiExtractor('https://x', 'course-v1:org+c+run')
+    assert extractor.extract_units(
+        blocks, 'block-v1:org+c+run+type@sequential+block@s', ['pdf']) is None
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import pstats
+import threading
+
+import pytest
+
+from edx_dl.profiling import MemoryTracer, RunProfiler
+
+
+def _worker_function():
+    return sum(i * i for i in range(1000))
+
+
+def test_profile_merges_threads(tmpdir):
+    filename = str(tmpdir.join('run.pstats'))
+    profiler = RunProfiler()
+    profiler.start()
+    try:
+        thread = threading.Thread(target=_worker_function)
+        thread.start()
+        thread.join()
+    finally:
+        profiler.stop(filename)
+
+    functions = set(name for _, _, name in pstats.Stats(filename).stats)
+    assert '_worker_function' in functions
+
+
+def test_memory_tracer_reports_phases(caplog):
+    pytest.importorskip('tracemalloc')
+    tracer = MemoryTracer(limit=3)
+    tracer.start()
+    try:
+        with caplog.at_level(logging.INFO):
+            data = [bytearray(1024) for _ in range(100)]
+            tracer.snapshot('extraction')
+            more = [bytearray(1024) for _ in range(100)]
+            tracer.snapshot('download')
+    finally:
+        tracer.stop()
+
+    messages = [record.getMessage() for record in caplog.records]
+    phases = [m for m in messages if m.startswith('Memory after')]
+    assert [m.split(':')[0] for m in phases] == ['Memory after extraction',
+                                                 'Memory after download']
+    assert any('test_profiling.py' in m for m in messages)
+    assert len(data) == len(more)
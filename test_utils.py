@@ -3,11 +3,20 @@
 
 from __future__ import unicode_literals
 
+import hashlib
+import socket
 import subprocess
+import threading
+import time
+import zlib
+
+from email.message import Message
 
 import pytest
 import six
 
+from six.moves.urllib.error import HTTPError, URLError
+
 from edx_dl import utils
 
 
@@ -169,3 +178,419 @@ def test_remove_duplicates_with_seen():
     for l, seen_before, reduced_l, seen_after in lists:
         actual_res = utils.remove_duplicates(l, seen_before)
         assert actual_res == (reduced_l, seen_after), actual_res
+
+
+def test_adaptive_limiter_additive_increase():
+    limiter = utils.AdaptiveLimiter(initial=2, maximum=4)
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release(latency=0.1, status=200)
+    assert limiter.limit == 4
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.parametrize('status', [429, 500, 503])
+def test_adaptive_limiter_multiplicative_decrease(status):
+    limiter = utils.AdaptiveLimiter(initial=8, maximum=16)
+    limiter.acquire()
+    limiter.release(status=status)
+    assert limiter.limit == 4
+
+
+def test_adaptive_limiter_does_not_grow_on_slow_responses():
+    limiter = utils.AdaptiveLimiter(initial=2, latency_target=1.0)
+    limiter.acquire()
+    limiter.release(latency=3.0, status=200)
+    assert limiter.limit == 2
+
+
+def test_adaptive_limiter_honors_retry_after():
+    limiter = utils.AdaptiveLimiter(initial=2)
+    limiter.acquire()
+    limiter.release(status=429, retry_after=0.2)
+    start = time.time()
+    limiter.acquire()
+    assert time.time() - start >= 0.15
+    assert limiter.limit == 1
+
+
+def test_parse_retry_after():
+    assert utils.parse_retry_after(None) is None
+    assert utils.parse_retry_after('') is None
+    assert utils.parse_retry_after('120') == 120
+    assert utils.parse_retry_after('not a date') is None
+    assert utils.parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+
+
+def _http_error(code, headers=None):
+    hdrs = Message()
+    for k, v in (headers or {}).items():
+        hdrs[k] = v
+    return HTTPError('http://example.com', code, 'error', hdrs, None)
+
+
+def test_retry_policy_classification():
+    policy = utils.RetryPolicy()
+    assert policy.is_retryable(_http_error(503))
+    assert policy.is_retryable(_http_error(429))
+    assert not policy.is_retryable(_http_error(404))
+    assert policy.is_retryable(URLError('connection refused'))
+    assert not policy.is_retryable(ValueError('bad json'))
+
+
+def test_retry_policy_delay_is_bounded():
+    policy = utils.RetryPolicy(base_delay=1.0, max_delay=5.0)
+    for attempt in range(1, 10):
+        assert 0 <= policy.delay(attempt) <= 5.0
+    assert policy.delay(1, retry_after=3) >= 3
+
+
+def test_retry_policy_retries_transient_errors():
+    policy = utils.RetryPolicy(max_attempts=3, base_delay=0)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise _http_error(503)
+        return 'ok'
+
+    assert policy.call(flaky) == 'ok'
+    assert len(calls) == 3
+
+
+def test_retry_policy_gives_up():
+    policy = utils.RetryPolicy(max_attempts=2, base_delay=0)
+    calls = []
+
+    def failing():
+        calls.append(1)
+        raise _http_error(500)
+
+    with pytest.raises(Exception):
+        policy.call(failing)
+    assert len(calls) == 2
+
+
+def test_retry_policy_does_not_retry_permanent_errors():
+    policy = utils.RetryPolicy(max_attempts=5, base_delay=0)
+    calls = []
+
+    def not_found():
+        calls.append(1)
+        raise _http_error(404)
+
+    with pytest.raises(Exception):
+        policy.call(not_found)
+    assert len(calls) == 1
+
+
+class _FakeResponse(object):
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_watchdog_cancels_stalled_transfers():
+    watchdog = utils.Watchdog(stall_timeout=10)
+    transfer = watchdog.watch(_FakeResponse())
+    assert watchdog.check(now=transfer.last_progress + 5) == []
+    assert watchdog.check(now=transfer.last_progress + 11) == [transfer]
+    assert transfer.cancelled
+    assert transfer.response.closed
+
+
+def _serve_stalled_response(server):
+    conn, _ = server.accept()
+    conn.recv(4096)
+    conn.sendall(b'HTTP/1.0 200 OK\r\nContent-Length: 1000\r\n\r\npartial')
+    time.sleep(3)
+    conn.close()
+
+
+def test_stalled_transfer_is_cancelled():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    thread = threading.Thread(target=_serve_stalled_response, args=(server,))
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%d/' % server.getsockname()[1]
+
+    utils.set_watchdog(utils.Watchdog(stall_timeout=0.3))
+    utils.set_retry_policy(utils.RetryPolicy(max_attempts=1))
+    try:
+        start = time.time()
+        with pytest.raises(utils.StalledTransferError):
+            utils.get_page_contents(url, {})
+        assert time.time() - start < 2.5
+    finally:
+        utils.set_watchdog(utils.Watchdog())
+        utils.set_retry_policy(utils.RetryPolicy())
+        server.close()
+
+
+def _serve_once(server, response):
+    conn, _ = server.accept()
+    conn.recv(4096)
+    conn.sendall(response)
+    conn.close()
+
+
+def _local_server(response):
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    thread = threading.Thread(target=_serve_once, args=(server, response))
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d/' % server.getsockname()[1]
+
+
+def test_open_url_holds_the_slot_until_closed():
+    server, url = _local_server(b'HTTP/1.0 200 OK\r\nContent-Length: 5\r\n\r\nhello')
+    limiter = utils.AdaptiveLimiter(initial=2, maximum=4)
+    try:
+        response = utils.open_url(url, limiter)
+        assert limiter.in_flight == 1
+        assert response.read() == b'hello'
+        assert limiter.in_flight == 1
+        response.close()
+        assert limiter.in_flight == 0
+        assert limiter.limit > 2
+        response.close()
+        assert limiter.in_flight == 0
+    finally:
+        server.close()
+
+
+def test_download_file_leaves_no_partial_file(tmpdir):
+    server, url = _local_server(
+        b'HTTP/1.0 200 OK\r\nContent-Length: 1000\r\n\r\npartial')
+    filename = str(tmpdir.join('video.mp4'))
+    utils.set_retry_policy(utils.RetryPolicy(max_attempts=1))
+    try:
+        with pytest.raises(Exception):
+            utils.download_file(url, filename)
+    finally:
+        utils.set_retry_policy(utils.RetryPolicy())
+        server.close()
+    assert tmpdir.listdir() == []
+
+
+@pytest.mark.parametrize('value,rate', [('100000', 100000), ('500K', 512000),
+                                        ('1.5m', 1572864), ('0', None)])
+def test_parse_rate(value, rate):
+    assert utils.parse_rate(value) == rate
+
+
+def test_parse_rate_invalid():
+    with pytest.raises(ValueError):
+        utils.parse_rate('fast')
+
+
+def test_rate_schedule():
+    schedule = utils.parse_rate_schedule('22:00-06:00=0,12:00-14:00=2M')
+    assert schedule == [(22 * 60, 6 * 60, None), (12 * 60, 14 * 60, 2097152)]
+    limiter = utils.BandwidthLimiter(1000, schedule)
+
+    def at(hour, minute):
+        return time.mktime((2020, 1, 1, hour, minute, 0, 0, 0, -1))
+
+    assert limiter.current_rate(at(23, 30)) is None
+    assert limiter.current_rate(at(3, 0)) is None
+    assert limiter.current_rate(at(13, 59)) == 2097152
+    assert limiter.current_rate(at(9, 0)) == 1000
+    with pytest.raises(ValueError):
+        utils.parse_rate_schedule('22:00=0')
+
+
+def test_bandwidth_limiter_sleeps_for_the_debt(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(utils.time, 'sleep', sleeps.append)
+    limiter = utils.BandwidthLimiter(1000)
+    waits = []
+    limiter.consume(2500, lambda: waits.append(1))
+    assert sum(sleeps) == pytest.approx(2.5, abs=0.01)
+    assert len(waits) == len(sleeps) == 3
+
+    unlimited = utils.BandwidthLimiter(None)
+    del sleeps[:]
+    unlimited.consume(10 ** 9)
+    assert sleeps == []
+
+
+def test_directory_cache(tmpdir):
+    tmpdir.join('a.mp4').write('12345')
+    tmpdir.mkdir('section')
+    cache = utils.DirectoryCache()
+
+    assert cache.exists(str(tmpdir.join('a.mp4')))
+    assert cache.size(str(tmpdir.join('a.mp4'))) == 5
+    assert cache.is_dir(str(tmpdir.join('section')))
+    assert not cache.exists(str(tmpdir.join('b.mp4')))
+    assert cache.listing(str(tmpdir.join('missing'))) == {}
+
+    tmpdir.join('b.mp4').write('1')
+    assert not cache.exists(str(tmpdir.join('b.mp4')))
+    cache.add(str(tmpdir.join('b.mp4')))
+    assert cache.size(str(tmpdir.join('b.mp4'))) == 1
+
+    tmpdir.join('c.mp4').write('1')
+    cache.forget(str(tmpdir))
+    assert cache.exists(str(tmpdir.join('c.mp4')))
+
+
+def test_throughput_tracker():
+    tracker = utils.ThroughputTracker(weight=0.5)
+    assert tracker.estimate('cdn') is None
+    tracker.record('cdn', 1000, 1.0)
+    tracker.record('cdn', 3000, 1.0)
+    assert tracker.estimate('cdn') == 2000
+    tracker.penalize('cdn')
+    assert tracker.estimate('cdn') == 1000
+    tracker.penalize('mirror')
+    assert tracker.estimate('mirror') == 0
+
+
+def test_probe_throughput_reads_only_the_range():
+    server, url = _local_server(
+        b'HTTP/1.0 200 OK\r\nContent-Length: 100000\r\n\r\n' +
+        b'x' * 100000)
+    try:
+        assert utils.probe_throughput(url, nbytes=1000) > 0
+    finally:
+        server.close()
+    assert utils.get_throughput_tracker().estimate(utils.url_host(url)) > 0
+
+
+def test_conditional_requests(monkeypatch):
+    requests = []
+    responses = [('v1', {'ETag': '"1"'}), None, ('v2', {'ETag': '"2"'})]
+
+    def mock_get_page_contents(url, headers, response_info=None):
+        requests.append(headers)
+        response = responses.pop(0)
+        if response is None:
+            raise HTTPError(url, 304, 'Not Modified', Message(), None)
+        response_info.append(response[1])
+        return response[0]
+
+    monkeypatch.setattr(utils, '_get_page_contents', mock_get_page_contents)
+    utils.set_conditional_cache(utils.ConditionalCache())
+    try:
+        pages = [utils.get_page_contents('http://x', {'a': 'b'},
+                                         conditional=True)
+                 for _ in range(3)]
+    finally:
+        utils.set_conditional_cache(None)
+
+    assert pages == ['v1', 'v1', 'v2']
+    assert requests == [{'a': 'b'}, {'a': 'b', 'If-None-Match': '"1"'},
+                        {'a': 'b', 'If-None-Match': '"1"'}]
+
+
+def test_get_content_length():
+    server, url = _local_server(
+        b'HTTP/1.0 200 OK\r\nContent-Length: 12345\r\n\r\n')
+    try:
+        assert utils.get_content_length(url) == 12345
+    finally:
+        server.close()
+
+
+def test_get_free_space_of_missing_directory(tmpdir):
+    free = utils.get_free_space(str(tmpdir.join('not', 'yet')))
+    assert free is None or free > 0
+
+
+def test_download_file(tmpdir):
+    server, url = _local_server(
+        b'HTTP/1.0 200 OK\r\nContent-Length: 5\r\n\r\nhello')
+    filename = str(tmpdir.join('video.mp4'))
+    try:
+        utils.download_file(url, filename)
+    finally:
+        server.close()
+    assert tmpdir.join('video.mp4').read() == 'hello'
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_download_file_hashes_while_writing(tmpdir):
+    server, url = _local_server(
+        b'HTTP/1.0 200 OK\r\nContent-Length: 5\r\n\r\nhello')
+    filename = str(tmpdir.join('video.mp4'))
+    try:
+        digest = utils.download_file(url, filename, new_hash=hashlib.sha256)
+    finally:
+        server.close()
+    assert digest == hashlib.sha256(b'hello').hexdigest()
+
+
+def _serve_slowly(server, body):
+    conn, _ = server.accept()
+    conn.recv(4096)
+    conn.sendall(b'HTTP/1.0 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body))
+    for i in range(len(body)):
+        conn.sendall(body[i:i + 1])
+        time.sleep(0.1)
+    conn.close()
+
+
+def test_slow_transfer_is_not_stalled():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    thread = threading.Thread(target=_serve_slowly, args=(server, b'0123456789'))
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%d/' % server.getsockname()[1]
+
+    utils.set_watchdog(utils.Watchdog(stall_timeout=0.5))
+    utils.set_retry_policy(utils.RetryPolicy(max_attempts=1))
+    try:
+        assert utils.get_page_contents(url, {}) == '0123456789'
+    finally:
+        utils.set_watchdog(utils.Watchdog())
+        utils.set_retry_policy(utils.RetryPolicy())
+        server.close()
+
+
+def _compress(data, encoding):
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == 'raw-deflate':
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    else:
+        compressor = zlib.compressobj(9)
+    return compressor.compress(data) + compressor.flush()
+
+
+@pytest.mark.parametrize('encoding,header', [('gzip', 'gzip'),
+                                             ('deflate', 'deflate'),
+                                             ('raw-deflate', 'deflate')])
+def test_get_page_contents_decompresses(encoding, header):
+    page = u'<div>caf\xe9</div>' * 1000
+    body = _compress(page.encode('utf-8'), encoding)
+    server, url = _local_server(
+        b'HTTP/1.0 200 OK\r\nContent-Type: text/html; charset=utf-8\r\n' +
+        b'Content-Encoding: ' + header.encode('ascii') + b'\r\n' +
+        b'Content-Length: ' + str(len(body)).encode('ascii') + b'\r\n\r\n' +
+        body)
+    wire_bytes = utils.transfer_stats.wire_bytes
+    decoded_bytes = utils.transfer_stats.decoded_bytes
+    try:
+        assert utils.get_page_contents(url, {}) == page
+    finally:
+        server.close()
+    assert utils.transfer_stats.wire_bytes - wire_bytes == len(body)
+    assert (utils.transfer_stats.decoded_bytes - decoded_bytes ==
+            len(page.encode('utf-8')))
+
+
+def test_page_request_accepts_compression():
+    request = utils._page_request('http://example.com', {'X-Test': '1'})
+    assert 'gzip' in request.get_header('Accept-encoding')
+    assert request.get_header('X-test') == '1'
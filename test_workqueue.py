@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+
+from edx_dl import workqueue
+from edx_dl.workqueue import WorkQueue
+
+
+def _queue(tmpdir, **kwargs):
+    queue = WorkQueue(str(tmpdir.join('queue')), **kwargs)
+    queue.add([('http://x/%d' % i, 'out/%d' % i, 'url') for i in range(3)])
+    return queue
+
+
+def test_add_ignores_known_filenames(tmpdir):
+    queue = _queue(tmpdir)
+    assert queue.add([('http://x/0', 'out/0', 'url'),
+                      ('http://x/3', 'out/3', 'url')]) == 1
+    assert queue.counts() == {workqueue.PENDING: 4}
+
+
+def test_workers_lease_different_jobs(tmpdir):
+    _queue(tmpdir).close()
+    leased = []
+    lock = threading.Lock()
+
+    def worker(name):
+        queue = WorkQueue(str(tmpdir.join('queue')))
+        while True:
+            job = queue.lease(name)
+            if job is None:
+                break
+            with lock:
+                leased.append(job.url)
+            queue.complete(job, name)
+        queue.close()
+
+    threads = [threading.Thread(target=worker, args=('w%d' % i,))
+               for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(leased) == ['http://x/0', 'http://x/1', 'http://x/2']
+    assert WorkQueue(str(tmpdir.join('queue'))).counts() == \
+        {workqueue.DONE: 3}
+
+
+def test_expired_lease_goes_to_another_worker(tmpdir):
+    queue = _queue(tmpdir, lease_timeout=10)
+    job = queue.lease('crashed', now=100)
+    assert [queue.lease('other', now=105).url for _ in range(2)] == \
+        ['http://x/1', 'http://x/2']
+    assert queue.lease('other', now=105) is None
+    assert queue.lease('other', now=111).id == job.id
+    # the crashed worker lost its lease
+    assert not queue.renew(job, 'crashed')
+
+
+def test_failed_jobs_are_retried_then_given_up(tmpdir):
+    queue = _queue(tmpdir, max_attempts=2)
+    job = queue.lease('w')
+    queue.fail(job, 'w')
+    assert queue.lease('w').id == job.id
+    queue.fail(job, 'w')
+    assert queue.counts()[workqueue.FAILED] == 1
+    assert queue.failures() == [('http://x/0', 'out/0', 'url')]
+
+    job = queue.lease('w')
+    queue.fail(job, 'w', retry=False)
+    assert queue.counts()[workqueue.FAILED] == 2